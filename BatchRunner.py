@@ -0,0 +1,236 @@
+import os
+import json
+import time
+import argparse
+import tempfile
+import traceback
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+
+import ee
+import pandas as pd
+
+from Utilities import *
+from RequestGovernor import get_info
+from TimeSeriesStore import TimeSeriesStore, aoi_key, update_area_series
+
+# Pipeline stages in run order; each stage needs the ones before it
+pipeline_stages = ['process', 'water', 'areas', 'depths', 'volumes']
+
+# Parameters of a job that are not given in the job file
+job_defaults = {'platform': 'Landsat-Collection 2', 'cloud_threshold': 50, 'clear_threshold': 0,
+                'speckle_filter': 'Refined-Lee', 'water_index': 'NDWI', 'threshold_method': 'Simple', 'threshold': 0.0,
+                'depth_method': 'FwDET', 'dem': 'SRTM', 'area_unit': 'Square m', 'volume_unit': 'ac-ft',
+                'deferred_clip': False, 'incremental': False, 'last_stage': 'volumes'}
+
+def load_jobs(job_file):
+    """Reads a batch job file.
+    The file is JSON: {"defaults": {...}, "jobs": [{"id": "...", "boundary": "...", "start": "YYYY-MM-dd",
+    "end": "YYYY-MM-dd", ...}]}. Job parameters override the file defaults, which override job_defaults.
+    Args:
+        job_file (str): Path of the job file
+    Returns:
+        list: Job parameter dictionaries
+    """
+    with open(job_file) as f:
+        spec = json.load(f)
+    jobs = []
+    for job in spec['jobs']:
+        params = dict(job_defaults)
+        params.update(spec.get('defaults', {}))
+        params.update(job)
+        params['id'] = str(params.get('id') or os.path.splitext(os.path.basename(params['boundary']))[0])
+        jobs.append(params)
+    return jobs
+
+def load_checkpoint(job_dir, stage, config):
+    """Reads the checkpoint of a stage; returns None if missing or written by another configuration"""
+    path = os.path.join(job_dir, stage + '.json')
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        checkpoint = json.load(f)
+    return checkpoint if checkpoint.get('config') == config else None
+
+def save_checkpoint(job_dir, stage, config, outputs):
+    """Writes the checkpoint of a stage through a temporary file, so a crash never leaves a partial checkpoint"""
+    fd, tmp = tempfile.mkstemp(dir=job_dir, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'config': config, 'outputs': outputs}, f, default=str)
+    os.replace(tmp, os.path.join(job_dir, stage + '.json'))
+
+def _property_series(collection, prop, band):
+    """Fetches the dates and a dictionary property of every image with one request; band None keeps whole dictionaries"""
+    info = get_info(ee.Dictionary({'times': collection.aggregate_array('system:time_start'),
+                                   'values': collection.aggregate_array(prop)}))
+    dates = [datetime.utcfromtimestamp(t / 1000.0).strftime('%Y-%m-%d') for t in info['times']]
+    return dates, [v if band is None else v.get(band) for v in info['values']]
+
+def _process(job, state, checkpoint, job_dir):
+    aoi = prepare_aoi(job['boundary'], platform_scales[job['platform']])
+    state['site'] = aoi['site']
+    # A resumed job reuses the scenes kept by the clear fraction prefilter instead of requesting them again
+    report = checkpoint.get('prefilter') if checkpoint else None
+    images, state['landsat_images'], new_report = load_platform_images(
+        job['platform'], aoi['site'], aoi['bounds'], ee.Date(job['start']), ee.Date(job['end']),
+        job['cloud_threshold'], job['clear_threshold'] / 100.0, job['speckle_filter'],
+        clear_ids=report.get('kept_ids') if report else None)
+    report = new_report or report
+    state['plan'] = checkpoint['plan'] if checkpoint else same_day_plan(images)
+    if not job['deferred_clip']:
+        images = images.map(lambda img: img.clip(aoi['site']).copyProperties(img, img.propertyNames()))
+    state['images'] = mosaic_same_day(images, state['plan'])
+    # Same scale as the Toolbox, so batch and interactive runs give the same areas
+    state['img_scale'] = checkpoint.get('img_scale') if checkpoint else None
+    if state['img_scale'] is None:
+        state['img_scale'] = collection_scale(state['images'])
+    return {'plan': state['plan'], 'img_scale': state['img_scale'],
+            'scenes': sum(len(ids) for ids in state['plan'].values()), 'dates': len(state['plan']), 'prefilter': report}
+
+def _water(job, state, checkpoint, job_dir):
+    terrain = None
+    if job['platform'] == 'Landsat-Collection 2' and job['water_index'] == 'DSWE':
+        terrain = get_terrain_layers('USGS/SRTMGL1_003', 'elevation', state['site'])
+    water = extract_water(state['images'], job['platform'], job['water_index'], job['threshold_method'],
+                          job['threshold'], state['site'], state['img_scale'], landsat_images=state['landsat_images'],
+                          terrain=terrain, plan=state['plan'], dswe_aoi=None if job['deferred_clip'] else state['site'])
+    state['WaterMasks'] = water['WaterMasks']
+    return {}
+
+def _areas(job, state, checkpoint, job_dir):
+    if checkpoint:
+        return checkpoint
+    divisor, symbol = area_units[job['area_unit']]
+    if job['incremental']:
+        # Only the dates missing from the stored series of the AOI are computed
+        params = {k: job[k] for k in ['platform', 'cloud_threshold', 'clear_threshold', 'speckle_filter',
+                                      'water_index', 'threshold_method', 'threshold']}
+        params['scale'] = state['img_scale']
+        series, _ = update_area_series(TimeSeriesStore(job.get('store')), aoi_key(state['site'], job['boundary']),
+                                       params, state['WaterMasks'], state['site'], state['img_scale'])
+        series = series[(series['Date'] >= job['start']) & (series['Date'] < job['end'])]
+        dates, values = series['Date'].dt.strftime('%Y-%m-%d').tolist(), (series['Area'] / divisor).tolist()
+    else:
+        areas = state['WaterMasks'].map(water_area_function(state['site'], state['img_scale'], divisor))
+        dates, values = _property_series(areas, 'water_area', 'waterMask')
+    pd.DataFrame({'Date': dates, 'Area, ' + symbol: values}).to_csv(os.path.join(job_dir, 'areas.csv'), index=False)
+    return {'file': 'areas.csv', 'images': len(dates)}
+
+def _depths(job, state, checkpoint, job_dir):
+    demSource, band = dem_source(job['dem'], job.get('user_dem'))
+    dem = get_terrain_layers(demSource, band, state['site']).select('elevation').clip(state['site'])
+    state['depth_maps'], _ = depth_estimates(state['WaterMasks'], job['depth_method'], dem, state['site'],
+                                             state['img_scale'])
+    if checkpoint:
+        return checkpoint
+
+    # Mean and maximum depth over the AOI of every date, fetched with one request
+    def depth_stats(img):
+        return img.set('depth_stats', img.select('Depth').reduceRegion(
+            ee.Reducer.mean().combine(ee.Reducer.max(), sharedInputs=True), state['site'].geometry(),
+            state['img_scale'], maxPixels=1e13))
+    dates, stats = _property_series(state['depth_maps'].map(depth_stats), 'depth_stats', None)
+    depths = pd.DataFrame({'Date': dates, 'Mean depth, m': [v.get('Depth_mean') for v in stats],
+                           'Max depth, m': [v.get('Depth_max') for v in stats]})
+    depths.to_csv(os.path.join(job_dir, 'depths.csv'), index=False)
+    return {'file': 'depths.csv', 'images': len(dates), 'max_depth': depths['Max depth, m'].max() if len(depths) else None}
+
+def _volumes(job, state, checkpoint, job_dir):
+    if checkpoint:
+        return checkpoint
+    multiplier, symbol = volume_units[job['volume_unit']]
+    volumes = state['depth_maps'].map(water_volume_function(state['site'], state['img_scale'], multiplier))
+    dates, values = _property_series(volumes, 'volume', 'Depth')
+    pd.DataFrame({'Date': dates, 'Volume, ' + symbol: values}).to_csv(os.path.join(job_dir, 'volumes.csv'), index=False)
+    return {'file': 'volumes.csv', 'images': len(dates)}
+
+# Function of each pipeline stage: builds the stage's Earth Engine objects and fetches its results unless checkpointed
+stage_functions = {'process': _process, 'water': _water, 'areas': _areas, 'depths': _depths, 'volumes': _volumes}
+
+def run_job(job, checkpoint_dir):
+    """Runs the pipeline of one AOI up to its last stage, skipping the fetches of checkpointed stages
+    Args:
+        job (dict): Job parameters (see load_jobs)
+        checkpoint_dir (str): Folder of the checkpoints and results, one subfolder per job
+    Returns:
+        dict: Job report with status, per-stage seconds and resumed flags, and the error if the job failed
+    """
+    job_dir = os.path.join(checkpoint_dir, job['id'])
+    os.makedirs(job_dir, exist_ok=True)
+    config = pipeline_config_hash({k: v for k, v in job.items() if k not in ['id', 'last_stage']})
+    report = {'id': job['id'], 'status': 'completed', 'stages': {}, 'error': None}
+    state = {}
+    start = time.perf_counter()
+    try:
+        for stage in pipeline_stages[:pipeline_stages.index(job['last_stage']) + 1]:
+            stage_start = time.perf_counter()
+            checkpoint = load_checkpoint(job_dir, stage, config)
+            outputs = stage_functions[stage](job, state, checkpoint['outputs'] if checkpoint else None, job_dir)
+            if checkpoint is None:
+                save_checkpoint(job_dir, stage, config, outputs)
+            report['stages'][stage] = {'seconds': time.perf_counter() - stage_start, 'resumed': checkpoint is not None}
+    except Exception as e:
+        report['status'] = 'failed'
+        report['error'] = ''.join(traceback.format_exception_only(type(e), e)).strip()
+    report['seconds'] = time.perf_counter() - start
+    return report
+
+def run_report(reports):
+    """Tabulates job reports: one row per job with status, total and per-stage seconds and resumed stages"""
+    rows = []
+    for report in reports:
+        row = {'id': report['id'], 'status': report['status'], 'seconds': report['seconds']}
+        for stage, result in report['stages'].items():
+            row[stage + '_seconds'] = result['seconds']
+        row['resumed'] = ','.join(s for s, result in report['stages'].items() if result['resumed'])
+        row['error'] = report['error']
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+def _init_worker(project=None):
+    ee.Initialize(project=project)
+
+def run_batch(job_file, checkpoint_dir, workers=4, executor='thread', project=None):
+    """Runs the pipeline for every job of a job file across a thread or process pool.
+    Finished (job, stage) results are checkpointed, so rerunning after a crash only redoes unfinished work.
+    Args:
+        job_file (str): Path of the job file (see load_jobs)
+        checkpoint_dir (str): Folder of the checkpoints, results and run report
+        workers (int, optional): Number of jobs run at once. Defaults to 4.
+        executor (str, optional): 'thread' or 'process'. Defaults to 'thread'.
+        project (str, optional): Google Cloud project to initialize Earth Engine with. Defaults to None.
+    Returns:
+        object: pandas.DataFrame run report, also written to run_report.csv and run_report.json
+    """
+    jobs = load_jobs(job_file)
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    if executor == 'process':
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(project,))
+    else:
+        _init_worker(project)
+        pool = ThreadPoolExecutor(max_workers=workers)
+
+    reports = []
+    with pool:
+        futures = [pool.submit(run_job, job, checkpoint_dir) for job in jobs]
+        for future in as_completed(futures):
+            report = future.result()
+            print(f"{report['id']}: {report['status']} in {report['seconds']:.1f} s"
+                  + (f" ({report['error']})" if report['error'] else ''))
+            reports.append(report)
+
+    with open(os.path.join(checkpoint_dir, 'run_report.json'), 'w') as f:
+        json.dump(reports, f, indent=1)
+    df = run_report(reports)
+    df.to_csv(os.path.join(checkpoint_dir, 'run_report.csv'), index=False)
+    return df
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the surface water pipeline for the AOIs of a job file')
+    parser.add_argument('job_file', help='JSON job file')
+    parser.add_argument('checkpoint_dir', help='Folder of checkpoints, results and the run report')
+    parser.add_argument('--workers', type=int, default=4, help='Number of jobs run at once')
+    parser.add_argument('--executor', choices=['thread', 'process'], default='thread')
+    parser.add_argument('--project', default=None, help='Google Cloud project for Earth Engine')
+    args = parser.parse_args()
+    print(run_batch(args.job_file, args.checkpoint_dir, args.workers, args.executor, args.project))
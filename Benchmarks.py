@@ -0,0 +1,252 @@
+import ee
+import os
+import time
+import numpy as np
+import pandas as pd
+from scipy import ndimage
+import rasterio
+
+from Utilities import *
+from LocalProcessing import *
+from RequestGovernor import get_info
+
+def fragmented_water_masks(site, n_images, water_fraction=0.4, img_scale=30, seed=0):
+    """Builds a collection of synthetic, highly fragmented water masks over a site
+    Args:
+        site (object): ee.Geometry of the study area
+        n_images (int): Number of masks to generate
+        water_fraction (float, optional): Approximate fraction of water pixels. Defaults to 0.4.
+        img_scale (float, optional): Pixel size of the masks in meters. Defaults to 30.
+        seed (int, optional): Seed for the random noise. Defaults to 0.
+    Returns:
+        object: ee.ImageCollection with 'water' and 'waterMask' bands
+    """
+    proj = ee.Projection('EPSG:4326').atScale(img_scale)
+    masks = []
+    for i in range(n_images):
+        water = ee.Image.random(seed + i).lt(water_fraction).reproject(proj).clip(site).rename('water')
+        masks.append(water.addBands(water.selfMask().rename('waterMask'))
+                     .set('system:time_start', ee.Date('2000-01-01').advance(i, 'day').millis()))
+    return ee.ImageCollection(masks)
+
+def time_images(collection, band, site, img_scale):
+    """Times the evaluation of a band for every image of a collection
+    Args:
+        collection (object): ee.ImageCollection to evaluate
+        band (str): Band to reduce
+        site (object): ee.Geometry to reduce over
+        img_scale (float): A nominal scale in meters of the projection to work in.
+    Returns:
+        list: Seconds spent on each image
+    """
+    count = get_info(collection.size())
+    images = collection.toList(count)
+    timings = []
+    for i in range(count):
+        img = ee.Image(images.get(i)).select(band)
+        start = time.perf_counter()
+        get_info(img.reduceRegion(**{
+            'reducer': ee.Reducer.mean(),
+            'geometry': site,
+            'scale': img_scale,
+            'maxPixels': 1e13
+            }))
+        timings.append(time.perf_counter() - start)
+    return timings
+
+def benchmark_depth_estimators(dem, site, img_scale, water_masks=None, n_images=5):
+    """Compares the time per image of the vector and raster DEM depth estimators
+    Args:
+        dem (object): Elevation data
+        site (object): ee.Geometry of the study area
+        img_scale (float): A nominal scale in meters of the projection to work in.
+        water_masks (object, optional): Water masks to use; fragmented synthetic masks are generated if None.
+        n_images (int, optional): Number of synthetic masks. Defaults to 5.
+    Returns:
+        object: pandas.DataFrame with the seconds per image of each estimator and their mean depths
+    """
+    if water_masks is None:
+        water_masks = fragmented_water_masks(site, n_images, img_scale=img_scale)
+
+    estimators = {'reduceToVectors': estimateDepths_FromDEM(dem, site, img_scale),
+                  'raster': estimateDepths_FromDEM_Raster(dem, site, img_scale)}
+    results = {}
+    for name, estimator in estimators.items():
+        results[name] = time_images(water_masks.map(estimator), 'Depth', site, img_scale)
+
+    df = pd.DataFrame(results)
+    df.index.name = 'image'
+    print(df.describe().loc[['mean', 'min', 'max']])
+    return df
+
+def synthetic_water_dem(size, water_fraction=0.3, seed=0):
+    """Builds a synthetic water mask and DEM for local benchmarks
+    Args:
+        size (int): Width and height of the arrays in pixels
+        water_fraction (float, optional): Approximate fraction of water pixels. Defaults to 0.3.
+        seed (int, optional): Seed for the random noise. Defaults to 0.
+    Returns:
+        tuple: (water mask, DEM) numpy arrays
+    """
+    rng = np.random.default_rng(seed)
+    dem = ndimage.gaussian_filter(rng.random((size, size), dtype=np.float32), 8) * 1000
+    water = dem < np.quantile(dem, water_fraction)
+    return water.astype(np.uint8), dem
+
+def benchmark_local_fwdet(sizes=(512, 1024, 2048, 4096), water_file=None, dem_file=None, out_file=None, **kwargs):
+    """Measures the throughput of the local FwDET engine in megapixels per second
+    Args:
+        sizes (tuple, optional): Sizes of the synthetic arrays for the in-memory engine.
+        water_file (str, optional): GeoTIFF water mask for the tiled engine.
+        dem_file (str, optional): GeoTIFF elevation data for the tiled engine.
+        out_file (str, optional): Output GeoTIFF for the tiled engine.
+        **kwargs: Additional arguments for fwdet_depth_tiled
+    Returns:
+        object: pandas.DataFrame with megapixels and megapixels per second of each run
+    """
+    rows = []
+    for size in sizes:
+        water, dem = synthetic_water_dem(size)
+        start = time.perf_counter()
+        fwdet_depth(water, dem)
+        elapsed = time.perf_counter() - start
+        rows.append({'engine': 'in-memory', 'megapixels': size * size / 1e6,
+                     'seconds': elapsed, 'MP/s': size * size / 1e6 / elapsed})
+
+    if water_file is not None:
+        with rasterio.open(water_file) as src:
+            megapixels = src.width * src.height / 1e6
+        start = time.perf_counter()
+        fwdet_depth_tiled(water_file, dem_file, out_file, **kwargs)
+        elapsed = time.perf_counter() - start
+        rows.append({'engine': 'tiled', 'megapixels': megapixels,
+                     'seconds': elapsed, 'MP/s': megapixels / elapsed})
+
+    df = pd.DataFrame(rows)
+    print(df)
+    return df
+
+def benchmark_band_pruning(images, imageType, water_index, site, img_scale, n_images=5):
+    """Measures server time and download bytes of full images against images pruned to the required bands
+    Args:
+        images (object): ee.ImageCollection as retrieved by the toolbox (e.g. clipped_images)
+        imageType (str): Satellite platform
+        water_index (str): Water index
+        site (object): ee.Geometry of the study area
+        img_scale (float): A nominal scale in meters of the projection to work in.
+        n_images (int, optional): Number of images to time. Defaults to 5.
+    Returns:
+        object: pandas.DataFrame with bands, mean seconds per image and estimated bytes per image
+    """
+    stage_bands = band_requirements(imageType, water_index)
+    variants = {'full': images, 'pruned': images.select(stage_bands['input'])}
+    rows = []
+    for name, collection in variants.items():
+        collection = collection.limit(n_images)
+        first = collection.first()
+        timings = time_images(collection.map(lambda img: img.reduce(ee.Reducer.mean()).rename('mean')),
+                              'mean', site, img_scale)
+        rows.append({'variant': name,
+                     'bands': len(get_info(first.bandNames())),
+                     'seconds_per_image': sum(timings) / len(timings),
+                     'bytes_per_image': estimate_image_bytes(first, site, img_scale)})
+    df = pd.DataFrame(rows)
+    print(df)
+    return df
+
+def benchmark_hydroperiod(n_dates=(16, 64, 256, 1024), size=256, water_images=None, site=None, img_scale=30):
+    """Measures how the local and server-side hydroperiod computations scale with the number of dates
+    Args:
+        n_dates (tuple, optional): Numbers of dates to time.
+        size (int, optional): Width and height of the synthetic local stacks in pixels. Defaults to 256.
+        water_images (object, optional): ee.ImageCollection with a 'water' band for the server-side timings.
+        site (object, optional): ee.Geometry to reduce over for the server-side timings.
+        img_scale (float, optional): A nominal scale in meters of the projection to work in. Defaults to 30.
+    Returns:
+        object: pandas.DataFrame with the seconds per run of each engine and number of dates
+    """
+    rng = np.random.default_rng(0)
+    rows = []
+    for n in n_dates:
+        water = (rng.random((n, size, size)) < 0.5).astype(np.float32)
+        water[rng.random(water.shape) < 0.1] = np.nan
+        dates = np.datetime64('2000-01-01') + np.sort(rng.choice(n * 8, n, replace=False))
+        start = time.perf_counter()
+        hydroperiod_local(water, dates)
+        rows.append({'engine': 'local', 'dates': n, 'seconds': time.perf_counter() - start})
+
+        if water_images is not None:
+            metrics = hydroperiod(water_images.limit(n, 'system:time_start'))
+            start = time.perf_counter()
+            get_info(metrics.reduceRegion(**{
+                'reducer': ee.Reducer.mean(),
+                'geometry': site,
+                'scale': img_scale,
+                'maxPixels': 1e13
+                }))
+            rows.append({'engine': 'server', 'dates': n, 'seconds': time.perf_counter() - start})
+
+    df = pd.DataFrame(rows)
+    print(df)
+    return df
+
+def benchmark_export_profile(img, product, imageType, region, scale, out_dir):
+    """Compares download time and file size of an image with and without its export profile
+    Args:
+        img (object): ee.Image as produced by the toolbox
+        product (str): 'Satellite', 'Water', 'Frequency', 'Depth', 'DSWE' or 'Hydroperiod'
+        imageType (str): Satellite platform
+        region (object): ee.FeatureCollection of the download region
+        scale (float): Download scale in meters
+        out_dir (str): Folder for the downloaded files
+    Returns:
+        object: pandas.DataFrame with seconds, file bytes and estimated bytes of each variant
+    """
+    profile = export_profile(product, imageType)
+    estimate = export_profile_report(img, profile, region.geometry(), scale)
+    rows = []
+    for name, variant_profile, estimated in [('default', None, estimate['original_bytes']),
+                                             ('profile', profile, estimate['profiled_bytes'])]:
+        filename = os.path.join(out_dir, f'{product}_{name}.tif')
+        start = time.perf_counter()
+        local_download(img, filename, region, scale, profile=variant_profile)
+        rows.append({'variant': name, 'seconds': time.perf_counter() - start,
+                     'file_bytes': os.path.getsize(filename), 'estimated_bytes': estimated})
+    df = pd.DataFrame(rows)
+    print(df)
+    return df
+
+def benchmark_deferred_clipping(images, band, site, img_scale, n_images=20, threshold=0):
+    """Compares the latency of an area time series with per-image clipping against reducing over the study area only
+    Args:
+        images (object): Unclipped ee.ImageCollection (e.g. filtered_Collection)
+        band (str): Band thresholded into a water mask (e.g. an index band or 'VV')
+        site (object): ee.FeatureCollection of the study area
+        img_scale (float): A nominal scale in meters of the projection to work in.
+        n_images (int, optional): Length of the time series. Defaults to 20.
+        threshold (float, optional): Value above which a pixel counts as water. Defaults to 0.
+    Returns:
+        object: pandas.DataFrame with seconds per series and the largest area difference between the modes
+    """
+    def area(img):
+        water_area = img.select(band).gt(threshold).multiply(ee.Image.pixelArea()).reduceRegion(**{
+            'reducer': ee.Reducer.sum(),
+            'geometry': site.geometry(),
+            'scale': img_scale,
+            'maxPixels': 1e13
+            }).values().get(0)
+        return img.set({'water_area': water_area})
+
+    images = images.limit(n_images)
+    variants = {'clipped': images.map(lambda img: img.clip(site)), 'deferred': images}
+    rows = []
+    series = {}
+    for name, collection in variants.items():
+        start = time.perf_counter()
+        series[name] = get_info(collection.map(area).aggregate_array('water_area'))
+        rows.append({'mode': name, 'images': len(series[name]), 'seconds': time.perf_counter() - start})
+
+    df = pd.DataFrame(rows)
+    df['max_area_difference'] = max([abs(a - b) for a, b in zip(series['clipped'], series['deferred'])], default=0)
+    print(df)
+    return df
@@ -0,0 +1,258 @@
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+
+import ee
+from geetools.utils import makeName
+
+from Utilities import ee_cast_methods
+from RequestGovernor import governor, get_info
+
+# Default folder of export manifests
+export_manifest_dir = os.path.join(os.path.expanduser('~'), '.pygee_swtoolbox', 'exports')
+
+# Task states after which a task is no longer polled
+terminal_states = ['COMPLETED', 'FAILED', 'CANCELLED']
+
+def drive_export_jobs(collection, folder, region, scale, name_pattern, date_pattern, extra, dtype='float32',
+                      formatOptions=None, maxPixels=int(1e13)):
+    """Builds one Google Drive export job per image of a collection, named as geetools names them
+    Args:
+        collection (object): ee.ImageCollection to export
+        folder (str): Google Drive folder
+        region (object): ee.Geometry of the export region
+        scale (float): Export scale in meters
+        name_pattern (str): The file naming pattern
+        date_pattern (str): The date pattern
+        extra (dict): A dictionary of additional file naming parameters; satellite platform and type of image collection
+        dtype (str, optional): Data type of the exported images (a key of ee_cast_methods). Defaults to 'float32'.
+        formatOptions (dict, optional): GeoTIFF format options, e.g. {'noData': 0}. Defaults to None.
+        maxPixels (int, optional): Maximum number of pixels per image. Defaults to 1e13.
+    Returns:
+        dict: Task factories (functions returning an unstarted ee.batch.Task) keyed by file name, in collection order.
+            Each factory has a 'params' attribute hashing the export parameters and the image expressions.
+    """
+    # Exports of the same file name with other images or settings must not be taken for completed ones
+    params = hashlib.md5(json.dumps([collection.serialize(), folder, region.serialize(), scale, dtype,
+                                     formatOptions, maxPixels], sort_keys=True, default=str).encode()).hexdigest()
+    named = collection.map(lambda img: img.set('export_name', makeName(img, name_pattern, date_pattern, extra)))
+    rows = get_info(named.reduceColumns(ee.Reducer.toList(2), ['system:index', 'export_name']).get('list'))
+
+    def task_factory(index, name):
+        def make_task():
+            img = ee.Image(collection.filter(ee.Filter.eq('system:index', index)).first())
+            task_params = {'image': getattr(img, ee_cast_methods[dtype])(),
+                      'description': name[:100],
+                      'folder': folder,
+                      'fileNamePrefix': name,
+                      'region': region,
+                      'scale': scale,
+                      'maxPixels': maxPixels}
+            if formatOptions is not None:
+                task_params['formatOptions'] = formatOptions
+            return ee.batch.Export.image.toDrive(**task_params)
+        make_task.params = params
+        return make_task
+
+    return {name: task_factory(index, name) for index, name in rows}
+
+class EarthEngineTaskAPI:
+    """Starts and polls Earth Engine batch tasks for ExportScheduler"""
+
+    def start(self, name, make_task):
+        task = make_task()
+        governor.call('startTask', task.start)
+        return task.id
+
+    def status(self, task_ids):
+        return {s['id']: s for s in governor.call('getTaskStatus', ee.data.getTaskStatus, task_ids)}
+
+class LocalTaskAPI:
+    """Local stand-in for the Earth Engine task API, for exercising ExportScheduler offline.
+    Tasks run for a fixed time and fail a given number of times before they complete.
+    Args:
+        duration (float, optional): Seconds each task runs. Defaults to 0.
+        failures (dict, optional): Number of failed attempts of each job name before it completes.
+        clock (function, optional): Time source. Defaults to time.monotonic.
+    """
+
+    def __init__(self, duration=0.0, failures=None, clock=time.monotonic):
+        self.duration = duration
+        self.failures = dict(failures or {})
+        self.clock = clock
+        self.tasks = {}
+        self.peak_running = 0
+
+    def start(self, name, make_task):
+        task_id = f'LOCAL_{len(self.tasks) + 1}'
+        fails = self.failures.get(name, 0) > 0
+        if fails:
+            self.failures[name] -= 1
+        self.tasks[task_id] = {'name': name, 'started': self.clock(), 'fails': fails}
+        return task_id
+
+    def status(self, task_ids):
+        statuses = {}
+        running = 0
+        for task_id, task in self.tasks.items():
+            if self.clock() - task['started'] < self.duration:
+                state = 'RUNNING'
+                running += 1
+            else:
+                state = 'FAILED' if task['fails'] else 'COMPLETED'
+            if task_id in task_ids:
+                statuses[task_id] = {'id': task_id, 'state': state,
+                                     'error_message': 'Simulated failure' if state == 'FAILED' else None}
+        self.peak_running = max(self.peak_running, running)
+        return statuses
+
+class ExportScheduler:
+    """Runs export jobs with a cap on concurrent tasks, polls them with backoff and retries failed tasks.
+    The state of every job is kept in a JSON manifest, so running the same jobs again after a restart
+    skips completed jobs, resumes monitoring of started tasks and only submits the rest.
+    Args:
+        manifest (str): Path of the JSON manifest
+        max_concurrent (int, optional): Maximum number of tasks submitted and not finished. Defaults to 4.
+        max_retries (int, optional): Number of times a failed task is resubmitted. Defaults to 2.
+        poll_interval (float, optional): Initial seconds between status polls. Defaults to 10.
+        max_poll_interval (float, optional): Longest seconds between status polls. Defaults to 120.
+        backoff (float, optional): Growth of the poll interval while no task changes state. Defaults to 1.5.
+        task_api (object, optional): Task API; EarthEngineTaskAPI if None, LocalTaskAPI for offline runs.
+        sleep (function, optional): Sleep function. Defaults to time.sleep.
+    """
+
+    def __init__(self, manifest, max_concurrent=4, max_retries=2, poll_interval=10, max_poll_interval=120,
+                 backoff=1.5, task_api=None, sleep=time.sleep):
+        self.manifest = manifest
+        self.max_concurrent = max_concurrent
+        self.max_retries = max_retries
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.backoff = backoff
+        self.task_api = task_api or EarthEngineTaskAPI()
+        self.sleep = sleep
+
+    def load(self):
+        """Reads the manifest; returns a dictionary of job states keyed by job name"""
+        if os.path.exists(self.manifest):
+            with open(self.manifest) as f:
+                return json.load(f)
+        return {}
+
+    def save(self, states):
+        """Writes the manifest through a temporary file so a restart never reads a partial manifest"""
+        folder = os.path.dirname(os.path.abspath(self.manifest))
+        os.makedirs(folder, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=folder, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(states, f, indent=1)
+        os.replace(tmp, self.manifest)
+
+    @staticmethod
+    def summary(states):
+        """Counts the jobs in each state"""
+        counts = {}
+        for entry in states.values():
+            counts[entry['state']] = counts.get(entry['state'], 0) + 1
+        return counts
+
+    def _submit(self, name, make_task, entry, queue):
+        entry['attempts'] += 1
+        try:
+            entry['task_id'] = self.task_api.start(name, make_task)
+            entry['state'] = 'READY'
+            return True
+        except Exception as e:
+            entry['error'] = str(e)
+            entry['state'] = 'PENDING' if entry['attempts'] <= self.max_retries else 'FAILED'
+            if entry['state'] == 'PENDING':
+                queue.append(name)
+            return False
+
+    def run(self, jobs, on_update=None):
+        """Submits and monitors jobs until every job completed or ran out of retries
+        Args:
+            jobs (dict): Task factories keyed by job name (see drive_export_jobs)
+            on_update (function, optional): Called with the state counts whenever a job changes state.
+        Returns:
+            dict: Number of jobs in each state
+        """
+        states = self.load()
+        for name, make_task in jobs.items():
+            params = getattr(make_task, 'params', None)
+            if name not in states or states[name].get('params') != params:
+                # New job, or the same file exported with other parameters
+                states[name] = {'state': 'PENDING', 'task_id': None, 'attempts': 0, 'error': None, 'params': params}
+
+        queue = []
+        active = []
+        for name in jobs:
+            entry = states[name]
+            if entry['state'] == 'COMPLETED':
+                continue
+            if entry['task_id'] is not None and entry['state'] not in terminal_states + ['PENDING']:
+                active.append(name) # started before a restart, resume monitoring
+            elif entry['state'] == 'PENDING' or entry['attempts'] <= self.max_retries:
+                entry['state'] = 'PENDING'
+                queue.append(name)
+        self.save(states)
+
+        interval = self.poll_interval
+        while queue or active:
+            changed = False
+            while queue and len(active) < self.max_concurrent:
+                name = queue.pop(0)
+                if self._submit(name, jobs[name], states[name], queue):
+                    active.append(name)
+                changed = True
+            self.save(states)
+
+            self.sleep(interval)
+            if active:
+                statuses = self.task_api.status([states[name]['task_id'] for name in active])
+                for name in list(active):
+                    entry = states[name]
+                    status = statuses.get(entry['task_id'], {})
+                    state = status.get('state', entry['state'])
+                    if state == entry['state']:
+                        continue
+                    changed = True
+                    entry['state'] = state
+                    if state in terminal_states:
+                        active.remove(name)
+                    if state in ['FAILED', 'CANCELLED']:
+                        entry['error'] = status.get('error_message')
+                    if state == 'FAILED' and entry['attempts'] <= self.max_retries:
+                        entry['state'] = 'PENDING'
+                        queue.append(name)
+                self.save(states)
+
+            if changed and on_update is not None:
+                on_update(self.summary({name: states[name] for name in jobs}))
+            interval = self.poll_interval if changed else min(interval * self.backoff, self.max_poll_interval)
+
+        return self.summary({name: states[name] for name in jobs})
+
+    def start(self, jobs, on_update=None, on_error=None):
+        """Runs jobs (see run) in a background thread
+        Args:
+            jobs (dict): Task factories keyed by job name (see drive_export_jobs)
+            on_update (function, optional): Called with the state counts whenever a job changes state.
+            on_error (function, optional): Called with the exception if the run stops on an error; printed if None.
+        Returns:
+            object: threading.Thread of the run
+        """
+        def target():
+            try:
+                self.run(jobs, on_update)
+            except Exception as e:
+                if on_error is None:
+                    print(f'Export scheduling stopped: {e}')
+                else:
+                    on_error(e)
+        thread = threading.Thread(target=target, daemon=True)
+        thread.start()
+        return thread
@@ -0,0 +1,405 @@
+import os
+import re
+import json
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy import ndimage
+import rasterio
+from rasterio.windows import Window
+
+def water_edges(water):
+    """Finds the water pixels that touch a non-water pixel (4-connected)
+    Args:
+        water (numpy.ndarray): Boolean water mask
+    Returns:
+        numpy.ndarray: Boolean mask of the water boundary pixels
+    """
+    interior = ndimage.binary_erosion(water, structure=ndimage.generate_binary_structure(2, 1), border_value=1)
+    return water & ~interior
+
+def fwdet_depth(water, dem, smooth_size=3, nodata=np.nan):
+    """Estimates water depth with the FwDET algorithm (Peter et al 2020) on local arrays.
+    Every water pixel takes the elevation of its nearest water boundary pixel, found with a
+    Euclidean distance transform, and the boundary elevations are smoothed with a focal mean.
+    Args:
+        water (numpy.ndarray): Water mask (non-zero is water)
+        dem (numpy.ndarray): Elevation data on the same grid as the water mask
+        smooth_size (int, optional): Size of the focal mean window in pixels. Defaults to 3.
+        nodata (float, optional): Value written to non-water pixels. Defaults to NaN.
+    Returns:
+        numpy.ndarray: float32 depths
+    """
+    water = np.asarray(water) > 0
+    dem = np.asarray(dem, dtype=np.float32)
+    depth = np.full(water.shape, nodata, dtype=np.float32)
+
+    edges = water_edges(water)
+    if not edges.any():
+        return depth
+
+    # Indices of the nearest boundary pixel for every pixel
+    _, (rows, cols) = ndimage.distance_transform_edt(~edges, return_indices=True)
+    boundary_elev = dem[rows, cols]
+    if smooth_size > 1:
+        boundary_elev = ndimage.uniform_filter(boundary_elev, size=smooth_size, mode='nearest')
+
+    depths = boundary_elev - dem
+    depths[depths < 0] = 0
+    depth[water] = depths[water]
+    return depth
+
+def tile_windows(height, width, tile_size, overlap):
+    """Splits a raster into tiles with an overlapping halo
+    Args:
+        height (int): Raster height in pixels
+        width (int): Raster width in pixels
+        tile_size (int): Size of the tile core in pixels
+        overlap (int): Width of the halo around each core in pixels
+    Returns:
+        list: (read window, core window, core offset in the read window) tuples
+    """
+    windows = []
+    for row in range(0, height, tile_size):
+        for col in range(0, width, tile_size):
+            core = Window(col, row, min(tile_size, width - col), min(tile_size, height - row))
+            row0 = max(row - overlap, 0)
+            col0 = max(col - overlap, 0)
+            row1 = min(row + core.height + overlap, height)
+            col1 = min(col + core.width + overlap, width)
+            read = Window(col0, row0, col1 - col0, row1 - row0)
+            windows.append((read, core, (row - row0, col - col0)))
+    return windows
+
+def _fwdet_tile(water_file, dem_file, read, core, offset, smooth_size):
+    """Computes FwDET depths for one tile; runs in a worker process"""
+    with rasterio.open(water_file) as src:
+        water = src.read(1, window=read, masked=True).filled(0)
+    with rasterio.open(dem_file) as src:
+        dem = src.read(1, window=read, masked=True).astype(np.float32).filled(np.nan)
+    depth = fwdet_depth(water, dem, smooth_size)
+    r, c = offset
+    return core, depth[r:r + core.height, c:c + core.width]
+
+def fwdet_depth_tiled(water_file, dem_file, out_file, tile_size=1024, overlap=256, smooth_size=3, workers=None):
+    """Estimates FwDET water depths for GeoTIFFs larger than memory.
+    The rasters are processed in overlapping tiles across a process pool, and each tile core is written
+    to the output as soon as it is done. Boundary pixels further than the overlap from a tile core are
+    not seen by that tile, so the overlap should exceed the largest distance from a water pixel to the shore.
+    Args:
+        water_file (str): GeoTIFF water mask (e.g. a downloaded 'Water Mask')
+        dem_file (str): GeoTIFF elevation data on the same grid as the water mask
+        out_file (str): Output GeoTIFF of depths
+        tile_size (int, optional): Size of the tile cores in pixels. Defaults to 1024.
+        overlap (int, optional): Width of the halo read around each tile in pixels. Defaults to 256.
+        smooth_size (int, optional): Size of the focal mean window in pixels. Defaults to 3.
+        workers (int, optional): Number of worker processes. Defaults to the number of cores.
+    Returns:
+        str: The output filename
+    """
+    with rasterio.open(water_file) as water_src, rasterio.open(dem_file) as dem_src:
+        if water_src.shape != dem_src.shape or water_src.transform != dem_src.transform:
+            raise ValueError('The water mask and the DEM must be on the same grid.')
+        profile = water_src.profile.copy()
+        height, width = water_src.shape
+
+    profile.update(count=1, dtype='float32', nodata=np.nan, tiled=True, blockxsize=256, blockysize=256,
+                   compress='deflate', BIGTIFF='IF_SAFER')
+
+    workers = workers or os.cpu_count()
+    windows = tile_windows(height, width, tile_size, overlap)
+    with rasterio.open(out_file, 'w', **profile) as dst, ProcessPoolExecutor(max_workers=workers) as pool:
+        # Keep at most two tiles per worker in flight so memory stays bounded
+        pending = []
+        for read, core, offset in windows:
+            pending.append(pool.submit(_fwdet_tile, water_file, dem_file, read, core, offset, smooth_size))
+            if len(pending) >= 2 * workers:
+                core_window, depth = pending.pop(0).result()
+                dst.write(depth, 1, window=core_window)
+        for future in pending:
+            core_window, depth = future.result()
+            dst.write(depth, 1, window=core_window)
+    return out_file
+
+def mask_file_dates(mask_files):
+    """Reads the acquisition dates from the names of downloaded files (e.g. 'Landsat_2020-05-01_Water.tif')
+    Args:
+        mask_files (list): GeoTIFF filenames
+    Returns:
+        list: datetime of each file
+    """
+    dates = []
+    for filename in mask_files:
+        match = re.search(r'\d{4}-\d{2}-\d{2}', os.path.basename(filename))
+        if match is None:
+            raise ValueError(f'No YYYY-MM-dd date in file name: {filename}')
+        dates.append(datetime.strptime(match.group(0), '%Y-%m-%d'))
+    return dates
+
+def select_period(mask_files, start=None, end=None):
+    """Selects the files acquired within a period
+    Args:
+        mask_files (list): GeoTIFF filenames with dates in their names
+        start (datetime, optional): First date of the period (inclusive). Defaults to None.
+        end (datetime, optional): Last date of the period (exclusive). Defaults to None.
+    Returns:
+        list: Selected filenames sorted by date
+    """
+    dated = sorted(zip(mask_file_dates(mask_files), mask_files))
+    return [f for d, f in dated if (start is None or d >= start) and (end is None or d < end)]
+
+def water_frequency_local(mask_files, out_file, start=None, end=None, tile_size=1024, denominator='valid'):
+    """Computes the water occurrence frequency of a stack of downloaded water masks.
+    Each mask is read once through windowed reads and per-pixel water and valid-observation counts
+    are accumulated in uint16 arrays, so memory holds one tile plus the two accumulators regardless
+    of the number of dates. The frequency raster is written tile by tile.
+    Masks downloaded as 'Water Mask' are self-masked (non-water pixels are nodata); use
+    denominator='dates' for those to divide by the number of dates as Toolbox.water_frequency does.
+    Args:
+        mask_files (list): GeoTIFF water masks on the same grid (non-zero is water, nodata is not observed)
+        out_file (str): Output GeoTIFF of water frequency in percent
+        start (datetime, optional): First date of the period (inclusive). Defaults to None.
+        end (datetime, optional): Last date of the period (exclusive). Defaults to None.
+        tile_size (int, optional): Size of the read and write windows in pixels. Defaults to 1024.
+        denominator (str, optional): 'valid' to divide by valid observations or 'dates' to divide by the number of dates.
+    Returns:
+        str: The output filename
+    """
+    mask_files = select_period(mask_files, start, end)
+    if not mask_files:
+        raise ValueError('No water masks in the selected period.')
+    if len(mask_files) > np.iinfo(np.uint16).max:
+        raise ValueError('Too many water masks for uint16 counts.')
+
+    with rasterio.open(mask_files[0]) as src:
+        profile = src.profile.copy()
+        height, width = src.shape
+        transform = src.transform
+
+    water_count = np.zeros((height, width), dtype=np.uint16)
+    valid_count = np.zeros((height, width), dtype=np.uint16)
+    windows = [core for _, core, _ in tile_windows(height, width, tile_size, 0)]
+
+    for filename in mask_files:
+        with rasterio.open(filename) as src:
+            if src.shape != (height, width) or src.transform != transform:
+                raise ValueError(f'{filename} is not on the same grid as the other water masks.')
+            for window in windows:
+                data = src.read(1, window=window, masked=True)
+                rows = slice(window.row_off, window.row_off + window.height)
+                cols = slice(window.col_off, window.col_off + window.width)
+                valid = ~np.ma.getmaskarray(data)
+                valid_count[rows, cols] += valid
+                water_count[rows, cols] += valid & (data.filled(0) > 0)
+
+    profile.update(count=1, dtype='float32', nodata=np.nan, tiled=True, blockxsize=256, blockysize=256,
+                   compress='deflate', BIGTIFF='IF_SAFER')
+    with rasterio.open(out_file, 'w', **profile) as dst:
+        for window in windows:
+            rows = slice(window.row_off, window.row_off + window.height)
+            cols = slice(window.col_off, window.col_off + window.width)
+            water = water_count[rows, cols].astype(np.float32)
+            if denominator == 'dates':
+                total = np.float32(len(mask_files))
+                frequency = np.where(water > 0, water / total * 100, np.nan)
+            else:
+                total = valid_count[rows, cols].astype(np.float32)
+                frequency = np.full(water.shape, np.nan, dtype=np.float32)
+                np.divide(water * 100, total, out=frequency, where=total > 0)
+            dst.write(frequency.astype(np.float32), 1, window=window)
+    return out_file
+
+def hydroperiod_local(water, dates):
+    """Computes per-pixel hydroperiod metrics of a local water mask stack without looping over dates.
+    Uses the same definitions as Utilities.hydroperiod: every observation lasts until the next valid
+    observation of the pixel (one day for the last one) and unobserved dates are skipped.
+    Args:
+        water (numpy.ndarray): T x H x W stack, 1 water, 0 dry; masked or NaN where not observed
+        dates (list): datetime (or numpy datetime64) of each of the T masks, in ascending order
+    Returns:
+        dict: H x W float32 arrays 'inundated_days', 'longest_wet_run' (days), 'first_wet' and 'last_wet'
+              (days since 1970-01-01, NaN where never wet)
+    """
+    water = np.ma.masked_invalid(np.ma.asarray(water, dtype=np.float32))
+    valid = ~np.ma.getmaskarray(water)
+    wet = valid & (water.filled(0) > 0)
+    t = (np.asarray(dates, dtype='datetime64[D]').astype(np.int64)).astype(np.float64)[:, None, None]
+
+    # Date of the next valid observation of every pixel (reverse running minimum)
+    tv = np.where(valid, t, np.inf)
+    following = np.minimum.accumulate(tv[::-1], axis=0)[::-1]
+    next_t = np.concatenate([following[1:], np.full((1,) + tv.shape[1:], np.inf)], axis=0)
+    duration = np.where(np.isinf(next_t), 1, next_t - t)
+    wet_days = np.where(wet, duration, 0)
+
+    cum = np.cumsum(wet_days, axis=0)
+    reset = np.maximum.accumulate(np.where(valid & ~wet, cum, 0), axis=0)
+    runs = cum - reset
+
+    ever_wet = wet.any(axis=0)
+    first = np.where(wet, t, np.inf).min(axis=0)
+    last = np.where(wet, t, -np.inf).max(axis=0)
+    return {'inundated_days': wet_days.sum(axis=0).astype(np.float32),
+            'longest_wet_run': runs.max(axis=0).astype(np.float32),
+            'first_wet': np.where(ever_wet, first, np.nan).astype(np.float32),
+            'last_wet': np.where(ever_wet, last, np.nan).astype(np.float32)}
+
+# Number of set bits of every byte value, for numpy versions without np.bitwise_count
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+def popcount(words):
+    """Counts the set bits of every element of a uint8 array"""
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words)
+    return _POPCOUNT[words]
+
+def write_water_cube(path, water, valid, dates, transform=None, crs=None, tile_size=256):
+    """Writes a T x H x W water mask stack as a bit-packed time cube.
+    Water and validity bits are packed along time with np.packbits (8 dates per byte) and stored
+    tile by tile, so a spatial tile of the whole series is one contiguous block of water.npy/valid.npy.
+    Args:
+        path (str): Output folder of the cube
+        water (numpy.ndarray): T x H x W boolean water masks
+        valid (numpy.ndarray): T x H x W boolean masks of observed pixels
+        dates (list): datetime of each of the T masks, in ascending order
+        transform (affine.Affine, optional): Geotransform of the masks. Defaults to None.
+        crs (str, optional): Coordinate reference system of the masks. Defaults to None.
+        tile_size (int, optional): Size of the tiles in pixels. Defaults to 256.
+    Returns:
+        str: The cube folder
+    """
+    cube = create_water_cube(path, water.shape, dates, transform, crs, tile_size)
+    for ty, tx, rows, cols in cube_tiles(cube):
+        cube['water'][ty, tx] = pack_tile(water[:, rows, cols], tile_size)
+        cube['valid'][ty, tx] = pack_tile(valid[:, rows, cols], tile_size)
+    return path
+
+def create_water_cube(path, shape, dates, transform=None, crs=None, tile_size=256):
+    """Creates an empty bit-packed time cube on disk and opens it for writing"""
+    os.makedirs(path, exist_ok=True)
+    n_dates, height, width = shape
+    grid = (-(-height // tile_size), -(-width // tile_size), -(-n_dates // 8), tile_size, tile_size)
+    meta = {'shape': [n_dates, height, width],
+            'tile_size': tile_size,
+            'dates': [d.strftime('%Y-%m-%d') for d in dates],
+            'transform': list(transform)[:6] if transform is not None else None,
+            'crs': str(crs) if crs is not None else None}
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    water = np.lib.format.open_memmap(os.path.join(path, 'water.npy'), mode='w+', dtype=np.uint8, shape=grid)
+    valid = np.lib.format.open_memmap(os.path.join(path, 'valid.npy'), mode='w+', dtype=np.uint8, shape=grid)
+    return {'meta': meta, 'water': water, 'valid': valid}
+
+def pack_tile(stack, tile_size):
+    """Packs a T x h x w boolean tile along time, padded to tile_size x tile_size"""
+    padded = np.zeros((stack.shape[0], tile_size, tile_size), dtype=bool)
+    padded[:, :stack.shape[1], :stack.shape[2]] = stack
+    return np.packbits(padded, axis=0)
+
+def read_water_cube(path):
+    """Opens a bit-packed time cube read-only with memory mapping
+    Args:
+        path (str): Cube folder
+    Returns:
+        dict: 'meta' dictionary and memory-mapped packed 'water' and 'valid' arrays
+    """
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    return {'meta': meta,
+            'water': np.load(os.path.join(path, 'water.npy'), mmap_mode='r'),
+            'valid': np.load(os.path.join(path, 'valid.npy'), mmap_mode='r')}
+
+def cube_tiles(cube):
+    """Yields (tile row, tile column, row slice, column slice) of every tile of a cube"""
+    _, height, width = cube['meta']['shape']
+    tile_size = cube['meta']['tile_size']
+    for ty in range(cube['water'].shape[0]):
+        for tx in range(cube['water'].shape[1]):
+            rows = slice(ty * tile_size, min((ty + 1) * tile_size, height))
+            cols = slice(tx * tile_size, min((tx + 1) * tile_size, width))
+            yield ty, tx, rows, cols
+
+def water_cube_from_files(mask_files, path, tile_size=256, nodata=255):
+    """Builds a bit-packed time cube from downloaded single-date water GeoTIFFs.
+    Each tile is read from every file and packed before moving on, so memory holds one tile of the series.
+    Args:
+        mask_files (list): GeoTIFFs of the 'water' band on the same grid, with dates in their names
+        path (str): Output folder of the cube
+        tile_size (int, optional): Size of the tiles in pixels. Defaults to 256.
+        nodata (int, optional): Value of pixels that were not observed. Defaults to 255.
+    Returns:
+        str: The cube folder
+    """
+    mask_files = select_period(mask_files)
+    dates = mask_file_dates(mask_files)
+    with rasterio.open(mask_files[0]) as src:
+        height, width = src.shape
+        transform, crs = src.transform, src.crs
+
+    cube = create_water_cube(path, (len(mask_files), height, width), dates, transform, crs, tile_size)
+    sources = [rasterio.open(f) for f in mask_files]
+    try:
+        for ty, tx, rows, cols in cube_tiles(cube):
+            window = Window(cols.start, rows.start, cols.stop - cols.start, rows.stop - rows.start)
+            stack = np.stack([src.read(1, window=window) for src in sources])
+            valid = stack != nodata
+            cube['water'][ty, tx] = pack_tile(valid & (stack > 0), tile_size)
+            cube['valid'][ty, tx] = pack_tile(valid, tile_size)
+    finally:
+        for src in sources:
+            src.close()
+    return path
+
+def _next_date_bits(words):
+    """Shifts packed bits along time so every bit holds the value of the next date"""
+    carry = np.zeros_like(words)
+    carry[:-1] = words[1:] >> 7
+    return (words << 1) | carry
+
+def _cube_reduce(path, func, dtype=np.float32):
+    """Applies func(packed water tile, packed valid tile) to every tile and assembles an H x W result"""
+    cube = read_water_cube(path)
+    _, height, width = cube['meta']['shape']
+    out = np.zeros((height, width), dtype=dtype)
+    for ty, tx, rows, cols in cube_tiles(cube):
+        result = func(np.asarray(cube['water'][ty, tx]), np.asarray(cube['valid'][ty, tx]))
+        out[rows, cols] = result[:rows.stop - rows.start, :cols.stop - cols.start]
+    return out
+
+def cube_water_counts(path):
+    """Counts the wet observations of every pixel of a time cube with popcount"""
+    return _cube_reduce(path, lambda w, v: popcount(w).sum(axis=0, dtype=np.uint32), np.uint32)
+
+def cube_frequency(path):
+    """Computes the water frequency (percent of valid observations) of every pixel of a time cube"""
+    def frequency(w, v):
+        wet = popcount(w).sum(axis=0, dtype=np.uint32)
+        observed = popcount(v).sum(axis=0, dtype=np.uint32)
+        result = np.full(wet.shape, np.nan, dtype=np.float32)
+        np.divide(wet * np.float32(100), observed, out=result, where=observed > 0)
+        return result
+    return _cube_reduce(path, frequency)
+
+def cube_change_counts(path):
+    """Counts wet/dry changes between consecutive dates that are both observed, for every pixel of a time cube"""
+    def changes(w, v):
+        both_valid = v & _next_date_bits(v)
+        return popcount((w ^ _next_date_bits(w)) & both_valid).sum(axis=0, dtype=np.uint32)
+    return _cube_reduce(path, changes, np.uint32)
+
+def cube_longest_run(path):
+    """Finds the longest run of consecutive wet dates of every pixel of a time cube.
+    Runs are shortened by one date per pass (bits AND next-date bits) until no pixel has wet bits left,
+    so the number of passes is the longest run in the tile.
+    """
+    def longest(w, v):
+        run = np.zeros(w.shape[1:], dtype=np.uint32)
+        bits = w.copy()
+        while True:
+            alive = bits.any(axis=0)
+            if not alive.any():
+                return run
+            run += alive
+            bits &= _next_date_bits(bits)
+    return _cube_reduce(path, longest, np.uint32)
@@ -0,0 +1,300 @@
+import os
+import csv
+import json
+import time
+import queue
+import hashlib
+import argparse
+import threading
+import traceback
+from datetime import datetime
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from Utilities import pipeline_config_hash
+from BatchRunner import job_defaults, run_job
+from RequestGovernor import governor
+
+# Default folder of the shared result cache
+service_cache_dir = os.path.join(os.path.expanduser('~'), '.pygee_swtoolbox', 'service')
+
+# Result file of each series served by /jobs/<id>/series/<name>
+service_series = {'area': 'areas.csv', 'volume': 'volumes.csv', 'depth': 'depths.csv'}
+
+def _job_key(params):
+    """Job key: the configuration hash (which hashes the boundary by content) joined with the last stage"""
+    return f"{params['id']}-{params['last_stage']}"
+
+class PipelineService:
+    """Runs pipeline jobs from a queue on a bounded pool of worker threads, with a shared result cache.
+    A job is identified by its configuration hash (the boundary by content) and last stage, so identical requests
+    share one job: a request for a queued or running job joins it, and a request for a completed job is
+    answered from the cache. Results are the checkpoints and CSV series of BatchRunner.run_job, kept in
+    one folder per configuration, so jobs that differ only in their last stage reuse each other's stages.
+    Args:
+        cache_dir (str, optional): Folder of the result cache. Defaults to service_cache_dir.
+        workers (int, optional): Number of jobs run at once. Defaults to 4.
+        runner (function, optional): Runs one job, as BatchRunner.run_job(job, checkpoint_dir). Defaults to run_job.
+    """
+
+    def __init__(self, cache_dir=None, workers=4, runner=run_job):
+        self.cache_dir = cache_dir or service_cache_dir
+        self.runner = runner
+        self.jobs = {}
+        self.queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._folder_locks = {}
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.threads = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def _normalize(self, request):
+        """Completes a job request with the batch defaults and stores an inline GeoJSON boundary in the cache"""
+        params = dict(job_defaults)
+        params.update({k: v for k, v in request.items() if k != 'id'})
+        if 'boundary_geojson' in params:
+            text = json.dumps(params.pop('boundary_geojson'), sort_keys=True)
+            folder = os.path.join(self.cache_dir, 'boundaries')
+            os.makedirs(folder, exist_ok=True)
+            params['boundary'] = os.path.join(folder, hashlib.md5(text.encode()).hexdigest() + '.geojson')
+            if not os.path.exists(params['boundary']):
+                with open(params['boundary'], 'w') as f:
+                    f.write(text)
+        for key in ['boundary', 'start', 'end']:
+            if not params.get(key):
+                raise ValueError(f'Missing job parameter: {key}')
+        if not os.path.exists(params['boundary']):
+            raise ValueError(f"Boundary file not found: {params['boundary']}")
+        # One result folder per configuration, whatever the last stage
+        params['id'] = pipeline_config_hash({k: v for k, v in params.items() if k != 'last_stage'})
+        return params
+
+    def submit(self, request):
+        """Queues a job unless an identical job is queued, running or completed
+        Args:
+            request (dict): Job parameters as in a batch job file (see BatchRunner.load_jobs)
+        Returns:
+            dict: Job record with 'job_id', 'state' and 'deduplicated'
+        """
+        params = self._normalize(request)
+        job_id = _job_key(params)
+        with self._lock:
+            record = self.jobs.get(job_id)
+            if record is not None and record['state'] != 'failed':
+                record['requests'] += 1
+                return dict(record, deduplicated=True)
+            record = {'job_id': job_id, 'folder': params['id'], 'state': 'queued', 'requests': 1,
+                      'submitted': datetime.now().isoformat(), 'started': None, 'finished': None,
+                      'report': None, 'error': None}
+            self.jobs[job_id] = record
+            self._folder_locks.setdefault(params['id'], threading.Lock())
+        self.queue.put((job_id, params))
+        return dict(record, deduplicated=False)
+
+    def _work(self):
+        while True:
+            job_id, params = self.queue.get()
+            with self._lock:
+                record = self.jobs[job_id]
+                folder_lock = self._folder_locks[params['id']]
+            # Jobs sharing a result folder run one at a time, the later one resuming from the checkpoints
+            with folder_lock:
+                with self._lock:
+                    record.update(state='running', started=datetime.now().isoformat())
+                try:
+                    report = self.runner(params, self.cache_dir)
+                    update = {'report': report, 'state': report['status'], 'error': report['error']}
+                except Exception as e:
+                    update = {'state': 'failed', 'error': ''.join(traceback.format_exception_only(type(e), e)).strip()}
+                # Records are read under the lock, so readers see a job either before or after its update
+                with self._lock:
+                    record.update(update, finished=datetime.now().isoformat())
+            self.queue.task_done()
+
+    def status(self, job_id):
+        """Job record, or None for an unknown job"""
+        with self._lock:
+            record = self.jobs.get(job_id)
+            return dict(record) if record is not None else None
+
+    def list_jobs(self):
+        with self._lock:
+            return [dict(record) for record in self.jobs.values()]
+
+    def files(self, job_id):
+        """Names of the result files (CSV series and stage checkpoints) of a job"""
+        record = self.status(job_id)
+        if record is None:
+            return None
+        folder = os.path.join(self.cache_dir, record['folder'])
+        return sorted(os.listdir(folder)) if os.path.isdir(folder) else []
+
+    def file_path(self, job_id, name):
+        """Path of a result file of a job, or None if the job has no such file"""
+        files = self.files(job_id)
+        if not files or name not in files:
+            return None
+        return os.path.join(self.cache_dir, self.status(job_id)['folder'], name)
+
+    def series(self, job_id, name):
+        """Reads a result series ('area', 'volume' or 'depth') as columns of values, or None if not computed"""
+        path = self.file_path(job_id, service_series.get(name, ''))
+        if path is None:
+            return None
+        with open(path, newline='') as f:
+            rows = list(csv.reader(f))
+        columns = {header: [] for header in rows[0]}
+        for row in rows[1:]:
+            for header, value in zip(rows[0], row):
+                columns[header].append(value if header == 'Date' else (float(value) if value else None))
+        return columns
+
+    def metrics(self):
+        """Job counts by state, queue length and the request governor metrics"""
+        counts = {}
+        for record in self.list_jobs():
+            counts[record['state']] = counts.get(record['state'], 0) + 1
+        return {'jobs': counts, 'queued': self.queue.qsize(), 'workers': len(self.threads),
+                'governor': governor.metrics()}
+
+class ServiceRequestHandler(BaseHTTPRequestHandler):
+    """HTTP interface of a PipelineService:
+        POST /jobs                       submit a job (JSON body as a batch job), returns its record
+        GET  /jobs                       list jobs
+        GET  /jobs/<id>                  job record (state, run report, error)
+        GET  /jobs/<id>/series/<name>    area, volume or depth series as JSON
+        GET  /jobs/<id>/files            result files of the job
+        GET  /jobs/<id>/files/<name>     download a result file
+        GET  /metrics                    job counts and request governor metrics
+    """
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload, default=str).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/jobs':
+            return self._send_json(404, {'error': 'Not found'})
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            record = self.server.service.submit(json.loads(self.rfile.read(length) or b'{}'))
+        except (ValueError, TypeError) as e:
+            return self._send_json(400, {'error': str(e)})
+        self._send_json(200 if record['deduplicated'] else 202, record)
+
+    def do_GET(self):
+        service = self.server.service
+        parts = [p for p in self.path.split('?')[0].split('/') if p]
+        if parts == ['jobs']:
+            return self._send_json(200, service.list_jobs())
+        if parts == ['metrics']:
+            return self._send_json(200, service.metrics())
+        if len(parts) < 2 or parts[0] != 'jobs' or service.status(parts[1]) is None:
+            return self._send_json(404, {'error': 'Not found'})
+
+        job_id = parts[1]
+        if len(parts) == 2:
+            return self._send_json(200, service.status(job_id))
+        if len(parts) == 4 and parts[2] == 'series':
+            series = service.series(job_id, parts[3])
+            if series is None:
+                return self._send_json(404, {'error': f'No {parts[3]} series for this job'})
+            return self._send_json(200, series)
+        if len(parts) == 3 and parts[2] == 'files':
+            return self._send_json(200, service.files(job_id))
+        if len(parts) == 4 and parts[2] == 'files':
+            path = service.file_path(job_id, parts[3])
+            if path is None:
+                return self._send_json(404, {'error': 'File not found'})
+            with open(path, 'rb') as f:
+                body = f.read()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/csv' if path.endswith('.csv') else 'application/json')
+            self.send_header('Content-Disposition', f'attachment; filename="{parts[3]}"')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        self._send_json(404, {'error': 'Not found'})
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(service, host='127.0.0.1', port=8765):
+    """Creates the HTTP server of a service; call serve_forever on it, or run it in a thread
+    Args:
+        service (object): PipelineService
+        host (str, optional): Interface to listen on. Defaults to '127.0.0.1' (local only).
+        port (int, optional): Port; 0 picks a free port. Defaults to 8765.
+    Returns:
+        object: http.server.ThreadingHTTPServer
+    """
+    server = ThreadingHTTPServer((host, port), ServiceRequestHandler)
+    server.service = service
+    return server
+
+class ServiceClient:
+    """Client of a running PipelineService, e.g. for a Toolbox acting as a thin client
+    Args:
+        url (str, optional): Base URL of the service. Defaults to 'http://127.0.0.1:8765'.
+    """
+
+    def __init__(self, url='http://127.0.0.1:8765'):
+        self.url = url.rstrip('/')
+
+    def _request(self, path, body=None, raw=False):
+        """Calls the service; returns the decoded JSON response, or its bytes if raw (file downloads)"""
+        data = None if body is None else json.dumps(body).encode()
+        request = Request(self.url + path, data=data, headers={'Content-Type': 'application/json'})
+        try:
+            with urlopen(request) as response:
+                payload = response.read()
+                return payload if raw else json.loads(payload)
+        except HTTPError as e:
+            raise ValueError(json.loads(e.read()).get('error', str(e)))
+
+    def submit(self, **params):
+        return self._request('/jobs', params)
+
+    def status(self, job_id):
+        return self._request('/jobs/' + job_id)
+
+    def series(self, job_id, name='area'):
+        return self._request(f'/jobs/{job_id}/series/{name}')
+
+    def download(self, job_id, name, filename):
+        with open(filename, 'wb') as f:
+            f.write(self._request(f'/jobs/{job_id}/files/{name}', raw=True))
+
+    def wait(self, job_id, poll_interval=5, timeout=None, sleep=None):
+        """Polls a job until it completed or failed; returns its record"""
+        sleep = sleep or time.sleep
+        start = time.monotonic()
+        while True:
+            record = self.status(job_id)
+            if record['state'] in ['completed', 'failed']:
+                return record
+            if timeout is not None and time.monotonic() - start > timeout:
+                raise TimeoutError(f'Job {job_id} still {record["state"]} after {timeout} s')
+            sleep(poll_interval)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the surface water pipeline over HTTP')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--workers', type=int, default=4, help='Number of jobs run at once')
+    parser.add_argument('--cache-dir', default=None, help='Folder of the shared result cache')
+    parser.add_argument('--project', default=None, help='Google Cloud project for Earth Engine')
+    args = parser.parse_args()
+
+    import ee
+    ee.Initialize(project=args.project)
+    server = serve(PipelineService(args.cache_dir, args.workers), args.host, args.port)
+    print(f'Serving on http://{args.host}:{server.server_address[1]}')
+    server.serve_forever()
@@ -9,7 +9,6 @@ ee.Initialize()
 # geemap:A Python package for interactive mapping with Google Earth Engine, ipyleaflet, and ipywidgets
 # Documentation: https://geemap.org
 import geemap
-from geemap import ml
 import pickle
 # from geemap import ee_basemaps
 
@@ -24,16 +23,6 @@ import eemont
 # import Utilities as ut
 from Utilities import *
 
-# geetols: Google earth engine tools
-# https://github.com/gee-community/gee_tools
-import geetools
-from geetools import tools
-
-# hydrafloods: Hydrologic Remote Sensing Analysis for Floods
-#https://github.com/Servir-Mekong/hydra-floods
-import hydrafloods as hf
-from hydrafloods import geeutils
-
 # Ipywidgets for GUI design
 import ipywidgets as ipw
 from IPython.display import display
@@ -54,6 +43,35 @@ import pandas as pd
 # Miscellaneous Python modules
 from datetime import datetime, timedelta
 import os
+import gzip
+import shutil
+import tempfile
+
+# Local engines for downloaded rasters
+from LocalProcessing import water_cube_from_files
+from SceneCatalog import SceneCatalog
+from ExportScheduler import ExportScheduler, drive_export_jobs, export_manifest_dir
+from RequestGovernor import governor, get_info
+from TimeSeriesStore import TimeSeriesStore, aoi_key, update_area_series
+from StageGraph import StageGraph
+
+
+# Toolbox attributes holding Earth Engine objects, saved in sessions as serialized expressions
+session_ee_attributes = ['site', 'site_bounds', 'StartDate', 'EndDate', 'filtered_Collection', 'filtered_landsat',
+                         'clipped_images', 'water_images', 'WaterMasks', 'index_images', 'dswe_images', 'depth_maps',
+                         'rf_ee_classifier', 'filtered_Water_Images', 'hydroperiod_image']
+
+# Toolbox attributes holding computed values, saved in sessions as they are
+session_attributes = ['imageType', 'img_scale', 'mosaic_plan', 'site_bbox', 'site_key', 'depth_location', 'dates',
+                      'file_list', 'visParams', 'freqParams', 'dswe_viz', 'depthParams']
+
+# Module globals of computed results; water_frequency and water_occurence are Earth Engine objects
+session_globals = ['df', 'vol_df', 'depths_df', 'gauge_depths_df', 'save_water_data', 'series_config', 'area_unit_symbol',
+                   'vol_unit_symbol']
+session_ee_globals = ['water_frequency', 'water_occurence']
+
+# Version of the session file layout
+session_version = 1
 
 
 class Toolbox:
@@ -121,7 +139,23 @@ class Toolbox:
         self.cloud_threshold = ipw.IntSlider(description = 'Cloud Threshold:', orientation = 'horizontal',
                                          value = 50, step = 5, style = style)
 
-        imageParameters = VBox([dataset_description, PlatformType, FilterType, datePickers, self.cloud_threshold], 
+        # Minimum percentage of clear (unmasked) pixels inside the study area for keeping an image
+        self.clear_threshold = ipw.IntSlider(description = 'Min. AOI Clear %:', orientation = 'horizontal',
+                                         value = 0, step = 5, style = style)
+
+        # Answer scene queries from the local scene catalog, syncing only uncatalogued and recent acquisitions
+        self.use_catalog = ipw.Checkbox(value=False, description='Use local scene catalog', indent=False,
+                                        tooltip='Select scenes from a local metadata catalog instead of querying every collection')
+
+        # Asset folder of exported terrain layers (see export_terrain_layers); layers are built on the fly if empty
+        self.terrain_assets = ipw.Text(value='', placeholder='users/<name>/terrain', description='Terrain assets:',
+                                       layout=Layout(width='290px'), style = style)
+
+        self.export_terrain_button = ipw.Button(description = 'Export terrain',
+                                                tooltip='Export the terrain layers of the study area to the terrain asset folder')
+
+        imageParameters = VBox([dataset_description, PlatformType, FilterType, datePickers, self.cloud_threshold,
+                                self.clear_threshold, self.use_catalog, self.terrain_assets, self.export_terrain_button], 
                            layout=Layout(width='305px', border='solid 2px black'))
 
 
@@ -132,7 +166,11 @@ class Toolbox:
 
         self.user_preference = ipw.RadioButtons(options=['Map drawn boundary','Upload boundary'], value='Map drawn boundary')
 
-        self.file_selector = FileChooser(description = 'Upload', filter_pattern = ["*.shp","*.kml"], use_dir_icons = True)
+        self.file_selector = FileChooser(description = 'Upload', filter_pattern = ["*.shp","*.kml","*.kmz","*.geojson","*.json"], use_dir_icons = True)
+
+        # Clip only map layers and downloads; statistics use the study area as reduction geometry
+        self.deferred_clip = ipw.Checkbox(value=False, description='Clip at display/export only', indent=False,
+                                          tooltip='Skip clipping every image; reductions still use the study area')
 
         # Retrieve and process satellite images
         #***********************************************************************************************
@@ -143,7 +181,7 @@ class Toolbox:
 
         # Study area UI and process button container
         # ************************************************************************************************
-        StudyArea = VBox(children = [StudyArea_description, self.user_preference, self.imageProcessing_Button], 
+        StudyArea = VBox(children = [StudyArea_description, self.user_preference, self.deferred_clip, self.imageProcessing_Button], 
                            layout=Layout(width='300px', border='solid 2px black', margin='0 0 0 10px'))
 
 
@@ -227,6 +265,9 @@ class Toolbox:
                                             layout=Layout(width='200px', border='solid 2px black',margin='5 0 0 50px'))
         self.water_Frequency_button.disabled = True
 
+        self.frequency_grouping = ipw.Dropdown(options=['Whole period','Monthly','Seasonal','Yearly'], value='Whole period',
+                                        description='Frequency by:', layout=Layout(width='210px', margin='0 0 0 10px'), style = style)
+
         self.Depths_Button = ipw.Button(description = 'Compute Depth Map',
                                         tooltip='Click to generate depth maps', button_style = 'info',
                                         layout=Layout(width='200px', border='solid 2px black',margin='5 0 0 50px'))
@@ -236,7 +277,7 @@ class Toolbox:
                                         layout=Layout(width='210px', margin='0 0 0 10px'), style = style)
         self.elevData_options.disabled = False
         
-        self.elev_Methods = ipw.Dropdown(options=['Random Forest','Mod_Stumpf','Mod_Lyzenga','FwDET'], value='Random Forest',
+        self.elev_Methods = ipw.Dropdown(options=['Random Forest','Mod_Stumpf','Mod_Lyzenga','FwDET','DEM Max'], value='Random Forest',
                             description='Depth method:',
                             layout=Layout(width='210px', margin='0 0 0 10px'), style = style)
         
@@ -258,7 +299,15 @@ class Toolbox:
                                        layout=Layout(width='200px', border='solid 2px black',margin='5 0 0 50px'))
 
         # Spatial_Analysis_Tab = VBox([water_Frequency_button, elev_Box, zonalAnalysis_Button])
-        Spatial_Analysis_Tab = VBox([self.water_Frequency_button, elev_Box])
+        frequency_Box = HBox([self.water_Frequency_button, self.frequency_grouping])
+
+        self.hydroperiod_button = ipw.Button(description = 'Compute Hydroperiod',
+                                            tooltip='Click to compute inundation duration and longest wet run',
+                                            button_style = 'info',
+                                            layout=Layout(width='200px', border='solid 2px black',margin='5 0 0 50px'))
+        self.hydroperiod_button.disabled = True
+
+        Spatial_Analysis_Tab = VBox([frequency_Box, self.hydroperiod_button, elev_Box])
 
 
         # Ploting and Statistics Tab
@@ -267,6 +316,10 @@ class Toolbox:
         self.area_unit = ipw.Dropdown(options = ['Square m','Square Km', 'Hectares', 'Acre'], value = 'Square m',
                                     description = 'Unit of area:', style=style, tooltip='Select unit for areas', layout=Layout(width='200px'))
 
+        # Keep a stored area series of the study area and only compute dates newer than the stored ones
+        self.incremental_update = ipw.Checkbox(value=False, description='Incremental update', indent=False,
+                                               tooltip='Append newly acquired images to the stored area series of this study area')
+
         self.plot_button = ipw.Button(description = 'Compute and Plot Areas', tooltip='Click to plot graph', button_style = 'info',
                                 layout=Layout(width='170px', margin='10 0 0 200px', border='solid 2px black'))
         self.plot_button.disabled = True
@@ -280,13 +333,15 @@ class Toolbox:
         # lbl_depth_Plotting = ipw.Label(value ='Plot depth hydrograph at a location:', layout=Layout(margin='10px 0 0 0'))
         lbl_depth_Plotting = ipw.HTML(value = f"<b><font color='blue'>{'Plot depth hydrograph at a location:'}</b>")
 
-        self.point_preference = ipw.RadioButtons(options=['Map drawn point','Enter coordinates'], 
+        self.point_preference = ipw.RadioButtons(options=['Map drawn point','Enter coordinates','Upload gauge points'], 
                                             value='Map drawn point')
 
         self.coordinates_textbox = ipw.Text(layout=Layout(width='200px'))
         lbl_coordinates = ipw.Label(value='Enter Long, Lat in decimal degrees')
 
-        # point_selector = FileChooser(description = 'Upload point', filter_pattern = ["*.shp"], use_dir_icons = True)
+        # CSV of Long, Lat columns or point shapefile/KML/KMZ/GeoJSON for multi-gauge hydrographs
+        self.point_selector = FileChooser(description = 'Upload points', filter_pattern = ["*.csv","*.shp","*.kml","*.kmz","*.geojson"],
+                                          use_dir_icons = True)
 
         self.depth_plot_button = ipw.Button(description = 'Plot depths', tooltip='Click to plot depth hydrograph', button_style = 'info',
                                 layout=Layout(width='170px', margin='10 0 0 100px', border='solid 2px black'))
@@ -294,7 +349,7 @@ class Toolbox:
 
         depth_box = VBox(children = [lbl_depth_Plotting,self.point_preference, self.depth_plot_button])
 
-        plotting_box = VBox([lbl_Area_Plotting, self.area_unit, self.plot_button, lbl_Volume_Plotting,self.vol_unit,self.volume_button, depth_box], 
+        plotting_box = VBox([lbl_Area_Plotting, self.area_unit, self.incremental_update, self.plot_button, lbl_Volume_Plotting,self.vol_unit,self.volume_button, depth_box], 
                             layout=Layout(width='310px', border='solid 2px black'))
 
         lbl_Stats = ipw.HTML(value = f"<b><font color='blue'>{'Summary Statistics:'}</b>")
@@ -343,10 +398,10 @@ class Toolbox:
         # Downloads Tab
         #***************************************************************************************************
         self.files_to_download = ipw.RadioButtons(options=['Satellite Images', 'Water Mask', 'Water Frequency', 'Depth Maps',
-                                                      'DSWE Images'], value='Satellite Images', 
+                                                      'DSWE Images', 'Hydroperiod', 'Water Cube'], value='Satellite Images', 
                                              description='Files to download:', style = style)
 
-        self.download_location = ipw.RadioButtons(options=['Google Drive', 'Local Disk'], 
+        self.download_location = ipw.RadioButtons(options=['Google Drive', 'Local Disk', 'Local Datacube (Zarr)'], 
                                              value='Google Drive', description='Download Location:', style = style)
 
         self.folder_name = ipw.Text(description='Folder Name:')
@@ -361,10 +416,27 @@ class Toolbox:
                                             tooltip='Click to plot download water images', button_style = 'info')
         self.download_button.disabled = True
 
+        self.compact_export = ipw.Checkbox(value=True, description='Compact data types', indent=False,
+                                           tooltip='Cast downloads to the smallest data type with nodata and compression')
 
         download_settings = VBox(children=[self.files_to_download, self.download_location, self.folder_name])
 
-        download_tab = HBox([download_settings, self.download_button])
+        download_tab = HBox([download_settings, VBox([self.compact_export, self.download_button])])
+
+        # Session Tab
+        #***************************************************************************************************
+        lbl_Session = ipw.HTML(value = f"<b><font color='blue'>{'Save or restore the toolbox session:'}</b>")
+
+        self.session_selector = FileChooser(description = 'Select session file', filter_pattern = "*.session", use_dir_icons = True)
+        self.session_selector.title = 'Select Folder and Filename'
+        self.session_selector.default_path = os.getcwd()
+
+        self.save_session_button = ipw.Button(description = 'Save Session', tooltip='Click to save the session to file',
+                                              button_style = 'info', layout=Layout(width='120px', border='solid 2px black'))
+        self.load_session_button = ipw.Button(description = 'Restore Session', tooltip='Click to restore a saved session',
+                                              button_style = 'info', layout=Layout(width='120px', border='solid 2px black'))
+
+        session_tab = VBox([lbl_Session, self.session_selector, HBox([self.save_session_button, self.load_session_button])])
         
         # variable to hold the random forest classifier
         self.rf_ee_classifier = None
@@ -374,9 +446,18 @@ class Toolbox:
         self.filtered_Collection = None
         self.filtered_landsat = None
         self.clipped_images = None
+        # Scene ids of each date (see same_day_plan), shared by mosaicking, DSWE and map lookups
+        self.mosaic_plan = None
         self.imageType = None
         self.dates = None
         self.site = None
+        self.site_bounds = None
+        self.site_bbox = None
+        self.scene_catalog = None
+        # Key of the study area in the time-series store
+        self.site_key = None
+        self.timeseries_store = None
+        self.depth_location = None
         self.img_scale = None
         self.file_list = None
         self.StartDate = None
@@ -388,6 +469,11 @@ class Toolbox:
         self.depth_maps = None
         self.filtered_Water_Images =  None
         self.depthParams = None
+        self.hydroperiod_image = None
+        # Maximum number of Earth Engine export tasks running at once for Google Drive downloads
+        self.max_export_tasks = 4
+        # Asset folder of exported terrain layers, set from the terrain assets box
+        self.terrain_asset_root = None
 
         # Functions to control UI changes and parameter settings
         #****************************************************************************************************
@@ -409,6 +495,7 @@ class Toolbox:
                           'max': 0.3,
                           }
                     self.cloud_threshold.disabled = False
+                    self.clear_threshold.disabled = False
                     self.water_indices.disabled = False
                     self.index_color.disabled = False
                     self.threshold_value.disabled = False
@@ -419,6 +506,7 @@ class Toolbox:
                 elif self.Platform_dropdown.value == 'Sentinel-1':
                     self.visParams = {'min': -25,'max': 0}
                     self.cloud_threshold.disabled = True
+                    self.clear_threshold.disabled = True
                     self.water_indices.options = ['VV','VH']#,'NDPI','NVHI', 'NVVI']
                     self.index_color.disabled = False
                     self.threshold_value.disabled = True
@@ -429,6 +517,7 @@ class Toolbox:
                       'min': 0.0,
                       'max': 3000}
                     self.cloud_threshold.disabled = False
+                    self.clear_threshold.disabled = False
                     self.water_indices.disabled = False
                     self.index_color.disabled = False
                     self.threshold_value.disabled = False
@@ -439,6 +528,7 @@ class Toolbox:
                     self.visParams = {'bands': ['R', 'G','B'],
                                 'min': 0.0,
                                 'max': 255.0}
+                    self.clear_threshold.disabled = True
                     self.threshold_value.disabled = False
                     self.water_indices.disabled = False
                     self.index_color.disabled = False
@@ -497,9 +587,11 @@ class Toolbox:
             returns:
                 None
             """
-            if button['new']:
+            if button['new'] == 1:
                 depth_box.children = [lbl_depth_Plotting,self.point_preference, lbl_coordinates, self.coordinates_textbox, 
                                       self.depth_plot_button]
+            elif button['new'] == 2:
+                depth_box.children = [lbl_depth_Plotting,self.point_preference, self.point_selector, self.depth_plot_button]
             else:
                 depth_box.children = [lbl_depth_Plotting,self.point_preference, self.depth_plot_button]
 
@@ -533,7 +625,7 @@ class Toolbox:
         self.threshold_dropdown.observe(thresholdSelection, 'value')
         
         def depthMethodSelection(change):
-            if self.elev_Methods.value == 'FwDET' or self.elev_Methods.value == 'Experimental':
+            if self.elev_Methods.value in ['FwDET', 'DEM Max', 'Experimental']:
                 self.elevData_options.disabled = False
             else:
                 self.elevData_options.disabled = True
@@ -544,8 +636,8 @@ class Toolbox:
 
         def demSelection(change):
             if self.elevData_options.value == 'User DEM':
-                folder = ee.data.getAssetRoots()[0]['id']
-                assets = ee.data.listAssets({'parent':folder})
+                folder = governor.call('getAssetRoots', ee.data.getAssetRoots)[0]['id']
+                assets = governor.call('listAssets', ee.data.listAssets, {'parent':folder})
                 # filter only image assets
                 filtered_asset = list(filter(lambda asset: asset['type'] == 'IMAGE', assets['assets']))
                 # create a list of image assets
@@ -558,11 +650,16 @@ class Toolbox:
         # Link widget to function
         self.elevData_options.observe(demSelection, 'value')
 
+        def terrainAssetsChange(change):
+            self.terrain_asset_root = change['new'].strip() or None
+
+        self.terrain_assets.observe(terrainAssetsChange, 'value')
+
         #****************************************************************************************************
 
         # Full UI
         #***************************************************************************************************
-        tab_children = [imageProcessing_tab, Extraction_tab, Spatial_Analysis_Tab, plot_stats_tab, download_tab]
+        tab_children = [imageProcessing_tab, Extraction_tab, Spatial_Analysis_Tab, plot_stats_tab, download_tab, session_tab]
 
         tab = ipw.Tab()
         tab.children = tab_children
@@ -573,6 +670,7 @@ class Toolbox:
         tab.set_title(2, 'Spatial Analysis')
         tab.set_title(3, 'Plotting & Stats')
         tab.set_title(4, 'Download & Export')
+        tab.set_title(5, 'Session')
 
 
         # Plotting outputs and feedback to user
@@ -598,6 +696,26 @@ class Toolbox:
         display(self.fig)
         display(self.feedback)
         
+        # Pipeline stages and the widget values they read; a widget change invalidates only the stages
+        # downstream of it, which are recomputed when next requested. Areas and volumes are kept in square
+        # and cubic meters, so a unit change is only a conversion in the plot handlers
+        self.pipeline = StageGraph()
+        self.pipeline.add_stage('images', self.images_stage, ['site', 'platform', 'cloud_threshold', 'clear_threshold',
+                                                              'speckle_filter', 'start_date', 'end_date', 'use_catalog',
+                                                              'deferred_clip'])
+        self.pipeline.add_stage('water', self.water_stage, ['water_index', 'threshold_method', 'threshold'], ['images'])
+        self.pipeline.add_stage('areas', self.areas_stage, ['incremental_update'], ['water'])
+        self.pipeline.add_stage('depths', self.depths_stage, ['depth_method', 'dem', 'user_dem'], ['water'])
+        self.pipeline.add_stage('volumes', self.volumes_stage, [], ['depths'])
+        for widget, param in [(self.Platform_dropdown, 'platform'), (self.cloud_threshold, 'cloud_threshold'),
+                              (self.clear_threshold, 'clear_threshold'), (self.filter_dropdown, 'speckle_filter'),
+                              (self.start_date, 'start_date'), (self.end_date, 'end_date'), (self.use_catalog, 'use_catalog'),
+                              (self.deferred_clip, 'deferred_clip'), (self.water_indices, 'water_index'),
+                              (self.threshold_dropdown, 'threshold_method'), (self.threshold_value, 'threshold'),
+                              (self.incremental_update, 'incremental_update'), (self.elev_Methods, 'depth_method'),
+                              (self.elevData_options, 'dem'), (self.userDEM, 'user_dem')]:
+            self.pipeline.bind(widget, param)
+
         # Widget-Function connections
         self.imageProcessing_Button.on_click(self.process_images)
         self.extractWater_Button.on_click(self.Water_Extraction)
@@ -606,8 +724,12 @@ class Toolbox:
         self.Depths_Button.on_click(self.calc_depths)
         self.download_button.on_click(self.dowload_images)
         self.water_Frequency_button.on_click(self.water_frequency)
+        self.hydroperiod_button.on_click(self.compute_hydroperiod)
         self.depth_plot_button.on_click(self.plot_depths)
         self.volume_button.on_click(self.plot_volumes)
+        self.save_session_button.on_click(self.save_session)
+        self.load_session_button.on_click(self.load_session)
+        self.export_terrain_button.on_click(self.export_terrain)
         
 
     # Function to clip images
@@ -625,6 +747,38 @@ class Toolbox:
         clipped_image = img.clip(self.site).copyProperties(orig, orig.propertyNames())
         return clipped_image    
 
+    def display_clip(self, img):
+        """
+        Function to clip an image for display or export when clipping is deferred
+
+        args:
+            Image or image collection
+
+        returns:
+            Clipped image(s) in deferred mode, otherwise the input unchanged
+        """
+        if self.deferred_clip.value:
+            if isinstance(img, ee.ImageCollection):
+                return img.map(self.clipImages)
+            return self.clipImages(img)
+        return img
+
+
+    def plan_image(self, collection, date):
+        """
+        Function to look up the image of a date through the same-day plan
+
+        args:
+            collection: Image collection with one image per day
+            date: Date of the image
+
+        returns:
+            Image of that day
+        """
+        day = date.strftime('%Y-%m-%d')
+        if self.mosaic_plan is not None and day in self.mosaic_plan:
+            return ee.Image(collection.filterDate(day, ee.Date(day).advance(1, 'day')).first())
+        return collection.closest(date).first()
 
     def process_images(self, b):
         """
@@ -643,83 +797,44 @@ class Toolbox:
                 self.fig.data = [] # clear existing plot
 
                 self.lbl_RetrievedImages.value = 'Processing....'
-                cloud_thresh = self.cloud_threshold.value
+
+                # get widget values
+                self.imageType = self.Platform_dropdown.value
 
                 # Define study area based on user preference
                 if self.user_preference.index == 1:
                     file = self.file_selector.selected  
-                    self.site = load_boundary(file)
+                    # Simplified boundary for clipping and reductions, bounding box for filterBounds
+                    aoi = prepare_aoi(file, platform_scales[self.imageType])
+                    self.site = aoi['site']
+                    self.site_bounds = aoi['bounds']
+                    self.site_bbox = aoi['bbox']
+                    self.site_key = aoi_key(self.site, file)
+                    print(f"AOI vertices: {aoi['report']['original_vertices']} -> {aoi['report']['simplified_vertices']}, "
+                          f"request payload: {aoi['report']['original_bytes']} -> {aoi['report']['simplified_bytes']} bytes")
                     self.Map.addLayer(self.site, {}, 'AOI')
                     self.Map.center_object(self.site)
                 else:
                     self.site = ee.FeatureCollection(self.Map.draw_last_feature)
+                    self.site_bounds = ee.FeatureCollection(self.site.geometry().bounds())
+                    self.site_bbox = None
+                    self.site_key = aoi_key(self.site)
+                self.pipeline.set_param('site', self.site_key)
 
-                # get widget values
-                self.imageType = self.Platform_dropdown.value
-                filterType = self.filter_dropdown.value
-                self.StartDate = ee.Date.fromYMD(self.start_date.value.year,self.start_date.value.month,self.start_date.value.day)
-                self.EndDate = ee.Date.fromYMD(self.end_date.value.year,self.end_date.value.month,self.end_date.value.day)
-
-                boxcar = ee.Kernel.circle(**{'radius':3, 'units':'pixels', 'normalize':True})
-
-                def filtr(img):
-                    return img.convolve(boxcar)
-
-                # filter image collection based on date, study area and cloud threshold(depends of datatype)
-                if self.imageType == 'Landsat-Collection 2':
-                    self.filtered_landsat = load_Landsat_Coll_2(self.site, self.StartDate, self.EndDate, cloud_thresh)
-                    self.filtered_Collection = self.filtered_landsat.map(maskLandsatclouds)
-                elif self.imageType == 'Sentinel-2':
-                    Collection_before = load_Sentinel2(self.site, self.StartDate, self.EndDate, cloud_thresh)
-                    self.filtered_Collection = Collection_before.map(maskS2clouds)
-                elif self.imageType == 'Sentinel-1':
-                    Collection_before = load_Sentinel1(self.site, self.StartDate, self.EndDate)
-                    # apply speckle filter algorithm or smoothing
-                    if filterType == 'Gamma MAP':
-                        corrected_Collection = Collection_before.map(slope_correction)
-                        self.filtered_Collection = corrected_Collection.map(hf.gamma_map)
-                    elif filterType == 'Refined-Lee':
-                        corrected_Collection = Collection_before.map(slope_correction)
-                        self.filtered_Collection = corrected_Collection.map(hf.refined_lee)
-                    elif filterType == 'Perona-Malik':
-                        corrected_Collection = Collection_before.map(slope_correction)
-                        self.filtered_Collection = corrected_Collection.map(hf.perona_malik)
-                    elif filterType == 'P-median':
-                        corrected_Collection = Collection_before.map(slope_correction)
-                        self.filtered_Collection = corrected_Collection.map(hf.p_median)
-                    elif filterType == 'Boxcar Convolution':
-                        corrected_Collection = Collection_before.map(slope_correction)
-                        self.filtered_Collection = corrected_Collection.map(filtr)
-                    elif filterType == 'Lee Sigma':
-    #                         corrected_Collection = Collection_before.map(ut.slope_correction) # slope correction before lee_sigma fails
-                        self.filtered_Collection = Collection_before.map(hf.lee_sigma)
-                elif self.imageType == 'USDA NAIP':
-                    self.filtered_Collection = load_NAIP(self.site, self.StartDate, self.EndDate)
-
-                # Clip images to study area
-                self.clipped_images = self.filtered_Collection.map(self.clipImages)
-
-                # Mosaic same day images
-                self.clipped_images = tools.imagecollection.mosaicSameDay(self.clipped_images)
+                # Retrieved again only if the study area or an image parameter changed
+                if self.pipeline.is_valid('images'):
+                    print('Images unchanged since the last run, using cached results')
+                self.pipeline.get('images')
 
                 # Add first image in collection to Map
-                first_image = self.clipped_images.first()
-                if self.imageType == 'Sentinel-1':
-                    self.img_scale = first_image.select(0).projection().nominalScale().getInfo()
-                else:
-                    bandNames = first_image.bandNames().getInfo()
-                    self.img_scale = first_image.select(str(bandNames[0])).projection().nominalScale().getInfo()
-
-                self.Map.addLayer(self.clipped_images.first(), self.visParams, self.imageType)
+                self.Map.addLayer(self.display_clip(self.clipped_images.first()), self.visParams, self.imageType)
 
                 # Get no. of processed images
-                no_of_images = self.filtered_Collection.size().getInfo()
+                no_of_images = sum(len(ids) for ids in self.mosaic_plan.values())
 
                 # Display number of images
                 self.lbl_RetrievedImages.value = str(no_of_images)
 
-                # List of files
-                self.file_list = self.filtered_Collection.aggregate_array('system:id').getInfo()
                 # display list of files
                 self.lst_files.options = self.file_list
                 self.extractWater_Button.disabled = False # enable the water extraction button
@@ -729,6 +844,57 @@ class Toolbox:
                      print(e)
                      print('An error occurred during processing.')
                         
+    def images_stage(self, site, platform, cloud_threshold, clear_threshold, speckle_filter, start_date, end_date,
+                     use_catalog, deferred_clip):
+        """
+        Pipeline stage retrieving, clipping and mosaicking the images of the study area (see process_images)
+
+        args:
+            Widget values the stage depends on
+
+        returns:
+            Dictionary of the fetched same-day plan, scale, file list and prefilter report
+        """
+        self.imageType = platform
+        self.StartDate = ee.Date.fromYMD(start_date.year, start_date.month, start_date.day)
+        self.EndDate = ee.Date.fromYMD(end_date.year, end_date.month, end_date.day)
+
+        # Scenes selected from the local catalog; the loaders query every collection if None
+        scene_ids = None
+        if use_catalog:
+            if self.scene_catalog is None:
+                self.scene_catalog = SceneCatalog()
+            if self.site_bbox is None:
+                ring = get_info(self.site_bounds.geometry().bounds().coordinates().get(0))
+                self.site_bbox = [min(p[0] for p in ring), min(p[1] for p in ring),
+                                  max(p[0] for p in ring), max(p[1] for p in ring)]
+            scene_ids = self.scene_catalog.select_scenes(platform, self.site_bbox, start_date, end_date, cloud_threshold)
+            print(f"Scene catalog: {sum(len(ids) for ids in scene_ids.values())} scenes selected")
+
+        # filter image collection based on date, study area and cloud threshold(depends of datatype)
+        self.filtered_Collection, self.filtered_landsat, report = load_platform_images(
+            platform, self.site, self.site_bounds, self.StartDate, self.EndDate, cloud_threshold, clear_threshold/100.0,
+            speckle_filter, self.terrain_asset_root, scene_ids)
+        if report is not None:
+            print(f"AOI cloud prefilter: kept {report['kept_scenes']} of {report['total_scenes']} scenes, "
+                  f"{report['work_saved_percent']:.1f}% of per-scene work saved")
+
+        # Clip images to study area, unless clipping is deferred to display and export
+        if deferred_clip:
+            self.clipped_images = self.filtered_Collection
+        else:
+            self.clipped_images = self.filtered_Collection.map(self.clipImages)
+
+        # Mosaic same day images, planned from one metadata request
+        self.mosaic_plan = same_day_plan(self.filtered_Collection)
+        self.clipped_images = mosaic_same_day(self.clipped_images, self.mosaic_plan)
+
+        self.img_scale = collection_scale(self.clipped_images)
+
+        # List of files
+        self.file_list = get_info(self.filtered_Collection.aggregate_array('system:id'))
+        return {'plan': self.mosaic_plan, 'img_scale': self.img_scale, 'file_list': self.file_list, 'report': report}
+
     def Water_Extraction(self, b):
         """
         Function to extract surface water from satellite images
@@ -743,155 +909,12 @@ class Toolbox:
             self.feedback.clear_output()
             try:
 
-                color_palette = self.index_color.value       
-                # Function to extract water using NDWI or MNDWI from multispectral images
-                def water_index(img):
-                    """
-                    Function to extract surface water from Landsat and Sentinel-2 images using
-                    water extraction indices: NDWI, MNDWI, and AWEI
-
-                    args:
-                        Image
-
-                    returns:
-                        Image with water mask
-                    """
-                    index_image = ee.Image(1)
-                    if self.water_indices.value == 'NDWI':
-                        if self.imageType == 'Landsat-Collection 2' or self.imageType == 'Sentinel-2':
-                            bands = ['green', 'nir']
-                        elif self.imageType == 'USDA NAIP':
-                            bands = ['G', 'N']
-                        index_image = img.normalizedDifference(bands).rename('waterIndex')\
-                            .copyProperties(img, ['system:time_start'])
-
-                    elif self.water_indices.value == 'MNDWI':
-                        if self.imageType == 'Landsat-Collection 2':
-                            bands = ['green', 'swir1']
-                            index_image = img.normalizedDifference(bands).rename('waterIndex')\
-                                .copyProperties(img, ['system:time_start'])
-
-                        elif self.imageType == 'Sentinel-2':
-                            # Resample the swir bands from 20m to 10m
-                            resampling_bands = img.select(['swir1','swir2'])
-                            img = img.resample('bilinear').reproject(**
-                                        {'crs': resampling_bands.projection().crs(),
-                                        'scale':10
-                                        })
-                            bands = ['green', 'swir1']
-                            index_image = img.normalizedDifference(bands).rename('waterIndex')\
-                                .copyProperties(img, ['system:time_start'])
-
-                    elif self.water_indices.value == 'AWEInsh':
-                        index_image = img.expression(
-                                '(4 * (GREEN - SWIR1)) - ((0.25 * NIR)+(2.75 * SWIR2))', {
-                                    'NIR': img.select('nir'),
-                                    'GREEN': img.select('green'),
-                                    'SWIR1': img.select('swir1'),
-                                    'SWIR2': img.select('swir2')
-                                }).rename('waterIndex').copyProperties(img, ['system:time_start'])
-
-                    elif self.water_indices.value == 'AWEIsh':
-                        index_image = img.expression(
-                                '(BLUE + (2.5 * GREEN) - (1.5 * (NIR + SWIR1)) - (0.25 * SWIR2))', {
-                                    'BLUE':img.select('blue'),
-                                    'NIR': img.select('nir'),
-                                    'GREEN': img.select('green'),
-                                    'SWIR1': img.select('swir1'),
-                                    'SWIR2': img.select('swir2')
-                                }).rename('waterIndex').copyProperties(img, ['system:time_start'])
-
-                    return img.addBands(index_image)
-
-                def water_thresholding(img):
-                    # Compute threshold
-                    if self.threshold_dropdown.value == 'Simple': # Simple value no dynamic thresholding
-                        nd_threshold = self.threshold_value.value
-                        water_image = img.select('waterIndex').gt(nd_threshold).rename('water')\
-                        .copyProperties(img, ['system:time_start'])
-                    elif self.threshold_dropdown.value == 'Otsu':
-                        reducers = ee.Reducer.histogram(255,2).combine(reducer2=ee.Reducer.mean(), sharedInputs=True)\
-                            .combine(reducer2=ee.Reducer.variance(), sharedInputs= True)
-
-                        histogram = img.select('waterIndex').reduceRegion(
-                                        reducer=reducers,
-                                        geometry=self.site.geometry(),
-                                        scale=self.img_scale,
-                                        bestEffort=True)
-                        nd_threshold = otsu(histogram.get('waterIndex_histogram')) # get threshold from the nir band
-
-                        water_image = img.select('waterIndex').gt(nd_threshold).rename('water')  
-                        water_image = water_image.copyProperties(img, ['system:time_start'])
-
-                    return img.addBands(water_image)
-
-                # Function to extract water from SAR Sentinel 1 images
-                def add_S1_waterMask(band):
-                    """
-                    Function to extract surface water from Sentinel-1 images Otsu algorithm
-
-                    args:
-                        Image
-
-                    returns:
-                        Image with water mask
-                    """
-                    def wrap(img):
-                        reducers = ee.Reducer.histogram(255,2).combine(reducer2=ee.Reducer.mean(), sharedInputs=True)\
-                            .combine(reducer2=ee.Reducer.variance(), sharedInputs= True)
-                        histogram = img.select(band).reduceRegion(
-                        reducer=reducers,
-                        geometry=self.site.geometry(),
-                        scale=self.img_scale,
-                        bestEffort=True)
-
-                        # Calculate threshold via function otsu (see before)
-                        threshold = otsu(histogram.get(band+'_histogram'))
-
-                        # get watermask
-                        waterMask = img.select(band).lt(threshold).rename('water')
-                #             waterMask = waterMask.updateMask(waterMask) #Remove all pixels equal to 0
-                        return img.addBands(waterMask)
-                    return wrap
-
-                def maskDSWE_Water(img):
-                    nd_threshold = self.threshold_value.value+1
-                    waterImage = img.select('dswe').rename('water')
-                    water = waterImage.gt(0).And(waterImage.lt(nd_threshold)).copyProperties(img, ['system:time_start'])
-                    return img.addBands(water)
-                def mask_Water(img):
-                    waterMask = img.select('water').selfMask().rename('waterMask').copyProperties(img, ['system:time_start'])
-                    return img.addBands(waterMask)
-
-                if self.imageType == 'Sentinel-1':
-                    band = self.water_indices.value
-                    self.water_images = self.clipped_images.map(add_S1_waterMask(band))#.select('water')
-                    self.WaterMasks = self.water_images.map(mask_Water)
-                    # self.visParams = {'min': 0,'max': 1, 'palette': color_palette}
-                    self.Map.addLayer(self.WaterMasks.select('waterMask').max(), {'palette': color_palette}, 'Water')
-                elif self.imageType == 'Landsat-Collection 2':
-                    if self.water_indices.value == 'DSWE':
-                        dem = ee.Image('USGS/SRTMGL1_003')
-                        self.dswe_images = DSWE_2(self.filtered_landsat, dem, self.site)
-                            # Viz parameters: classes: 0, 1, 2, 3, 4, 9
-                        self.dswe_viz = {'min':0, 'max': 9, 'palette': ['000000', '002ba1', '6287ec', '77b800', 'c1bdb6', 
-                                                                    '000000', '000000', '000000', '000000', 'ffffff']}
-                        self.water_images = self.dswe_images.map(maskDSWE_Water)
-                        self.WaterMasks = self.water_images.map(mask_Water)
-    #                     Map.addLayer(dswe_images.max(), dswe_viz, 'DSWE')
-                    else:
-                        self.index_images = self.clipped_images.map(water_index)
-                        self.water_images = self.index_images.map(water_thresholding)
-                        self.WaterMasks = self.water_images.map(mask_Water)
-                    self.Map.addLayer(self.WaterMasks.select('waterMask').max(), {'palette': color_palette}, 'Water')
-
-                else:
-                    self.index_images = self.clipped_images.map(water_index)
-                    self.water_images = self.index_images.map(water_thresholding)
-                    self.WaterMasks = self.water_images.map(mask_Water)
-                    self.Map.addLayer(self.WaterMasks.select('waterMask').max(), {'palette': color_palette}, 'Water')
+                color_palette = self.index_color.value
+                self.pipeline.get('water')
+                self.Map.addLayer(self.display_clip(self.WaterMasks.select('waterMask').max()), {'palette': color_palette}, 'Water')
 
                 self.water_Frequency_button.disabled = False
+                self.hydroperiod_button.disabled = False
                 self.Depths_Button.disabled = False
                 self.elev_Methods.disabled = False
                 self.plot_button.disabled = False
@@ -901,42 +924,89 @@ class Toolbox:
                      print('An error occurred during computation.')
  
 
-    def calc_area(self, img):
+    def water_stage(self, images, water_index, threshold_method, threshold):
         """
-        Function to calculate area of water pixels
+        Pipeline stage extracting surface water from the processed images (see Water_Extraction)
 
         args:
-            Water mask image
+            Result of the images stage and the widget values the stage depends on
 
         returns:
-            Water image with calculated total area of water pixels
+            Empty dictionary; the water images and masks are kept on the toolbox
         """
-        global area_unit_symbol
-        unit = self.area_unit.value
-        divisor = 1
-        if unit =='Square Km':
-            divisor = 1e6
-            area_unit_symbol = 'Sq km'
-        elif unit =='Hectares':
-            divisor = 1e4
-            area_unit_symbol = 'Ha'
-        elif unit =='Square m':
-            divisor = 1
-            area_unit_symbol = 'Sq m'
-        else:
-            divisor = 4047
-            area_unit_symbol = 'acre'
-
-        pixel_area = img.select('waterMask').multiply(ee.Image.pixelArea()).divide(divisor)
-        img_area = pixel_area.reduceRegion(**{
-                            'geometry': self.site.geometry(),
-                            'reducer': ee.Reducer.sum(),
-                            'scale': self.img_scale,
-                            'maxPixels': 1e13
-                            })
-
-        return img.set({'water_area': img_area})
+        terrain = None
+        if self.imageType == 'Landsat-Collection 2' and water_index == 'DSWE':
+            terrain = get_terrain_layers('USGS/SRTMGL1_003', 'elevation', self.site, self.terrain_asset_root)
+        dswe_aoi = None if self.deferred_clip.value else self.site
+        water = extract_water(self.clipped_images, self.imageType, water_index, threshold_method, threshold, self.site,
+                              self.img_scale, landsat_images=self.filtered_landsat, terrain=terrain, plan=self.mosaic_plan,
+                              dswe_aoi=dswe_aoi)
+        self.water_images = water['water_images']
+        self.WaterMasks = water['WaterMasks']
+        if water['index_images'] is not None:
+            self.index_images = water['index_images']
+        if water['dswe_images'] is not None:
+            self.dswe_images = water['dswe_images']
+            # Viz parameters: classes: 0, 1, 2, 3, 4, 9
+            self.dswe_viz = {'min':0, 'max': 9, 'palette': ['000000', '002ba1', '6287ec', '77b800', 'c1bdb6', 
+                                                        '000000', '000000', '000000', '000000', 'ffffff']}
+        return {}
+
+    def water_params(self, depth=False):
+        """
+        Function to collect the settings that determine the water masks, for matching stored time series
+
+        args:
+            depth: Whether to include the depth estimation settings
+
+        returns:
+            Dictionary of the image, water extraction and depth settings
+        """
+        params = {'platform': self.imageType, 'cloud_threshold': self.cloud_threshold.value,
+                  'clear_threshold': self.clear_threshold.value, 'speckle_filter': self.filter_dropdown.value,
+                  'water_index': self.water_indices.value, 'threshold_method': self.threshold_dropdown.value,
+                  'threshold': self.threshold_value.value, 'scale': self.img_scale}
+        if depth:
+            params.update({'depth_method': self.elev_Methods.value, 'dem': self.elevData_options.value,
+                           'user_dem': self.userDEM.value})
+        return params
     
+    def areas_stage(self, water, incremental_update):
+        """
+        Pipeline stage computing the water area of each water mask (see plot_areas)
+
+        args:
+            Result of the water stage and the widget values the stage depends on
+
+        returns:
+            Dictionary of the area DataFrame (square meters), dates and configuration hash of the series
+        """
+        config = pipeline_config_hash(self.water_params())
+        if incremental_update:
+            # Compute only the dates missing from the stored series, then read back the whole series
+            if self.timeseries_store is None:
+                self.timeseries_store = TimeSeriesStore()
+            series, new_dates = update_area_series(self.timeseries_store, self.site_key, self.water_params(),
+                                                   self.WaterMasks, self.site, self.img_scale)
+            series = series[(series['Date'] >= self.start_date.value.strftime('%Y-%m-%d'))
+                            & (series['Date'] < self.end_date.value.strftime('%Y-%m-%d'))]
+            areas = pd.DataFrame({'Date': series['Date'], 'Area': series['Area']}).reset_index(drop=True)
+            print(f'Incremental update: {new_dates} dates computed, {len(areas)} dates in series')
+            return {'df': areas, 'dates': areas['Date'].dt.strftime('%Y-%m-%d').tolist(),
+                    'config': config}
+
+        # Compute water areas
+        water_areas = self.WaterMasks.map(water_area_function(self.site, self.img_scale))
+        water_stats = get_info(water_areas.aggregate_array('water_area'))
+
+        dates = get_info(self.WaterMasks.aggregate_array('system:time_start')
+                         .map(lambda d: ee.Date(d).format('YYYY-MM-dd')))
+
+        dates_lst = [datetime.strptime(i, '%Y-%m-%d') for i in dates]
+        y = [item.get('waterMask') for item in water_stats]
+        return {'df': pd.DataFrame(list(zip(dates_lst,y)), columns=['Date','Area']), 'dates': dates,
+                'config': config}
+
     def plot_areas(self, b):
         """
         Function to plot a time series of calculated water area for each water image
@@ -953,17 +1023,15 @@ class Toolbox:
             try:
                 global df
                 global save_water_data
+                global area_unit_symbol
+                global series_config
                 save_water_data = 1
-                # Compute water areas
-                water_areas = self.WaterMasks.map(self.calc_area)
-                water_stats = water_areas.aggregate_array('water_area').getInfo()
-
-                self.dates = self.WaterMasks.aggregate_array('system:time_start')\
-                    .map(lambda d: ee.Date(d).format('YYYY-MM-dd')).getInfo()
-
-                dates_lst = [datetime.strptime(i, '%Y-%m-%d') for i in self.dates]
-                y = [item.get('waterMask') for item in water_stats]
-                df = pd.DataFrame(list(zip(dates_lst,y)), columns=['Date','Area'])
+                # Recomputed only if the areas or an upstream stage were invalidated
+                areas = self.pipeline.get('areas')
+                divisor, area_unit_symbol = area_units[self.area_unit.value]
+                df = areas['df'].assign(Area=areas['df']['Area'] / divisor)
+                series_config = areas['config']
+                self.dates = areas['dates']
 
                 self.fig.data = []
 
@@ -994,14 +1062,14 @@ class Toolbox:
                     global selected_sat
                     date = df['Date'].iloc[points.point_inds].values[0]
                     date = pd.to_datetime(str(date))
-                    selected_image = self.WaterMasks.closest(date).first()
+                    selected_image = self.plan_image(self.WaterMasks, date)
                     wImage = selected_image.select('waterMask')
-                    self.Map.addLayer(selected_image, self.visParams, self.imageType)
+                    self.Map.addLayer(self.display_clip(selected_image), self.visParams, self.imageType)
                     if self.water_indices.value == 'DSWE':
-                        selected_DWSE = self.dswe_images.closest(date).first()
-                        self.Map.addLayer(selected_DWSE.select('dswe'), self.dswe_viz, 'DSWE')
+                        selected_DWSE = self.plan_image(self.dswe_images, date)
+                        self.Map.addLayer(self.display_clip(selected_DWSE.select('dswe')), self.dswe_viz, 'DSWE')
 #                         Map.addLayer(wImage, {'palette': color_palette}, 'Water')
-                    self.Map.addLayer(wImage, {'palette': color_palette}, 'Water')
+                    self.Map.addLayer(self.display_clip(wImage), {'palette': color_palette}, 'Water')
 
                 scatter.on_click(update_point)
 
@@ -1012,7 +1080,7 @@ class Toolbox:
 
     def save_data(self, b):
         """
-        Function to save time series to CSV file
+        Function to save time series to the time-series store and export them to CSV
         args:
             None
 
@@ -1022,32 +1090,153 @@ class Toolbox:
         with self.feedback:
             self.feedback.clear_output()
             try:
+                # Keep the series in the time-series store under the configuration it was computed with;
+                # CSV is written only when a file is selected
+                if self.timeseries_store is None:
+                    self.timeseries_store = TimeSeriesStore()
+                filename = self.file_selector1.selected
                 if save_water_data==1:
-                    filename = self.file_selector1.selected
-                    water_df = df
-                    water_df = water_df.rename(columns={'Area':'Area, '+area_unit_symbol})
-                    water_df.to_csv(filename, index=False)
+                    divisor = {symbol: d for d, symbol in area_units.values()}[area_unit_symbol]
+                    self.timeseries_store.append(self.site_key, self.imageType, 'area', series_config,
+                                                 df['Date'], df['Area'] * divisor)
+                    if filename:
+                        water_df = df
+                        water_df = water_df.rename(columns={'Area':'Area, '+area_unit_symbol})
+                        water_df.to_csv(filename, index=False)
                 elif save_water_data==2:
-                    filename = self.file_selector1.selected
-                    volume_df = vol_df
-                    volume_df = volume_df.rename(columns={'Volume':'Volume, '+vol_unit_symbol})
-                    volume_df.to_csv(filename, index=False)
+                    multiplier = {symbol: m for m, symbol in volume_units.values()}[vol_unit_symbol]
+                    self.timeseries_store.append(self.site_key, self.imageType, 'volume', series_config,
+                                                 vol_df['Date'], vol_df['Volume'] / multiplier)
+                    if filename:
+                        volume_df = vol_df
+                        volume_df = volume_df.rename(columns={'Volume':'Volume, '+vol_unit_symbol})
+                        volume_df.to_csv(filename, index=False)
                 elif save_water_data==3:
-                    filename = self.file_selector1.selected
-                    filtered_df = depths_df.drop(columns=['reducer'])
-                    filtered_df = filtered_df[['date','Depth']]
-                    filtered_df = filtered_df.rename(columns={'Depth':'Depth, m'})
-                    filtered_df.to_csv(filename, index=False)
+                    self.timeseries_store.append(self.site_key, self.imageType, 'depth', series_config,
+                                                 depths_df['date'], depths_df['Depth'], location=self.depth_location)
+                    if filename:
+                        filtered_df = depths_df.drop(columns=['reducer'])
+                        filtered_df = filtered_df[['date','Depth']]
+                        filtered_df = filtered_df.rename(columns={'Depth':'Depth, m'})
+                        filtered_df.to_csv(filename, index=False)
+                elif save_water_data==4:
+                    for gauge in gauge_depths_df.columns:
+                        self.timeseries_store.append(self.site_key, self.imageType, 'depth', series_config,
+                                                     gauge_depths_df.index, gauge_depths_df[gauge], location=str(gauge))
+                    if filename:
+                        # One column of depths (m) per gauge
+                        gauge_depths_df.to_csv(filename, index_label='date')
 
             except Exception as e:
                     print(e)
                     print('Data save error')
 
 
+    def save_session(self, b):
+        """
+        Function to save the session to a compressed file: widget values, the Earth Engine expressions
+        of the built collections, computed values and DataFrames. Nothing is evaluated on the server.
+
+        args:
+            None
+
+        returns:
+            None
+        """
+        with self.feedback:
+            self.feedback.clear_output()
+            try:
+                filename = self.session_selector.selected
+                widgets = {name: w.value for name, w in vars(self).items() if isinstance(w, ipw.ValueWidget)}
+                buttons = {name: w.disabled for name, w in vars(self).items() if isinstance(w, ipw.Button)}
+                module_globals = globals()
+                session = {'version': session_version,
+                           'widgets': widgets,
+                           'buttons': buttons,
+                           'ee_objects': serialize_ee_objects({name: getattr(self, name) for name in session_ee_attributes}),
+                           'ee_globals': serialize_ee_objects({name: module_globals.get(name) for name in session_ee_globals}),
+                           'attributes': {name: getattr(self, name) for name in session_attributes},
+                           'globals': {name: module_globals[name] for name in session_globals if name in module_globals},
+                           'pipeline': self.pipeline.state(),
+                           'figure': self.fig.to_dict()}
+                with gzip.open(filename, 'wb') as f:
+                    pickle.dump(session, f, protocol=pickle.HIGHEST_PROTOCOL)
+                print(f'Session saved to {filename} ({os.path.getsize(filename)/1024:.0f} KB)')
+
+            except Exception as e:
+                    print(e)
+                    print('Session could not be saved')
+
+    def load_session(self, b):
+        """
+        Function to restore a session saved with save_session; collections are rebuilt from their
+        serialized expressions, so no stage has to be rerun. Plot click-throughs need replotting.
+
+        args:
+            None
+
+        returns:
+            None
+        """
+        with self.feedback:
+            self.feedback.clear_output()
+            try:
+                filename = self.session_selector.selected
+                with gzip.open(filename, 'rb') as f:
+                    session = pickle.load(f)
+                if session.get('version') != session_version:
+                    raise ValueError(f"Unsupported session file version: {session.get('version')}")
+
+                # Widgets first, their observers reset parameters that the saved attributes then override
+                for name, value in session['widgets'].items():
+                    widget = getattr(self, name, None)
+                    if isinstance(widget, ipw.ValueWidget):
+                        try:
+                            widget.value = value
+                        except Exception:
+                            pass # options of the widget not available in this session
+                for name, value in session['attributes'].items():
+                    setattr(self, name, value)
+                if 'pipeline' in session:
+                    self.pipeline.restore(session['pipeline'])
+                for name, obj in deserialize_ee_objects(session['ee_objects']).items():
+                    setattr(self, name, obj)
+                globals().update(session['globals'])
+                globals().update(deserialize_ee_objects(session['ee_globals']))
+                for name, disabled in session['buttons'].items():
+                    if isinstance(getattr(self, name, None), ipw.Button):
+                        getattr(self, name).disabled = disabled
+
+                if self.file_list is not None:
+                    self.lst_files.options = self.file_list
+
+                self.fig.data = []
+                self.fig.add_traces(session['figure'].get('data', []))
+                self.fig.update_layout(session['figure'].get('layout', {}))
+
+                # Map layers of the completed stages
+                if self.site is not None:
+                    self.Map.addLayer(self.site, {}, 'AOI')
+                    self.Map.center_object(self.site)
+                if self.clipped_images is not None:
+                    self.Map.addLayer(self.display_clip(self.clipped_images.first()), self.visParams, self.imageType)
+                if self.WaterMasks is not None:
+                    self.Map.addLayer(self.display_clip(self.WaterMasks.select('waterMask').max()),
+                                      {'palette': self.index_color.value}, 'Water')
+                if self.depth_maps is not None and self.depthParams is not None:
+                    self.Map.addLayer(self.display_clip(self.depth_maps.select('Depth').max()), self.depthParams, 'Depth')
+                print(f'Session restored from {filename}')
+
+            except Exception as e:
+                    print(e)
+                    print('Session could not be restored')
+
     def dowload_images(self, b):
         with self.feedback:
             self.feedback.clear_output()
             try:
+                # Bring the products to download up to date with the current parameters
+                self.pipeline.get({0: 'images', 3: 'depths'}.get(self.files_to_download.index, 'water'))
                 path = self.folder_selector.selected_path
                 folder = self.folder_name.value
                 name_Pattern = '{sat}_{system_date}_{imgType}'
@@ -1057,7 +1246,8 @@ class Toolbox:
                     download_images = self.clipped_images
                     extra = dict(sat=self.imageType, imgType = 'Satellite')
                 elif self.files_to_download.index == 1:
-                    download_images = self.WaterMasks.select('waterMask')
+                    # The compact profile keeps dry (0) and unobserved (nodata) pixels apart, so it exports the water band
+                    download_images = self.WaterMasks.select('water' if self.compact_export.value else 'waterMask')
                     extra = dict(sat=self.imageType, imgType = 'Water')
                 elif self.files_to_download.index == 2:
                     download_images = ee.ImageCollection([water_occurence])
@@ -1067,26 +1257,83 @@ class Toolbox:
                 elif self.files_to_download.index == 3:
                     download_images = self.depth_maps
                     extra = dict(sat=self.imageType, imgType = 'Depth')
-                else:
+                elif self.files_to_download.index == 4:
                     download_images = self.dswe_images
                     extra = dict(sat=self.imageType, imgType = 'DSWE')
+                elif self.files_to_download.index == 5:
+                    download_images = ee.ImageCollection([self.hydroperiod_image])
+                    name_Pattern = '{sat}_{start}_{end}_{imgType}'
+                    extra = dict(sat=self.imageType, imgType = 'Hydroperiod', start=self.start_date.value.strftime("%x"),
+                                 end=self.end_date.value.strftime("%x"))
+                else:
+                    # Water band with unobserved pixels set to 255, packed into a time cube after download
+                    download_images = self.water_images.map(lambda img: self.display_clip(img).select('water').unmask(255)
+                                                            .toUint8().copyProperties(img, ['system:time_start']))
+                    extra = dict(sat=self.imageType, imgType = 'Water')
 
-                if self.download_location.index == 0:
-                    task = geetools.batch.Export.imagecollection.toDrive(
-                        collection = download_images,
-                        folder = folder,
-                        region = self.site.geometry(),
-                        namePattern = name_Pattern,
-                        scale = self.img_scale,
-                        datePattern=date_pattern,
-                        extra = extra,
-                        verbose=True,
-                        maxPixels = int(1e13))
-                    task
+                if self.deferred_clip.value and self.files_to_download.index != 6:
+                    download_images = download_images.map(self.clipImages)
+
+                profile = None
+                if self.compact_export.value and self.files_to_download.index != 6:
+                    profile = export_profile(extra['imgType'], self.imageType)
+                    report = export_profile_report(ee.Image(download_images.first()), profile,
+                                                   self.site.geometry(), self.img_scale)
+                    print(f"Compact {extra['imgType']} export: {report['profiled_bytes']/1e6:.1f} MB instead of "
+                          f"{report['original_bytes']/1e6:.1f} MB per image ({report['saving_percent']:.0f}% smaller)")
+
+                if self.files_to_download.index == 6:
+                    # The cube is packed from local GeoTIFFs: download into a fresh folder and pack exactly those files
+                    if self.download_location.index != 1:
+                        raise ValueError('The water cube is built from local downloads; select Local Disk')
+                    masks_dir = tempfile.mkdtemp(prefix='.water_masks_', dir=path)
+                    try:
+                        mask_files = export_image_collection_to_local(download_images, masks_dir, name_Pattern, date_pattern,
+                                                                      extra, self.img_scale, region=self.site, strict=True)
+                        if not mask_files:
+                            raise ValueError('No water images to pack into a cube')
+                        water_cube_from_files(mask_files, os.path.join(path, 'water_cube'))
+                    finally:
+                        shutil.rmtree(masks_dir, ignore_errors=True)
+                elif self.download_location.index == 0:
+                    dataType = 'float32'
+                    formatOptions = None
+                    if profile is not None:
+                        download_images = download_images.map(lambda img: apply_export_profile(img, profile))
+                        dataType = profile['dtype']
+                        formatOptions = {'noData': profile['nodata']}
+                    jobs = drive_export_jobs(download_images, folder, self.site.geometry(), self.img_scale, name_Pattern,
+                                             date_pattern, extra, dtype=dataType, formatOptions=formatOptions)
+                    # Same folder and product reuse the manifest: completed images are skipped, started tasks resumed
+                    manifest = os.path.join(export_manifest_dir, f"{folder}_{extra['sat']}_{extra['imgType']}.json")
+                    scheduler = ExportScheduler(manifest, max_concurrent=self.max_export_tasks)
+
+                    def report(counts):
+                        with self.feedback:
+                            print('Export tasks: ' + ', '.join(f'{n} {state.lower()}' for state, n in counts.items()))
+
+                    def report_error(e):
+                        with self.feedback:
+                            print(f'Export scheduling stopped: {e}')
+                            print(f'Rerun the download to resume from the manifest {manifest}')
+
+                    scheduler.start(jobs, on_update=report, on_error=report_error)
+                    print(f'{len(jobs)} export tasks scheduled, at most {self.max_export_tasks} at a time')
+                elif self.download_location.index == 2:
+                    # Single chunked (time, y, x) store; rerunning appends only the new dates
+                    store = os.path.join(path, f"{extra['sat']}_{extra['imgType']}.zarr")
+                    if profile is None:
+                        export_image_collection_to_zarr(download_images, store, self.img_scale, self.site)
+                    else:
+                        export_image_collection_to_zarr(download_images.map(lambda img: apply_export_profile(img, profile)),
+                                                        store, self.img_scale, self.site,
+                                                        dtype=profile['dtype'], nodata=profile['nodata'])
                 else:
-                    export_image_collection_to_local(download_images,path,name_Pattern,date_pattern,extra,self.img_scale,region=self.site)
+                    export_image_collection_to_local(download_images,path,name_Pattern,date_pattern,extra,self.img_scale,
+                                                     region=self.site,profile=profile)
 
-                print('Download complete!!')
+                if self.download_location.index != 0:
+                    print('Download complete!!')
 
             except Exception as e:
                     print(e)
@@ -1098,12 +1345,26 @@ class Toolbox:
             try:
                 global water_frequency
                 global water_occurence
-                water_occurence =  self.water_images.select('water').reduce(ee.Reducer.sum())
-                water_frequency = water_occurence.divide(self.water_images.size()).multiply(100)
+                self.pipeline.get('water') # recompute if a water parameter changed since extraction
                 Max_Water_Map = self.WaterMasks.select('waterMask').max()
-                water_frequency = water_frequency.updateMask(Max_Water_Map)
                 self.freqParams = {'min':0, 'max':100, 'palette': ['white','lightblue','blue','darkblue']}
-                self.Map.addLayer(water_frequency, self.freqParams, 'Water Frequency')
+                grouping = self.frequency_grouping.value
+                if grouping == 'Whole period':
+                    water_count =  self.water_images.select('water').reduce(ee.Reducer.sum())
+                    water_frequency = water_count.divide(self.water_images.size()).multiply(100)
+                    water_frequency = water_frequency.updateMask(Max_Water_Map)
+                    water_occurence = water_frequency # downloaded as frequency (%), as the grouped frequencies
+                    self.Map.addLayer(self.display_clip(water_frequency), self.freqParams, 'Water Frequency')
+                else:
+                    # One band per month/season/year; the multi-band image is also what gets downloaded
+                    water_frequency = grouped_water_frequency(self.water_images, grouping,
+                                                              self.start_date.value, self.end_date.value)
+                    water_frequency = water_frequency.updateMask(Max_Water_Map)
+                    water_occurence = water_frequency
+                    _, names = frequency_groups(grouping, self.start_date.value, self.end_date.value)
+                    for i, name in enumerate(names):
+                        self.Map.addLayer(self.display_clip(water_frequency.select(name)), self.freqParams, 'Water Frequency '+name,
+                                          i == 0)
 
                 colors = self.freqParams['palette']
                 vmin = self.freqParams['min']
@@ -1114,6 +1375,31 @@ class Toolbox:
                         print(e)
                         print('Frequency computation could not be completed')
 
+    def compute_hydroperiod(self, b):
+        """
+        Function to compute per-pixel inundated days, longest wet run and first/last wet dates
+
+        args:
+            None
+
+        returns:
+            None
+        """
+        with self.feedback:
+            self.feedback.clear_output()
+            try:
+                self.pipeline.get('water') # recompute if a water parameter changed since extraction
+                self.hydroperiod_image = hydroperiod(self.water_images)
+                total_days = (self.end_date.value - self.start_date.value).days
+                hydroParams = {'min':0, 'max':total_days, 'palette': ['white','lightblue','blue','darkblue']}
+                self.Map.addLayer(self.display_clip(self.hydroperiod_image.select('inundated_days')), hydroParams, 'Inundated Days')
+                self.Map.addLayer(self.display_clip(self.hydroperiod_image.select('longest_wet_run')), hydroParams, 'Longest Wet Run', False)
+                self.Map.add_colorbar_branca(colors=hydroParams['palette'], vmin=0, vmax=total_days,
+                                             layer_name='Inundated Days')
+            except Exception as e:
+                        print(e)
+                        print('Hydroperiod computation could not be completed')
+
     def get_dates(self, col):
         dates = ee.List(col.toList(col.size()).map(lambda img: ee.Image(img).date().format()))
         return dates
@@ -1123,58 +1409,66 @@ class Toolbox:
         count = img.select('waterMask').reduceRegion(ee.Reducer.sum(), self.site).values().get(0)
         return img.set({'pixel_count': count})
 
-    def calc_depths(self, b):
+    def export_terrain(self, b):
+        """
+        Function to export the terrain layers of the study area to the terrain asset folder, for DSWE, slope
+        correction and the selected elevation dataset; later runs read the assets instead of building the layers
+
+        args:
+            None
+
+        returns:
+            None
+        """
         with self.feedback:
             self.feedback.clear_output()
             try:
+                if self.terrain_asset_root is None:
+                    raise ValueError('Enter a terrain asset folder, e.g. users/<name>/terrain')
+                if self.site is None:
+                    raise ValueError('Process images first to define the study area')
+                sources = [('USGS/SRTMGL1_003', 'elevation'), dem_source(self.elevData_options.value, self.userDEM.value)]
+                for demSource, band in dict.fromkeys(sources):
+                    task = export_terrain_layers(demSource, band, self.site, self.terrain_asset_root)
+                    print(f'Exporting {demSource} terrain layers to '
+                          f'{terrain_asset_id(demSource, band, self.site, self.terrain_asset_root)} (task {task.id})')
 
-                if self.elevData_options.value =='NED':
-                    demSource = 'USGS/NED'
-                    band = 'elevation'
-                elif self.elevData_options.value =='SRTM':
-                    demSource = 'USGS/SRTMGL1_003'
-                    band = 'elevation'
-                else:
-                    demSource = str(self.userDEM.value)
-                    band = 'b1'
+            except Exception as e:
+                    print(e)
 
-                dem = ee.Image(demSource).select(band).clip(self.site)
+    def depths_stage(self, water, depth_method, dem, user_dem):
+        """
+        Pipeline stage estimating water depths from the water masks (see calc_depths)
 
-                # get water pixel count per image
-                countImages = self.WaterMasks.map(self.CountWaterPixels)
+        args:
+            Result of the water stage and the widget values the stage depends on
 
-                # Filter out only images containing water pixels to avoid error in depth estimation
-                self.filtered_Water_Images = countImages.filter(ee.Filter.gt('pixel_count', 0))
-                
-                if self.elev_Methods.value == 'Random Forest':
-                    if self.rf_ee_classifier is not None:
-                        collection_with_depth_variables = self.WaterMasks.map(add_depth_variables)
-                        self.depth_maps = collection_with_depth_variables.map(RF_Depth_Estimate(self.rf_ee_classifier))
-                    else:
-                        filename = 'ML_models/Landsat_RF_model.sav'
-                        feature_names = ['mod_green','mod_swir1']
-                        loaded_model = pickle.load(open(filename, 'rb'))
-                        trees =  ml.rf_to_strings(loaded_model,feature_names)
-                        self.rf_ee_classifier = ml.strings_to_classifier(trees)
-                        collection_with_depth_variables = self.WaterMasks.map(add_depth_variables)
-                        self.depth_maps = collection_with_depth_variables.map(RF_Depth_Estimate(self.rf_ee_classifier))
-                elif self.elev_Methods.value == 'Mod_Stumpf':
-                    collection_with_depth_variables = self.WaterMasks.map(add_depth_variables)
-                    self.depth_maps = collection_with_depth_variables.map(Mod_Stumpf_Depth_Estimate)
-                elif self.elev_Methods.value == 'Mod_Lyzenga':
-                    collection_with_depth_variables = self.WaterMasks.map(add_depth_variables)
-                    self.depth_maps = collection_with_depth_variables.map(Mod_Lyzenga_Depth_Estimate)
-                elif self.elev_Methods.value == 'FwDET':
-                    self.depth_maps = self.filtered_Water_Images.map(FwDET_Depth_Estimate(dem))
-                else:
-                    self.depth_maps = self.filtered_Water_Images.map(estimateDepths_FromDEM(dem, self.site, self.img_scale))
+        returns:
+            Dictionary of the fetched maximum depth and configuration hash of the depth maps
+        """
+        demSource, band = dem_source(dem, user_dem)
 
-                max_depth_map = self.depth_maps.select('Depth').max()
-                maxVal = max_depth_map.reduceRegion(ee.Reducer.max(),self.site, self.img_scale).values().get(0).getInfo()
+        # Terrain layers cover the bounding box of the study area; depths are estimated inside the study area only
+        elevation = get_terrain_layers(demSource, band, self.site, self.terrain_asset_root).select('elevation').clip(self.site)
+
+        self.depth_maps, self.rf_ee_classifier = depth_estimates(self.WaterMasks, depth_method, elevation,
+                                                                 self.site, self.img_scale, self.rf_ee_classifier)
+
+        max_depth_map = self.depth_maps.select('Depth').max()
+        maxVal = get_info(max_depth_map.reduceRegion(ee.Reducer.max(),self.site, self.img_scale).values().get(0))
+
+        self.depthParams = {'min':0, 'max':round(maxVal,1), 'palette': ['1400f7','00f4e8','f4f000','f40000','960424']}
+        #['006633', 'E5FFCC', '662A00', 'D8D8D8', 'F5F5F5']
+        return {'max_depth': maxVal, 'config': pipeline_config_hash(self.water_params(depth=True))}
+
+    def calc_depths(self, b):
+        with self.feedback:
+            self.feedback.clear_output()
+            try:
 
-                self.depthParams = {'min':0, 'max':round(maxVal,1), 'palette': ['1400f7','00f4e8','f4f000','f40000','960424']}
-                #['006633', 'E5FFCC', '662A00', 'D8D8D8', 'F5F5F5']
-                self.Map.addLayer(max_depth_map, self.depthParams, 'Depth')
+                maxVal = self.pipeline.get('depths')['max_depth']
+                max_depth_map = self.depth_maps.select('Depth').max()
+                self.Map.addLayer(self.display_clip(max_depth_map), self.depthParams, 'Depth')
                 colors = self.depthParams['palette']
                 self.Map.add_colorbar_branca(colors=colors, vmin=0, vmax=round(maxVal,1), layer_name='Depth')
                 self.depth_plot_button.disabled = False # enable depth plotting
@@ -1183,48 +1477,42 @@ class Toolbox:
             except Exception as e:
                     print(e)
                     
-    def calc_volume(self, img):
-        global vol_unit_symbol
-        unit = self.vol_unit.value
-        multiplier = 1
-        if unit =='Cubic m':
-            multiplier = 1
-            vol_unit_symbol = 'cu m'
-        elif unit =='Cubic ft':
-            multiplier = 35.3147
-            vol_unit_symbol = 'cu ft'
-        elif unit =='Litres':
-            multiplier = 1e3
-            vol_unit_symbol = 'litres'
-        else:
-            multiplier = 1.0/1233
-            vol_unit_symbol = 'ac-ft'
-        depth = img.select('Depth')
-        volume = depth.multiply(ee.Image.pixelArea()).multiply(multiplier)
-        total_volume = volume.reduceRegion(**{
-                        'reducer':ee.Reducer.sum(),
-                        'geometry':self.site.geometry(),
-                        'scale':self.img_scale,
-                        'maxPixels':1e13})
-        return img.set({'volume':total_volume})
-    
+    def volumes_stage(self, depths):
+        """
+        Pipeline stage computing the water volume of each depth map (see plot_volumes)
+
+        args:
+            Result of the depths stage
+
+        returns:
+            Dictionary of the volume DataFrame (cubic meters), dates and configuration hash of the series
+        """
+        water_volumes = self.depth_maps.map(water_volume_function(self.site, self.img_scale))
+        volume_stats = get_info(water_volumes.aggregate_array('volume'))
+
+        dates = get_info(self.depth_maps.aggregate_array('system:time_start')
+                         .map(lambda d: ee.Date(d).format('YYYY-MM-dd')))
+
+        dates_lst = [datetime.strptime(i, '%Y-%m-%d') for i in dates]
+        y = [item.get('Depth') for item in volume_stats]
+        return {'df': pd.DataFrame(list(zip(dates_lst,y)), columns=['Date','Volume']), 'dates': dates,
+                'config': depths['config']}
+
     def plot_volumes(self, b):
         with self.feedback:
             self.feedback.clear_output()
             try:
                 global vol_df
                 global save_water_data
+                global vol_unit_symbol
+                global series_config
                 save_water_data = 2
-                # Compute water areas
-                water_volumes = self.depth_maps.map(self.calc_volume)
-                volume_stats = water_volumes.aggregate_array('volume').getInfo()
-
-                self.dates = self.depth_maps.aggregate_array('system:time_start')\
-                    .map(lambda d: ee.Date(d).format('YYYY-MM-dd')).getInfo()
-
-                dates_lst = [datetime.strptime(i, '%Y-%m-%d') for i in self.dates]
-                y = [item.get('Depth') for item in volume_stats]
-                vol_df = pd.DataFrame(list(zip(dates_lst,y)), columns=['Date','Volume'])
+                # Recomputed only if the volumes or an upstream stage were invalidated
+                volumes = self.pipeline.get('volumes')
+                multiplier, vol_unit_symbol = volume_units[self.vol_unit.value]
+                vol_df = volumes['df'].assign(Volume=volumes['df']['Volume'] * multiplier)
+                series_config = volumes['config']
+                self.dates = volumes['dates']
 
                 self.fig.data = []
 
@@ -1258,9 +1546,9 @@ class Toolbox:
                     selected_image = self.depth_maps.closest(date)
                     wImage = selected_image.select('waterMask')
                     depthImage = selected_image.select('Depth')
-                    self.Map.addLayer(selected_image, self.visParams, self.imageType)
-                    self.Map.addLayer(wImage, {'palette': color_palette}, 'Water')
-                    self.Map.addLayer(depthImage, self.depthParams, 'Depth')
+                    self.Map.addLayer(self.display_clip(selected_image), self.visParams, self.imageType)
+                    self.Map.addLayer(self.display_clip(wImage), {'palette': color_palette}, 'Water')
+                    self.Map.addLayer(self.display_clip(depthImage), self.depthParams, 'Depth')
 
                 scatter.on_click(update_point)
 
@@ -1274,22 +1562,32 @@ class Toolbox:
             try: 
                 global depths_df
                 global save_water_data
+                global series_config
+                # Recompute if a depth parameter changed since estimation
+                series_config = self.pipeline.get('depths')['config']
+                if self.point_preference.index == 2:
+                    self.plot_gauge_depths()
+                    return
                 save_water_data = 3
                 if self.point_preference.index == 0:
                     point = ee.FeatureCollection(self.Map.draw_last_feature)
+                    xy = get_info(self.Map.draw_last_feature.geometry().coordinates())
+                    floated_xy = [round(float(i), 6) for i in xy]
                 else:
                     coordinates = self.coordinates_textbox.value
                     xy = coordinates.split(',')
                     floated_xy = [float(i) for i in xy]
                     point = ee.Geometry.Point(floated_xy)
                     self.Map.addLayer(point, {}, 'Depth Point')
+                # Long, Lat of the point, the location of its series in the time-series store
+                self.depth_location = ','.join(str(i) for i in floated_xy)
 
                 ts_1 = self.depth_maps.getTimeSeriesByRegion(geometry = point,
                                           bands = ['Depth'],
                                           reducer = [ee.Reducer.mean()],
                                           scale = self.img_scale)
 
-                depths_df = geemap.ee_to_pandas(ts_1)
+                depths_df = governor.call('ee_to_pandas', geemap.ee_to_pandas, ts_1)
                 depths_df[depths_df == -9999] = np.nan
                 depths_df = depths_df.fillna(0)
                 depths_df['date'] = pd.to_datetime(depths_df['date'],infer_datetime_format = True)
@@ -1326,12 +1624,61 @@ class Toolbox:
                     wImage = selected_image.select('waterMask')
 #                     selected_sat = clipped_images.closest(date).first()
                     depthImage = selected_image.select('Depth')
-                    self.Map.addLayer(selected_image, self.visParams, self.imageType)
-                    self.Map.addLayer(wImage, {'palette': color_palette}, 'Water')
-                    self.Map.addLayer(depthImage, self.depthParams, 'Depth')
+                    self.Map.addLayer(self.display_clip(selected_image), self.visParams, self.imageType)
+                    self.Map.addLayer(self.display_clip(wImage), {'palette': color_palette}, 'Water')
+                    self.Map.addLayer(self.display_clip(depthImage), self.depthParams, 'Depth')
 
                 scatter.on_click(update_point)
 
             except Exception as e:
                 print(e)
                 print('Please draw a point or enter coordinates')
+
+    def plot_gauge_depths(self):
+        """
+        Function to plot depth hydrographs of all uploaded gauge points
+
+        args:
+            None
+
+        returns:
+            None
+        """
+        global gauge_depths_df
+        global save_water_data
+        save_water_data = 4
+        points = gauge_points(self.point_selector.selected)
+        self.Map.addLayer(points, {}, 'Gauges')
+
+        gauge_depths_df = depth_hydrographs(self.depth_maps, points, self.img_scale,
+                                            self.start_date.value, self.end_date.value)
+        gauge_depths_df = gauge_depths_df.fillna(0)
+
+        self.fig.data = []
+        for gauge in gauge_depths_df.columns:
+            self.fig.add_trace(go.Scatter(x=gauge_depths_df.index, y=gauge_depths_df[gauge], name=str(gauge),
+                        mode='lines+markers', line=dict(dash = 'solid', width = 0.5)))
+
+        self.fig.layout.yaxis.title = '<b>Depth (m)<b>'
+        self.fig.layout.title = '<b>Water Depth Hydrographs<b>'
+        self.fig.layout.titlefont = dict(family="Arial",size=24)
+        self.fig.layout.title.x = 0.5
+        self.fig.layout.title.y = 0.9
+
+        self.lbl_Max_Depth.value = str(round(gauge_depths_df.values.max(), 3))
+        self.lbl_Min_Depth.value = str(round(gauge_depths_df.values.min(), 3))
+        self.lbl_Avg_Depth.value = str(round(gauge_depths_df.values.mean(), 3))
+
+        color_palette = self.index_color.value
+
+        # Function to show the depth map of a date on clicking any hydrograph
+        def update_point(trace, points, selector):
+            if not points.point_inds:
+                return
+            date = pd.to_datetime(str(gauge_depths_df.index[points.point_inds[0]]))
+            selected_image = self.depth_maps.closest(date)
+            self.Map.addLayer(self.display_clip(selected_image.select('waterMask')), {'palette': color_palette}, 'Water')
+            self.Map.addLayer(self.display_clip(selected_image.select('Depth')), self.depthParams, 'Depth')
+
+        for scatter in self.fig.data:
+            scatter.on_click(update_point)
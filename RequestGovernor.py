@@ -0,0 +1,145 @@
+import time
+import random
+import socket
+import threading
+from urllib.error import HTTPError, URLError
+
+# Error message fragments of Earth Engine quota and rate limit errors
+throttle_markers = ['too many concurrent', 'too many requests', 'rate limit', 'quota exceeded', 'resource exhausted']
+
+# Error message fragments of transient server and network errors
+transient_markers = ['internal error', 'service unavailable', 'backend error', 'deadline exceeded', 'bad gateway',
+                     'gateway timeout', 'connection reset', 'connection aborted', 'temporarily unavailable']
+
+def classify_error(e):
+    """Classifies an exception of a network call
+    Args:
+        e (Exception): Exception raised by the call
+    Returns:
+        str: 'throttle' (quota or rate limit, retry with less concurrency), 'transient' (retry) or 'fatal' (do not retry)
+    """
+    code = getattr(e, 'code', None) if isinstance(e, HTTPError) else getattr(getattr(e, 'resp', None), 'status', None)
+    if code is not None:
+        code = int(code)
+        if code == 429:
+            return 'throttle'
+        if code in [500, 502, 503, 504]:
+            return 'transient'
+        return 'fatal'
+    if isinstance(e, (ConnectionError, TimeoutError, socket.timeout, URLError)):
+        return 'transient'
+    message = str(e).lower()
+    if any(marker in message for marker in throttle_markers):
+        return 'throttle'
+    if any(marker in message for marker in transient_markers):
+        return 'transient'
+    return 'fatal'
+
+class RequestGovernor:
+    """Shared gate for network calls: an AIMD concurrency limit, retries with jittered exponential backoff
+    and per-call metrics.
+    The number of calls in flight grows by one per window of successful calls and is halved on every
+    quota or rate limit error, so parallel stages settle just below the quota.
+    Args:
+        initial_limit (int, optional): Starting number of concurrent calls. Defaults to 4.
+        min_limit (int, optional): Lowest number of concurrent calls. Defaults to 1.
+        max_limit (int, optional): Highest number of concurrent calls. Defaults to 32.
+        max_retries (int, optional): Retries of a throttled or transient failure. Defaults to 5.
+        base_delay (float, optional): Backoff of the first retry in seconds. Defaults to 1.
+        max_delay (float, optional): Longest backoff in seconds. Defaults to 60.
+        sleep (function, optional): Sleep function. Defaults to time.sleep.
+    """
+
+    def __init__(self, initial_limit=4, min_limit=1, max_limit=32, max_retries=5, base_delay=1.0, max_delay=60.0,
+                 sleep=time.sleep):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.sleep = sleep
+        self.in_flight = 0
+        self._condition = threading.Condition()
+        self._metrics = {}
+
+    def _acquire(self):
+        with self._condition:
+            while self.in_flight >= max(int(self.limit), self.min_limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def _release(self, outcome):
+        """Frees a slot; the limit grows only after a success and halves after a quota or rate limit error"""
+        with self._condition:
+            self.in_flight -= 1
+            if outcome == 'throttle':
+                self.limit = max(self.min_limit, self.limit / 2)
+            elif outcome == 'success':
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            self._condition.notify_all()
+
+    def _record(self, name, **counts):
+        with self._condition:
+            entry = self._metrics.setdefault(name, {'calls': 0, 'retries': 0, 'throttled': 0, 'failures': 0,
+                                                    'wait_seconds': 0.0, 'call_seconds': 0.0})
+            for key, value in counts.items():
+                entry[key] += value
+
+    def call(self, name, function, *args, **kwargs):
+        """Runs a network call through the concurrency limit, retrying throttled and transient failures
+        Args:
+            name (str): Name of the call in the metrics, e.g. 'getInfo'
+            function (function): Function making the call
+            *args, **kwargs: Arguments of the function
+        Returns:
+            Result of the function; the last exception is raised once retries are exhausted or on fatal errors
+        """
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            self._acquire()
+            acquired = time.perf_counter()
+            outcome = 'fatal'
+            try:
+                result = function(*args, **kwargs)
+                outcome = 'success'
+                self._record(name, calls=1, wait_seconds=acquired - start, call_seconds=time.perf_counter() - acquired)
+                return result
+            except Exception as e:
+                kind = outcome = classify_error(e)
+                self._record(name, calls=1, throttled=int(kind == 'throttle'), wait_seconds=acquired - start,
+                             call_seconds=time.perf_counter() - acquired)
+                if kind == 'fatal' or attempt >= self.max_retries:
+                    self._record(name, failures=1)
+                    raise
+            finally:
+                self._release(outcome)
+            self._record(name, retries=1)
+            self.sleep(random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt)))
+            attempt += 1
+
+    def metrics(self):
+        """Returns a copy of the metrics of each call name, with the current concurrency limit"""
+        with self._condition:
+            metrics = {name: dict(entry) for name, entry in self._metrics.items()}
+            for entry in metrics.values():
+                entry['mean_call_seconds'] = entry['call_seconds'] / entry['calls'] if entry['calls'] else 0.0
+            return {'limit': self.limit, 'calls': metrics}
+
+    def reset_metrics(self):
+        with self._condition:
+            self._metrics = {}
+
+# Governor shared by every network call of the toolbox
+governor = RequestGovernor()
+
+def get_info(ee_object, name='getInfo'):
+    """Fetches the value of an Earth Engine object through the shared governor
+    Args:
+        ee_object (object): Any computed Earth Engine object
+        name (str, optional): Name of the call in the metrics. Defaults to 'getInfo'.
+    Returns:
+        Client-side value of the object
+    """
+    return governor.call(name, ee_object.getInfo)
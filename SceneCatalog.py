@@ -0,0 +1,170 @@
+import os
+import sqlite3
+from contextlib import closing
+from datetime import datetime, timezone, timedelta
+
+import ee
+
+from RequestGovernor import get_info
+
+# Default location of the scene catalog database
+catalog_path = os.path.join(os.path.expanduser('~'), '.pygee_swtoolbox', 'catalog.sqlite')
+
+# Source collections of each platform: (collection id, cloud cover property, metadata filters) as used by the load_* functions
+catalog_sources = {
+    'Landsat-Collection 2': [('LANDSAT/LT04/C02/T1_L2', 'CLOUD_COVER', []),
+                             ('LANDSAT/LT05/C02/T1_L2', 'CLOUD_COVER', []),
+                             ('LANDSAT/LE07/C02/T1_L2', 'CLOUD_COVER', []),
+                             ('LANDSAT/LC08/C02/T1_L2', 'CLOUD_COVER', []),
+                             ('LANDSAT/LC09/C02/T1_L2', 'CLOUD_COVER', [])],
+    'Sentinel-2': [('COPERNICUS/S2_SR_HARMONIZED', 'CLOUDY_PIXEL_PERCENTAGE', [])],
+    'Sentinel-1': [('COPERNICUS/S1_GRD', None, [('instrumentMode', 'IW'),
+                                                ('transmitterReceiverPolarisation', ['VV', 'VH']),
+                                                ('orbitProperties_pass', 'ASCENDING'),
+                                                ('resolution_meters', 10)])],
+    'USDA NAIP': [('USDA/NAIP/DOQQ', None, [])]
+}
+
+# Acquisitions this recent are fetched again on every sync, since scenes are ingested days to weeks after acquisition
+resync_window = timedelta(days=60)
+
+_schema = """
+CREATE TABLE IF NOT EXISTS scenes (
+    id INTEGER PRIMARY KEY,
+    collection TEXT NOT NULL,
+    scene_id TEXT NOT NULL,
+    time_start INTEGER NOT NULL,
+    cloud REAL,
+    UNIQUE (collection, scene_id));
+CREATE INDEX IF NOT EXISTS scenes_time ON scenes (collection, time_start);
+CREATE VIRTUAL TABLE IF NOT EXISTS scene_bounds USING rtree (id, min_x, max_x, min_y, max_y);
+CREATE TABLE IF NOT EXISTS syncs (
+    collection TEXT NOT NULL,
+    west REAL, south REAL, east REAL, north REAL,
+    synced_from INTEGER NOT NULL,
+    synced_until INTEGER NOT NULL,
+    PRIMARY KEY (collection, west, south, east, north));
+"""
+
+def date_millis(date):
+    """Converts a date or datetime to milliseconds since the epoch (UTC), as system:time_start"""
+    return int(datetime(date.year, date.month, date.day, tzinfo=timezone.utc).timestamp() * 1000)
+
+class SceneCatalog:
+    """Local catalog of scene metadata (id, acquisition time, cloud cover and footprint bounding box) per platform.
+    Scenes are stored in SQLite with an R-tree index of their bounding boxes. Each synced region records the
+    acquisition period it covers; a sync only fetches the requested dates outside that period, plus the
+    acquisitions of the last resync_window of it, which may have been ingested after the previous sync.
+    Date-range and cloud-threshold queries are answered locally.
+    """
+
+    def __init__(self, path=None):
+        """
+        Args:
+            path (str, optional): SQLite database file. Defaults to catalog_path.
+        """
+        self.path = path or catalog_path
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.executescript(_schema)
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=60)
+
+    def _synced_region(self, conn, collection_id, bbox):
+        """Finds a synced region covering a bounding box; returns (region, synced_from, synced_until) or Nones"""
+        row = conn.execute("""SELECT west, south, east, north, synced_from, synced_until FROM syncs
+                              WHERE collection = ? AND west <= ? AND south <= ? AND east >= ? AND north >= ?
+                              ORDER BY synced_until - synced_from DESC LIMIT 1""", [collection_id] + list(bbox)).fetchone()
+        if row is None:
+            return None, None, None
+        return list(row[:4]), row[4], row[5]
+
+    def sync(self, platform, bbox, StartDate, EndDate):
+        """Fetches the metadata of the scenes of a study period not yet catalogued for a region
+        Args:
+            platform (str): Satellite platform (a key of catalog_sources)
+            bbox (list): [west, south, east, north] of the study area in degrees
+            StartDate (date): Start of the study period
+            EndDate (date): End of the study period (exclusive, as filterDate)
+        Returns:
+            int: Number of new scenes added to the catalog
+        """
+        start, end = date_millis(StartDate), date_millis(EndDate)
+        now = int(datetime.now(timezone.utc).timestamp() * 1000)
+        window = int(resync_window.total_seconds() * 1000)
+        added = 0
+        for collection_id, cloud_property, properties in catalog_sources[platform]:
+            with closing(self._connect()) as conn:
+                region, synced_from, synced_until = self._synced_region(conn, collection_id, bbox)
+
+            # Acquisition periods to fetch; the synced period stays one contiguous range
+            if region is None:
+                region, ranges = list(bbox), [(start, end)]
+                synced_from, synced_until = start, max(start, min(end, now))
+            else:
+                ranges = []
+                if start < synced_from:
+                    ranges.append((start, synced_from))
+                if end > synced_until - window:
+                    ranges.append((max(synced_until - window, synced_from), end))
+                synced_from, synced_until = min(synced_from, start), max(synced_until, min(end, now))
+            if not ranges:
+                continue
+
+            collection = ee.ImageCollection(collection_id).filterBounds(ee.Geometry.Rectangle(region))
+            for name, value in properties:
+                collection = collection.filter(ee.Filter.eq(name, value))
+            collection = collection.filter(ee.Filter.Or(*[ee.Filter.date(a, b) for a, b in ranges]))
+
+            def scene_row(img):
+                cloud = img.get(cloud_property) if cloud_property else -1
+                return ee.Feature(None, {'id': img.get('system:index'), 'time': img.get('system:time_start'),
+                                         'cloud': cloud, 'ring': img.geometry().bounds(1).coordinates().get(0)})
+
+            rows = get_info(ee.FeatureCollection(collection.map(scene_row))
+                            .reduceColumns(ee.Reducer.toList(4), ['id', 'time', 'cloud', 'ring']).get('list'))
+
+            with closing(self._connect()) as conn, conn:
+                for scene_id, time_start, cloud, ring in rows:
+                    cursor = conn.execute('INSERT OR IGNORE INTO scenes (collection, scene_id, time_start, cloud) VALUES (?, ?, ?, ?)',
+                                          (collection_id, scene_id, time_start, cloud if cloud_property else None))
+                    if cursor.rowcount:
+                        xs = [p[0] for p in ring]
+                        ys = [p[1] for p in ring]
+                        conn.execute('INSERT INTO scene_bounds VALUES (?, ?, ?, ?, ?)',
+                                     (cursor.lastrowid, min(xs), max(xs), min(ys), max(ys)))
+                        added += 1
+                conn.execute('INSERT OR REPLACE INTO syncs VALUES (?, ?, ?, ?, ?, ?, ?)',
+                             [collection_id] + region + [synced_from, synced_until])
+        return added
+
+    def query(self, platform, bbox, StartDate, EndDate, cloud_thresh=None):
+        """Selects catalogued scenes intersecting a bounding box within a date range
+        Args:
+            platform (str): Satellite platform (a key of catalog_sources)
+            bbox (list): [west, south, east, north] of the study area in degrees
+            StartDate (date): Start of the study period
+            EndDate (date): End of the study period (exclusive, as filterDate)
+            cloud_thresh (float, optional): Keep scenes with cloud cover below this percentage; ignored for SAR and NAIP.
+        Returns:
+            dict: Scene system:index values of each source collection, in acquisition order
+        """
+        west, south, east, north = bbox
+        selected = {}
+        with closing(self._connect()) as conn:
+            for collection_id, cloud_property, _ in catalog_sources[platform]:
+                sql = """SELECT s.scene_id FROM scenes s JOIN scene_bounds b ON s.id = b.id
+                         WHERE s.collection = ? AND b.max_x >= ? AND b.min_x <= ? AND b.max_y >= ? AND b.min_y <= ?
+                         AND s.time_start >= ? AND s.time_start < ?"""
+                params = [collection_id, west, east, south, north, date_millis(StartDate), date_millis(EndDate)]
+                if cloud_property and cloud_thresh is not None:
+                    sql += ' AND s.cloud < ?'
+                    params.append(cloud_thresh)
+                selected[collection_id] = [r[0] for r in conn.execute(sql + ' ORDER BY s.time_start', params)]
+        return selected
+
+    def select_scenes(self, platform, bbox, StartDate, EndDate, cloud_thresh=None):
+        """Syncs the uncatalogued acquisitions of a region and period and selects its scenes (see sync and query)"""
+        self.sync(platform, bbox, StartDate, EndDate)
+        return self.query(platform, bbox, StartDate, EndDate, cloud_thresh)
@@ -0,0 +1,94 @@
+class StageGraph:
+    """Pipeline of stages with declared inputs and dirty tracking.
+    Each stage declares the parameters (e.g. widget values) and upstream stages it reads. Results are cached
+    until one of those inputs changes; a changed parameter invalidates only the stages that depend on it,
+    directly or through upstream stages, and they are recomputed lazily the next time they are requested.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.params = {}
+        self.results = {}
+        # Number of times each stage was computed
+        self.runs = {}
+
+    def add_stage(self, name, function, params=(), inputs=()):
+        """Adds a stage
+        Args:
+            name (str): Stage name
+            function (function): Computes the stage; called with the declared parameters and upstream results as keyword arguments
+            params (list, optional): Names of the parameters the stage reads. Defaults to ().
+            inputs (list, optional): Names of the upstream stages the stage reads. Defaults to ().
+        """
+        for upstream in inputs:
+            if upstream not in self.stages:
+                raise ValueError(f'Unknown upstream stage {upstream} of {name}')
+        self.stages[name] = {'function': function, 'params': list(params), 'inputs': list(inputs)}
+
+    def bind(self, widget, param):
+        """Keeps a parameter equal to the value of a widget (any object with a value trait and observe)"""
+        self.set_param(param, widget.value)
+        widget.observe(lambda change: self.set_param(param, change['new']), 'value')
+
+    def downstream(self, names):
+        """Stages depending on any of the given stages, including them"""
+        affected = set(names)
+        changed = True
+        while changed:
+            changed = False
+            for name, stage in self.stages.items():
+                if name not in affected and affected.intersection(stage['inputs']):
+                    affected.add(name)
+                    changed = True
+        return affected
+
+    def invalidate(self, names):
+        """Drops the results of stages and of every stage downstream of them
+        Returns:
+            set: Names of the invalidated stages
+        """
+        affected = self.downstream(names)
+        for name in affected:
+            self.results.pop(name, None)
+        return affected
+
+    def set_param(self, name, value):
+        """Sets a parameter and invalidates the stages that read it, if the value changed
+        Returns:
+            set: Names of the invalidated stages
+        """
+        if name in self.params:
+            try:
+                if bool(self.params[name] == value):
+                    return set()
+            except (TypeError, ValueError):
+                pass
+        self.params[name] = value
+        return self.invalidate([stage for stage, spec in self.stages.items() if name in spec['params']])
+
+    def is_valid(self, name):
+        return name in self.results
+
+    def get(self, name):
+        """Returns the result of a stage, computing it and any invalidated upstream stage first"""
+        if name in self.results:
+            return self.results[name]
+        stage = self.stages[name]
+        kwargs = {param: self.params.get(param) for param in stage['params']}
+        kwargs.update({upstream: self.get(upstream) for upstream in stage['inputs']})
+        self.results[name] = stage['function'](**kwargs)
+        self.runs[name] = self.runs.get(name, 0) + 1
+        return self.results[name]
+
+    def status(self):
+        """'valid' or 'dirty' for every stage"""
+        return {name: 'valid' if name in self.results else 'dirty' for name in self.stages}
+
+    def state(self):
+        """Parameters and cached results, e.g. for saving a session"""
+        return {'params': dict(self.params), 'results': dict(self.results)}
+
+    def restore(self, state):
+        """Restores parameters and cached results saved with state"""
+        self.params.update(state['params'])
+        self.results = {name: result for name, result in state['results'].items() if name in self.stages}
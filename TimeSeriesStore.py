@@ -0,0 +1,203 @@
+import os
+import uuid
+import hashlib
+import tempfile
+from datetime import datetime
+from urllib.parse import quote
+
+import ee
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from Utilities import boundary_file_hash, pipeline_config_hash, water_area_function
+from RequestGovernor import get_info
+
+# Default folder of stored time series
+timeseries_store_dir = os.path.join(os.path.expanduser('~'), '.pygee_swtoolbox', 'timeseries')
+
+# Columns of a stored partition. Values are in square meters (area), cubic meters (volume) or meters (depth);
+# location is '' for study area totals and the point or gauge of depth series; written orders the appends
+store_schema = pa.schema([('date', pa.timestamp('ms')), ('series', pa.string()), ('location', pa.string()),
+                          ('value', pa.float64()), ('config', pa.string()), ('written', pa.timestamp('us'))])
+
+# Columns identifying a stored value; of several values with the same key, the last written one is read
+store_key = ['aoi', 'platform', 'series', 'location', 'config', 'date']
+
+# Partition folders: aoi=<key>/platform=<platform>/year=<year>
+store_partitioning = ds.partitioning(pa.schema([('aoi', pa.string()), ('platform', pa.string()), ('year', pa.int32())]),
+                                     flavor='hive')
+
+def aoi_key(site, boundaryfile=None):
+    """Key of a study area in the time-series store: the content hash of its boundary file, or of its geometry if drawn
+    Args:
+        site (object): ee.FeatureCollection of the study area
+        boundaryfile (str, optional): Uploaded boundary file. Defaults to None.
+    Returns:
+        str: Hex digest
+    """
+    if boundaryfile:
+        return boundary_file_hash(boundaryfile)
+    return hashlib.md5(site.serialize().encode()).hexdigest()
+
+def _matches(name, value):
+    """Filter expression of a column equal to a value or in a list of values; None matches everything"""
+    if value is None:
+        return None
+    if isinstance(value, (list, tuple, set)):
+        return ds.field(name).isin(list(value))
+    return ds.field(name) == value
+
+class TimeSeriesStore:
+    """Parquet store of water area, volume and depth time series, partitioned by study area, platform and year.
+    Every value is kept with the hash of the pipeline configuration that produced it, so series of several
+    configurations can live side by side and a read for one configuration never returns values of another.
+    Reads push their filters down to the partition folders and Parquet row group statistics, and reading
+    several study areas at once concatenates them in one scan.
+    Every append writes its own file, so concurrent appends (batch workers, the service) never overwrite
+    each other; reads keep the last written value of each date, and compact merges the files of a partition.
+    """
+
+    def __init__(self, root=None):
+        """
+        Args:
+            root (str, optional): Store folder. Defaults to timeseries_store_dir.
+        """
+        self.root = root or timeseries_store_dir
+
+    def _partition_dir(self, aoi, platform, year):
+        return os.path.join(self.root, 'aoi=' + quote(aoi, safe=''), 'platform=' + quote(platform, safe=''),
+                            f'year={year}')
+
+    def _write(self, folder, rows):
+        """Writes rows to a new file of a partition through a temporary file, so readers never see a partial file"""
+        os.makedirs(folder, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=folder, prefix='.', suffix='.tmp') # hidden from dataset scans
+        os.close(fd)
+        pq.write_table(pa.Table.from_pandas(rows, schema=store_schema, preserve_index=False), tmp)
+        os.replace(tmp, os.path.join(folder, f'part-{uuid.uuid4().hex}.parquet'))
+
+    def append(self, aoi, platform, series, config, dates, values, location=''):
+        """Adds values to a series; values of an already stored date replace the stored ones
+        Args:
+            aoi (str): Study area key (see aoi_key)
+            platform (str): Satellite platform
+            series (str): 'area', 'volume' or 'depth'
+            config (str): Pipeline configuration hash (see pipeline_config_hash)
+            dates (list): Dates of the values
+            values (list): Values in square meters, cubic meters or meters
+            location (str, optional): Point or gauge of a depth series. Defaults to '' (study area total).
+        Returns:
+            int: Number of values written
+        """
+        frame = pd.DataFrame({'date': pd.to_datetime(pd.Series(list(dates))).astype('datetime64[ms]'), 'series': series,
+                              'location': location, 'value': pd.Series(list(values), dtype='float64'), 'config': config,
+                              'written': pd.Timestamp.now()})
+        frame = frame.drop_duplicates(['date'], keep='last')
+        for year, rows in frame.groupby(frame['date'].dt.year):
+            self._write(self._partition_dir(aoi, platform, year), rows.sort_values('date'))
+        return len(frame)
+
+    def compact(self):
+        """Merges the files of every partition into one, keeping the last written value of each date.
+        Appends made meanwhile write new files, which are left in place.
+        Returns:
+            int: Number of files merged
+        """
+        merged = 0
+        for folder, _, names in os.walk(self.root):
+            files = [os.path.join(folder, n) for n in names if n.startswith('part-') and n.endswith('.parquet')]
+            if len(files) < 2:
+                continue
+            rows = pd.concat([pq.read_table(f, schema=store_schema).to_pandas() for f in files], ignore_index=True)
+            rows = rows.sort_values('written', kind='stable', na_position='first')
+            rows = rows.drop_duplicates(['series', 'location', 'config', 'date'], keep='last')
+            self._write(folder, rows.sort_values(['series', 'location', 'config', 'date']))
+            for f in files:
+                try:
+                    os.remove(f)
+                except FileNotFoundError:
+                    pass # merged by a concurrent compact
+            merged += len(files)
+        return merged
+
+    def read(self, aoi=None, platform=None, series=None, config=None, location=None, start=None, end=None):
+        """Reads stored values; every argument is a value or a list of values to match, None matches all
+        Args:
+            aoi (str or list, optional): Study area keys
+            platform (str or list, optional): Satellite platforms
+            series (str or list, optional): 'area', 'volume' or 'depth'
+            config (str or list, optional): Pipeline configuration hashes
+            location (str or list, optional): Points or gauges ('' for study area totals)
+            start (date, optional): First date to read
+            end (date, optional): Date after the last date to read (exclusive, as filterDate)
+        Returns:
+            object: pandas.DataFrame of date, series, location, value, config, aoi, platform and year
+        """
+        columns = [name for name in store_schema.names if name != 'written'] + ['aoi', 'platform', 'year']
+        if not os.path.isdir(self.root):
+            return pd.DataFrame({name: pd.Series(dtype='datetime64[ms]' if name == 'date' else 'object')
+                                 for name in columns})
+
+        filters = [_matches('aoi', aoi), _matches('platform', platform), _matches('series', series),
+                   _matches('config', config), _matches('location', location)]
+        if start is not None:
+            filters.append(ds.field('year') >= pd.Timestamp(start).year)
+            filters.append(ds.field('date') >= pa.scalar(pd.Timestamp(start).to_pydatetime(), pa.timestamp('ms')))
+        if end is not None:
+            filters.append(ds.field('year') <= pd.Timestamp(end).year)
+            filters.append(ds.field('date') < pa.scalar(pd.Timestamp(end).to_pydatetime(), pa.timestamp('ms')))
+        expression = None
+        for f in filters:
+            if f is not None:
+                expression = f if expression is None else expression & f
+
+        dataset = ds.dataset(self.root, schema=pa.unify_schemas([store_schema, store_partitioning.schema]),
+                             format='parquet', partitioning=store_partitioning)
+        frame = dataset.to_table(filter=expression, columns=columns + ['written']).to_pandas()
+        frame = frame.sort_values('written', kind='stable', na_position='first').drop_duplicates(store_key, keep='last')
+        frame = frame.drop(columns='written')
+        return frame.sort_values(['aoi', 'platform', 'series', 'location', 'date']).reset_index(drop=True)
+
+    def export_csv(self, filename, **filters):
+        """Exports stored values to a CSV file, one row per value (filters as read)"""
+        frame = self.read(**filters)
+        frame.to_csv(filename, index=False, date_format='%Y-%m-%d')
+        return len(frame)
+
+    def latest_date(self, aoi, platform, series, config, location=''):
+        """Date of the latest stored value of a series, or None if the series is empty"""
+        stored = self.read(aoi, platform, series, config, location)
+        return None if stored.empty else stored['date'].max().to_pydatetime()
+
+def update_area_series(store, aoi, params, water_masks, site, img_scale):
+    """Brings the stored water area series of a study area up to date.
+    Only the water masks of dates missing from the store are reduced, so an earlier start date or a gap
+    in the stored series is filled as well as newer dates. The latest stored date is redone in case scenes
+    of that day were ingested after the last update. Only area series are updated incrementally.
+    Args:
+        store (object): TimeSeriesStore
+        aoi (str): Study area key (see aoi_key)
+        params (dict): Parameters of the water extraction, including 'platform'; hashed with pipeline_config_hash
+        water_masks (object): ee.ImageCollection of water masks (e.g. WaterMasks)
+        site (object): ee.FeatureCollection of the study area
+        img_scale (float): A nominal scale in meters of the projection to work in.
+    Returns:
+        tuple: (pandas.DataFrame of the whole series with 'Date' and 'Area' in square meters, number of dates computed)
+    """
+    config = pipeline_config_hash(params)
+    stored = store.read(aoi, params['platform'], 'area', config, '')
+    done = sorted(set(stored['date'].dt.strftime('%Y-%m-%d')))[:-1] # all but the latest stored date
+    if done:
+        water_masks = water_masks.map(lambda img: img.set('store_date', img.date().format('YYYY-MM-dd'))) \
+            .filter(ee.Filter.inList('store_date', done).Not())
+
+    areas = water_masks.map(water_area_function(site, img_scale))
+    info = get_info(ee.Dictionary({'times': areas.aggregate_array('system:time_start'),
+                                   'values': areas.aggregate_array('water_area')}))
+    dates = [datetime.utcfromtimestamp(t / 1000.0).strftime('%Y-%m-%d') for t in info['times']]
+    new_dates = store.append(aoi, params['platform'], 'area', config, dates, [v.get('waterMask') for v in info['values']])
+
+    stored = store.read(aoi, params['platform'], 'area', config, '')
+    return pd.DataFrame({'Date': stored['date'], 'Area': stored['value']}), new_dates
@@ -9,8 +9,26 @@ from urllib.request import urlretrieve
 import shutil
 from geetools.utils import makeName
 import os
-
-def DSWE(imgCollection, DEM, aoi=None):
+import hashlib
+import math
+from concurrent.futures import ThreadPoolExecutor
+import zipfile
+import json
+from xml.etree import ElementTree
+import shapefile
+import tempfile
+import numpy as np
+import zarr
+import rasterio
+from shapely.geometry import shape, mapping
+from datetime import datetime, timedelta
+import csv
+import pandas as pd
+from RequestGovernor import governor, get_info
+import pickle
+from geemap import ml
+
+def DSWE(imgCollection, DEM, aoi=None, terrain=None, plan=None):
     
     """ Computes the DSWE water index for landsat image collection
     
@@ -19,11 +37,15 @@ def DSWE(imgCollection, DEM, aoi=None):
             Landsat image collection
         DEM: digital elevation model
         aoi: area of interest or study area bounday
+        terrain: precomputed terrain layers (see terrain_layers); computed from DEM if None
+        plan: same-day mosaic plan of imgCollection (see same_day_plan); fetched if None
     returns:
         ee.ImageCollection
         collection of DWSE images
     """
-    dem = DEM
+    if terrain is None:
+        terrain = terrain_layers(DEM)
+    dem = terrain.select('elevation')
     aoi = aoi
 
     def clipImages(img):
@@ -158,9 +180,10 @@ def DSWE(imgCollection, DEM, aoi=None):
     # --------------------------------------------------------
     # Produce DSWE layers
     # ----------------------------------------------------------------------
-    # Construct slope image from DEM
-    #dem = dem.clip(aoi); # removed clipping in an attempt to speed up script
-    slope = ee.Terrain.slope(dem)
+    # Slope classes from the terrain layers
+    slope_10pct = terrain.select('slope_10pct')
+    slope_20pct = terrain.select('slope_20pct')
+    slope_30pct = terrain.select('slope_30pct')
     # Convert binary code into 4 DSWE categories
     def convert_bin_dswe(img):
         reclass = img.select('summed_bit_band').remap([0, 1, 2, 3, 4, 5, 6, 7, 8, 9,
@@ -177,16 +200,16 @@ def DSWE(imgCollection, DEM, aoi=None):
         # ID shaded areas
         reclass = reclass.where(img.select('hillshade').lte(110), 8)
         # ID slopes
-        reclass = reclass.where(img.select('dswe').eq(4) and slope.gte(5.71).Or  # 10% slope = 5.71°
-                      (img.select('dswe').eq(3) and slope.gte(11.31)).Or           # 20% slope = 11.31°
-                      (img.select('dswe').eq(2) and slope.gte(16.7)).Or            # 30% slope = 16.7°
-                      (img.select('dswe').eq(1) and slope.gte(16.7)), 0);          # 30% slope = 16.7°
+        reclass = reclass.where(img.select('dswe').eq(4) and slope_10pct.Or  # 10% slope = 5.71°
+                      (img.select('dswe').eq(3) and slope_20pct).Or           # 20% slope = 11.31°
+                      (img.select('dswe').eq(2) and slope_30pct).Or            # 30% slope = 16.7°
+                      (img.select('dswe').eq(1) and slope_30pct), 0);          # 30% slope = 16.7°
 
 #         return img.addBands(reclass).select('dswe')
         return img.addBands(reclass)
 
     img_indices_all = img_indices_bit.map(convert_bin_dswe)
-    dswe_Images_mosaic = tools.imagecollection.mosaicSameDay(img_indices_all)
+    dswe_Images_mosaic = mosaic_same_day(img_indices_all, plan if plan is not None else same_day_plan(imgCollection))
 
     if aoi is None:
         dswe_Images = dswe_Images_mosaic
@@ -196,7 +219,7 @@ def DSWE(imgCollection, DEM, aoi=None):
 
     return dswe_Images
 
-def DSWE_2(imgCollection, DEM, aoi=None):
+def DSWE_2(imgCollection, DEM, aoi=None, terrain=None, plan=None):
     
     """ Computes the DSWE water index for landsat image collection
     
@@ -205,11 +228,15 @@ def DSWE_2(imgCollection, DEM, aoi=None):
             Landsat image collection
         DEM: digital elevation model
         aoi: area of interest or study area bounday
+        terrain: precomputed terrain layers (see terrain_layers); computed from DEM if None
+        plan: same-day mosaic plan of imgCollection (see same_day_plan); fetched if None
     returns:
         ee.ImageCollection
         collection of DWSE images
     """
-    dem = DEM
+    if terrain is None:
+        terrain = terrain_layers(DEM)
+    dem = terrain.select('elevation')
     aoi = aoi
 
     def clipImages(img):
@@ -344,9 +371,10 @@ def DSWE_2(imgCollection, DEM, aoi=None):
     # --------------------------------------------------------
     # Produce DSWE layers
     # ----------------------------------------------------------------------
-    # Construct slope image from DEM
-    #dem = dem.clip(aoi); # removed clipping in an attempt to speed up script
-    slope = ee.Terrain.slope(dem)
+    # Slope classes from the terrain layers
+    slope_10pct = terrain.select('slope_10pct')
+    slope_20pct = terrain.select('slope_20pct')
+    slope_30pct = terrain.select('slope_30pct')
     # Convert binary code into 4 DSWE categories
     def convert_bin_dswe(img):
         reclass = img.select('summed_bit_band').remap([0, 1, 2, 3, 4, 5, 6, 7, 8, 9,
@@ -363,16 +391,16 @@ def DSWE_2(imgCollection, DEM, aoi=None):
         # ID shaded areas
         reclass = reclass.where(img.select('hillshade').lte(110), 8)
         # ID slopes
-        reclass = reclass.where(img.select('dswe').eq(4) and slope.gte(5.71).Or  # 10% slope = 5.71°
-                      (img.select('dswe').eq(3) and slope.gte(11.31)).Or           # 20% slope = 11.31°
-                      (img.select('dswe').eq(2) and slope.gte(16.7)).Or            # 30% slope = 16.7°
-                      (img.select('dswe').eq(1) and slope.gte(16.7)), 0);          # 30% slope = 16.7°
+        reclass = reclass.where(img.select('dswe').eq(4) and slope_10pct.Or  # 10% slope = 5.71°
+                      (img.select('dswe').eq(3) and slope_20pct).Or           # 20% slope = 11.31°
+                      (img.select('dswe').eq(2) and slope_30pct).Or            # 30% slope = 16.7°
+                      (img.select('dswe').eq(1) and slope_30pct), 0);          # 30% slope = 16.7°
 
 #         return img.addBands(reclass).select('dswe')
         return img.addBands(reclass)
 
     img_indices_all = img_indices_bit.map(convert_bin_dswe)
-    dswe_Images_mosaic = tools.imagecollection.mosaicSameDay(img_indices_all)
+    dswe_Images_mosaic = mosaic_same_day(img_indices_all, plan if plan is not None else same_day_plan(imgCollection))
 
     if aoi is None:
         dswe_Images = dswe_Images_mosaic
@@ -384,7 +412,23 @@ def DSWE_2(imgCollection, DEM, aoi=None):
 
 
 
-def load_Landsat_Coll_2(aoi, StartDate, EndDate, cloud_thresh):
+def catalog_collection(collection_id, scene_ids=None):
+    """
+    Function to build a collection, restricted to scenes selected from the local scene catalog
+
+    args:
+        collection_id: Earth Engine collection id
+        scene_ids: Scene system:index values of each collection id (see SceneCatalog.query); all scenes if None
+
+    returns:
+        Image collection
+    """
+    collection = ee.ImageCollection(collection_id)
+    if scene_ids is None:
+        return collection
+    return collection.filter(ee.Filter.inList('system:index', scene_ids.get(collection_id, [])))
+
+def load_Landsat_Coll_2(aoi, StartDate, EndDate, cloud_thresh, scene_ids=None):
     """
     Function to retrieve and filter Landsat images
 
@@ -393,6 +437,7 @@ def load_Landsat_Coll_2(aoi, StartDate, EndDate, cloud_thresh):
         StartDate: Starting date to filter data
         EndDate: End date to filter data
         cloud_thresh: Threshold for filtering cloudy images
+        scene_ids: Scene ids selected from the local scene catalog; all scenes are queried if None
 
     returns:
         Image collection of Landsat images
@@ -421,22 +466,23 @@ def load_Landsat_Coll_2(aoi, StartDate, EndDate, cloud_thresh):
         orig = img
         qa = img.select('pixel_qa')
         opticalBands_scaled = img.select(['blue', 'green', 'red', 'nir', 'swir1', 'swir2']).multiply(0.0000275).add(-0.2)
-        return img.addBands(opticalBands_scaled, None, True).addBands(qa, None, True).copyProperties(orig, orig.propertyNames())
+        # Build the scaled image from the selected bands instead of overwriting them in place
+        return opticalBands_scaled.addBands(qa).copyProperties(orig, orig.propertyNames())
 
     # ------------------------------------------------------
     # Landsat 4 - Data availability Aug 22, 1982 - Dec 14, 1993
-    ls4 = ee.ImageCollection('LANDSAT/LT04/C02/T1_L2') \
+    ls4 = catalog_collection('LANDSAT/LT04/C02/T1_L2', scene_ids) \
         .filterBounds(aoi.geometry()) \
         .select(sensor_band_dict.get('l4'), bandNames)
 
     # Landsat 5 - Data availability Jan 1, 1984 - May 5, 2012
-    ls5 = ee.ImageCollection('LANDSAT/LT05/C02/T1_L2') \
+    ls5 = catalog_collection('LANDSAT/LT05/C02/T1_L2', scene_ids) \
         .filterBounds(aoi.geometry()) \
         .select(sensor_band_dict.get('l5'), bandNames)
 
     # Landsat 7 - Data availability Jan 1, 1999 - Aug 9, 2016
     # SLC-off after 31 May 2003
-    ls7 = ee.ImageCollection('LANDSAT/LE07/C02/T1_L2') \
+    ls7 = catalog_collection('LANDSAT/LE07/C02/T1_L2', scene_ids) \
         .filterDate('1999-01-01', '2003-05-31') \
         .filterBounds(aoi.geometry()) \
         .select(sensor_band_dict.get('l7'), bandNames)
@@ -445,20 +491,20 @@ def load_Landsat_Coll_2(aoi, StartDate, EndDate, cloud_thresh):
     # -------------------------------------------------------
     # Landsat 7 - Data availability Jan 1, 1999 - Aug 9, 2016
     # SLC-off after 31 May 2003
-    ls7_2 = ee.ImageCollection('LANDSAT/LE07/C02/T1_L2') \
+    ls7_2 = catalog_collection('LANDSAT/LE07/C02/T1_L2', scene_ids) \
         .filterDate('2012-05-05', '2014-04-11') \
         .filterBounds(aoi.geometry()) \
         .select(sensor_band_dict.get('l7'), bandNames)
 
     # --------------------------------------------------------
     # Landsat 8 - Data availability Apr 11, 2014 - present
-    ls8 = ee.ImageCollection('LANDSAT/LC08/C02/T1_L2') \
+    ls8 = catalog_collection('LANDSAT/LC08/C02/T1_L2', scene_ids) \
         .filterBounds(aoi.geometry()) \
         .select(sensor_band_dict.get('l8'), bandNames)
     
     # --------------------------------------------------------
     # Landsat 9 - Data availability Oct 31, 2021 - present
-    ls9 = ee.ImageCollection('LANDSAT/LC09/C02/T1_L2') \
+    ls9 = catalog_collection('LANDSAT/LC09/C02/T1_L2', scene_ids) \
         .filterBounds(aoi.geometry()) \
         .select(sensor_band_dict.get('l9'), bandNames)
 
@@ -476,7 +522,7 @@ def load_Landsat_Coll_2(aoi, StartDate, EndDate, cloud_thresh):
 
     return l45789_scaled
 
-def load_Sentinel1(site, StartDate, EndDate):
+def load_Sentinel1(site, StartDate, EndDate, scene_ids=None):
     """
     Function to retrieve and filter Sentinel-1 images
 
@@ -484,12 +530,13 @@ def load_Sentinel1(site, StartDate, EndDate):
         aoi: region of interest
         StartDate: Starting date to filter data
         EndDate: End date to filter data
+        scene_ids: Scene ids selected from the local scene catalog; all scenes are queried if None
 
     returns:
         Image collection of Sentinel-1 images
     """
 
-    filtered_col = ee.ImageCollection('COPERNICUS/S1_GRD')\
+    filtered_col = catalog_collection('COPERNICUS/S1_GRD', scene_ids)\
         .filterDate(StartDate,EndDate)\
         .filter(ee.Filter.eq('instrumentMode', 'IW'))\
         .filterMetadata('transmitterReceiverPolarisation', 'equals',['VV','VH'])\
@@ -504,6 +551,122 @@ def slope_correction(img):
     corrected_image = corrections.slope_correction(img,elevation=elev)
     return corrected_image.copyProperties(img, img.propertyNames())
 
+def slope_correction_terrain(terrain):
+    """Radiometric slope correction of Sentinel-1 images using precomputed terrain layers
+    Args:
+        terrain (object): ee.Image of terrain layers (see terrain_layers)
+    Returns:
+        function: Slope correction function to map over a Sentinel-1 collection
+    """
+    elev = terrain.select('elevation')
+    def wrap(img):
+        corrected_image = corrections.slope_correction(img,elevation=elev)
+        return corrected_image.copyProperties(img, img.propertyNames())
+    return wrap
+
+# Terrain layers already built in this session, keyed by DEM source, band and AOI
+_terrain_cache = {}
+
+def terrain_layers(dem, aoi=None):
+    """Builds the static terrain layers used by DSWE, slope correction and depth estimation
+    Args:
+        dem (object): Elevation data (single band ee.Image)
+        aoi (object, optional): ee.FeatureCollection of the study area; the layers are clipped to its bounding box.
+    Returns:
+        object: ee.Image with elevation, slope, aspect, pixel_area and DSWE slope class bands
+    """
+    elevation = dem.rename('elevation')
+    slope = ee.Terrain.slope(elevation)
+    terrain = elevation.addBands([slope,
+                                  ee.Terrain.aspect(elevation),
+                                  ee.Image.pixelArea().rename('pixel_area'),
+                                  slope.gte(5.71).rename('slope_10pct'),    # 10% slope = 5.71°
+                                  slope.gte(11.31).rename('slope_20pct'),   # 20% slope = 11.31°
+                                  slope.gte(16.7).rename('slope_30pct')])   # 30% slope = 16.7°
+    if aoi is not None:
+        terrain = terrain.clip(aoi.geometry().bounds())
+    return terrain
+
+def terrain_asset_id(demSource, band, aoi, asset_root):
+    """Builds the asset ID of the exported terrain layers of a DEM and an AOI
+    Args:
+        demSource (str): Earth Engine ID of the DEM
+        band (str): Elevation band of the DEM
+        aoi (object): ee.FeatureCollection of the study area
+        asset_root (str): Asset folder holding the terrain layers, e.g. 'users/<name>/terrain'
+    Returns:
+        str: Asset ID
+    """
+    key = hashlib.md5((demSource + band + aoi.serialize()).encode()).hexdigest()[:16]
+    return asset_root.rstrip('/') + '/terrain_' + key
+
+def get_terrain_layers(demSource, band, aoi, asset_root=None):
+    """Retrieves the terrain layers of a DEM and an AOI, reusing previously built or exported layers.
+    Layers are taken, in order, from the session cache, from an exported asset under asset_root,
+    or built with terrain_layers. Layers built because the asset under asset_root does not exist yet are not
+    cached, so the asset is looked up again on the next call.
+    Args:
+        demSource (str): Earth Engine ID of the DEM
+        band (str): Elevation band of the DEM
+        aoi (object): ee.FeatureCollection of the study area
+        asset_root (str, optional): Asset folder holding exported terrain layers. Defaults to None.
+    Returns:
+        object: ee.Image of terrain layers
+    """
+    key = (demSource, band, aoi.serialize(), asset_root)
+    if key in _terrain_cache:
+        return _terrain_cache[key]
+
+    if asset_root is not None:
+        asset_id = terrain_asset_id(demSource, band, aoi, asset_root)
+        try:
+            governor.call('getAsset', ee.data.getAsset, asset_id)
+        except ee.EEException:
+            # Not exported (yet): build the layers without caching them, so a later export is picked up
+            return terrain_layers(ee.Image(demSource).select(band), aoi)
+        terrain = ee.Image(asset_id)
+    else:
+        terrain = terrain_layers(ee.Image(demSource).select(band), aoi)
+
+    _terrain_cache[key] = terrain
+    return terrain
+
+def export_terrain_layers(demSource, band, aoi, asset_root, scale=30):
+    """Exports the terrain layers of a DEM and an AOI to an Earth Engine asset for reuse across runs
+    Args:
+        demSource (str): Earth Engine ID of the DEM
+        band (str): Elevation band of the DEM
+        aoi (object): ee.FeatureCollection of the study area
+        asset_root (str): Asset folder holding the terrain layers
+        scale (float, optional): Export scale in meters. Defaults to 30.
+    Returns:
+        object: The started ee.batch.Task
+    """
+    terrain = terrain_layers(ee.Image(demSource).select(band), aoi).toFloat()
+    asset_id = terrain_asset_id(demSource, band, aoi, asset_root)
+    task = ee.batch.Export.image.toAsset(**{
+        'image': terrain,
+        'description': asset_id.split('/')[-1],
+        'assetId': asset_id,
+        'region': aoi.geometry().bounds(),
+        'scale': scale,
+        'maxPixels': 1e13
+        })
+    governor.call('startTask', task.start)
+    return task
+
+def download_terrain_layers(demSource, band, aoi, filename, scale=30):
+    """Downloads the terrain layers of a DEM and an AOI as a local GeoTIFF for the offline engines
+    Args:
+        demSource (str): Earth Engine ID of the DEM
+        band (str): Elevation band of the DEM
+        aoi (object): ee.FeatureCollection of the study area
+        filename (str): Output GeoTIFF
+        scale (float, optional): Download scale in meters. Defaults to 30.
+    """
+    terrain = get_terrain_layers(demSource, band, aoi).toFloat()
+    local_download(terrain, filename, aoi, scale)
+
 def SAR_indices(img):
     # From Huang et al. (2018), doi: 10.3390/rs10050797
     # Polarized raio
@@ -521,7 +684,7 @@ def SAR_indices(img):
     
     return img.addBands([PR,NDPI,NVHI,NVVI])
 
-def load_Sentinel2(aoi, StartDate, EndDate, cloud_thresh):
+def load_Sentinel2(aoi, StartDate, EndDate, cloud_thresh, scene_ids=None):
     """
     Function to retrieve and filter Sentinel-2 images
 
@@ -530,11 +693,12 @@ def load_Sentinel2(aoi, StartDate, EndDate, cloud_thresh):
         StartDate: Starting date to filter data
         EndDate: End date to filter data
         cloud_thresh: Threshold for filtering cloudy images
+        scene_ids: Scene ids selected from the local scene catalog; all scenes are queried if None
 
     returns:
         Image collection of Sentinel-2 images
     """
-    filtered_col = ee.ImageCollection('COPERNICUS/S2_SR_HARMONIZED')\
+    filtered_col = catalog_collection('COPERNICUS/S2_SR_HARMONIZED', scene_ids)\
         .filterDate(StartDate,EndDate)\
         .filterBounds(aoi)\
         .filter(ee.Filter.lt('CLOUDY_PIXEL_PERCENTAGE', cloud_thresh))\
@@ -542,7 +706,7 @@ def load_Sentinel2(aoi, StartDate, EndDate, cloud_thresh):
         .select(['B2','B3','B4','B8','B11','B12','QA60'], ['blue','green','red','nir','swir1','swir2','pixel_qa'])
     return filtered_col
 
-def load_NAIP(aoi, StartDate, EndDate):
+def load_NAIP(aoi, StartDate, EndDate, scene_ids=None):
     """
     Function to retrieve and filter NAIP images
 
@@ -550,11 +714,12 @@ def load_NAIP(aoi, StartDate, EndDate):
         aoi: region of interest
         StartDate: Starting date to filter data
         EndDate: End date to filter data
+        scene_ids: Scene ids selected from the local scene catalog; all scenes are queried if None
 
     returns:
         Image collection of NAIP images
     """
-    filtered_col = ee.ImageCollection('USDA/NAIP/DOQQ')\
+    filtered_col = catalog_collection('USDA/NAIP/DOQQ', scene_ids)\
         .filterDate(StartDate,EndDate)\
         .filterBounds(aoi)\
         .sort('system:time_start')
@@ -565,21 +730,221 @@ def load_boundary(boundaryfile):
     Function to laod shapefile
         
     args:
-        boundaryfile: An ESRI shapefile for the aoi boudary (WGS84 projection) or KML OR KMZ
+        boundaryfile: An ESRI shapefile for the aoi boudary (WGS84 projection), KML, KMZ or GeoJSON
 
     returns:
         ee user boundary
     """
-    extension = boundaryfile[-3:]
-    if extension == "shp":       
-        aoi = geemap.shp_to_ee(boundaryfile)
-    elif extension == "kml":
-        geemap.kml_to_shp(boundaryfile,'shape.shp')
-        aoi = geemap.shp_to_ee('shape.shp')  
+    key = boundary_file_hash(boundaryfile)
+    if key not in _boundary_cache:
+        _boundary_cache[key] = geemap.geojson_to_ee(boundary_geojson(boundaryfile))
+    return _boundary_cache[key]
+
+# Elevation datasets of the depth stage: asset ID and elevation band
+dem_sources = {'NED': ('USGS/NED', 'elevation'), 'SRTM': ('USGS/SRTMGL1_003', 'elevation')}
+
+def dem_source(dem, user_dem=None):
+    """Looks up the Earth Engine ID and elevation band of an elevation dataset
+    Args:
+        dem (str): 'NED', 'SRTM' or 'User DEM'
+        user_dem (str, optional): Image asset of a user DEM, read from its 'b1' band; required for 'User DEM'.
+    Returns:
+        tuple: (DEM ID, band)
+    """
+    if dem in dem_sources:
+        return dem_sources[dem]
+    if dem == 'User DEM' and user_dem:
+        return str(user_dem), 'b1'
+    raise ValueError(f'Unknown elevation dataset: {dem}' if dem != 'User DEM' else 'Select the user DEM asset')
+
+# Nominal pixel size of each platform in meters, used to prepare boundaries before any image is loaded
+platform_scales = {'Landsat-Collection 2': 30, 'Sentinel-1': 10, 'Sentinel-2': 10, 'USDA NAIP': 1}
+
+def collection_scale(images):
+    """Nominal scale of the first band of the first image of a processed collection: the scale of every
+    later reduction, shared by the Toolbox and batch runs so both compute the same areas and volumes
+    Args:
+        images (object): ee.ImageCollection of processed images
+    Returns:
+        float: Scale in meters
+    """
+    return get_info(ee.Image(images.first()).select(0).projection().nominalScale())
+
+# Folder of prepared AOI boundaries
+aoi_cache_dir = os.path.join(os.path.expanduser('~'), '.pygee_swtoolbox', 'aoi')
+
+# Boundaries converted in this session, keyed by file content hash
+_boundary_cache = {}
+
+def _kml_coordinates(element):
+    """Parses the first coordinates element below a KML element into [lon, lat] pairs"""
+    for child in element.iter():
+        if child.tag.split('}')[-1] == 'coordinates':
+            return [[float(v) for v in point.split(',')[:2]] for point in child.text.split()]
+    return []
+
+def _kml_rings(polygon, boundary):
+    """Lists the rings of a KML polygon boundary ('outerBoundaryIs' or 'innerBoundaryIs')"""
+    return [_kml_coordinates(child) for child in polygon if child.tag.split('}')[-1] == boundary]
+
+def kml_to_geojson_dict(kml_text):
+    """
+    Function to convert KML text to GeoJSON in memory
+
+    args:
+        kml_text: Content of a KML file
+
+    returns:
+        GeoJSON FeatureCollection dictionary with one feature per Polygon, LineString or Point
+    """
+    root = ElementTree.fromstring(kml_text)
+    features = []
+    for placemark in root.iter():
+        if placemark.tag.split('}')[-1] != 'Placemark':
+            continue
+        name = [c.text for c in placemark if c.tag.split('}')[-1] == 'name']
+        properties = {'name': name[0]} if name else {}
+        for element in placemark.iter():
+            tag = element.tag.split('}')[-1]
+            if tag == 'Polygon':
+                geometry = {'type': 'Polygon',
+                            'coordinates': _kml_rings(element, 'outerBoundaryIs') + _kml_rings(element, 'innerBoundaryIs')}
+            elif tag == 'LineString':
+                geometry = {'type': 'LineString', 'coordinates': _kml_coordinates(element)}
+            elif tag == 'Point':
+                geometry = {'type': 'Point', 'coordinates': _kml_coordinates(element)[0]}
+            else:
+                continue
+            features.append({'type': 'Feature', 'geometry': geometry, 'properties': properties})
+    return {'type': 'FeatureCollection', 'features': features}
+
+def boundary_geojson(boundaryfile):
+    """
+    Function to read a boundary file as GeoJSON in memory, without intermediate files
+
+    args:
+        boundaryfile: An ESRI shapefile (WGS84 projection), KML, KMZ or GeoJSON
+
+    returns:
+        GeoJSON FeatureCollection dictionary
+    """
+    extension = os.path.splitext(boundaryfile)[1].lower()
+    if extension == ".shp":
+        prj = os.path.splitext(boundaryfile)[0] + '.prj'
+        if os.path.exists(prj):
+            with open(prj) as f:
+                wkt = f.read().upper()
+            # Only geographic (lon/lat) coordinates can be read as they are; projected ones, e.g. UTM, need reprojecting
+            if not wkt.lstrip().startswith('GEOGCS') or 'PROJCS' in wkt:
+                return geemap.shp_to_geojson(boundaryfile) # reprojects to WGS84
+        with shapefile.Reader(boundaryfile) as reader:
+            return json.loads(json.dumps(reader.__geo_interface__))
+    elif extension == ".kml":
+        with open(boundaryfile, 'rb') as f:
+            return kml_to_geojson_dict(f.read())
+    elif extension == ".kmz":
+        with zipfile.ZipFile(boundaryfile) as archive:
+            kml_name = [n for n in archive.namelist() if n.lower().endswith('.kml')][0]
+            return kml_to_geojson_dict(archive.read(kml_name))
+    elif extension in [".geojson", ".json"]:
+        with open(boundaryfile) as f:
+            geojson = json.load(f)
+        if geojson['type'] == 'Feature':
+            geojson = {'type': 'FeatureCollection', 'features': [geojson]}
+        elif geojson['type'] != 'FeatureCollection':
+            geojson = {'type': 'FeatureCollection', 'features': [{'type': 'Feature', 'geometry': geojson, 'properties': {}}]}
+        return geojson
+    raise ValueError(f'Unsupported boundary file: {boundaryfile}')
+
+def boundary_file_hash(boundaryfile):
+    """Hashes the content of a boundary file, including the sidecar files of a shapefile"""
+    md5 = hashlib.md5()
+    base = os.path.splitext(boundaryfile)[0]
+    for ext in ['', '.dbf', '.prj', '.shx']:
+        name = boundaryfile if ext == '' else base + ext
+        if os.path.exists(name):
+            with open(name, 'rb') as f:
+                md5.update(f.read())
+    return md5.hexdigest()
+
+def simplify_geojson(geojson, tolerance):
+    """Simplifies every geometry of a GeoJSON FeatureCollection without breaking its topology
+    Args:
+        geojson (dict): GeoJSON FeatureCollection in WGS84
+        tolerance (float): Simplification tolerance in degrees
+    Returns:
+        dict: Simplified GeoJSON FeatureCollection with coordinates rounded to a tenth of the tolerance
+    """
+    decimals = max(0, int(math.ceil(-math.log10(tolerance))) + 1)
+    def round_coords(coords):
+        if isinstance(coords[0], (int, float)):
+            return [round(c, decimals) for c in coords]
+        return [round_coords(c) for c in coords]
+
+    features = []
+    for feature in geojson['features']:
+        geometry = mapping(shape(feature['geometry']).simplify(tolerance, preserve_topology=True))
+        geometry = {'type': geometry['type'], 'coordinates': round_coords(json.loads(json.dumps(geometry['coordinates'])))}
+        features.append({'type': 'Feature', 'geometry': geometry, 'properties': feature.get('properties', {})})
+    return {'type': 'FeatureCollection', 'features': features}
+
+def geojson_bounds(geojson):
+    """Computes the [west, south, east, north] bounding box of a GeoJSON FeatureCollection"""
+    boxes = [shape(f['geometry']).bounds for f in geojson['features']]
+    return [min(b[0] for b in boxes), min(b[1] for b in boxes), max(b[2] for b in boxes), max(b[3] for b in boxes)]
+
+def geojson_vertices(geojson):
+    """Counts the vertices of a GeoJSON FeatureCollection"""
+    def count(coords):
+        if isinstance(coords[0], (int, float)):
+            return 1
+        return sum(count(c) for c in coords)
+    return sum(count(f['geometry']['coordinates']) for f in geojson['features'])
+
+def prepare_aoi(boundaryfile, img_scale=30, cache_dir=None):
+    """Prepares an uploaded boundary for the requests of the toolbox.
+    The boundary is simplified (topology preserving) to half a pixel, its bounding box is kept for
+    filterBounds, and the simplified GeoJSON is cached by file content so later runs skip the conversion.
+    Args:
+        boundaryfile (str): An ESRI shapefile (WGS84 projection), KML, KMZ or GeoJSON
+        img_scale (float, optional): Pixel size of the imagery in meters. Defaults to 30.
+        cache_dir (str, optional): Folder of prepared boundaries. Defaults to aoi_cache_dir.
+    Returns:
+        dict: 'site' (ee.FeatureCollection), 'bounds' (ee.FeatureCollection of the bounding box), 'bbox' ([west, south, east, north]) and 'report'
+    """
+    cache_dir = cache_dir or aoi_cache_dir
+    tolerance = img_scale / 2.0 / 111320.0 # half a pixel in degrees
+    key = boundary_file_hash(boundaryfile) + '_' + str(img_scale)
+    cached = os.path.join(cache_dir, key + '.geojson')
+
+    if key in _boundary_cache:
+        return _boundary_cache[key]
+
+    if os.path.exists(cached):
+        with open(cached) as f:
+            prepared = json.load(f)
     else:
-#         aoi = geemap.kmz_to_ee(boundaryfile)
-        None
-    return aoi
+        original = boundary_geojson(boundaryfile)
+        simplified = simplify_geojson(original, tolerance)
+        bounds = geojson_bounds(simplified)
+        prepared = {'geojson': simplified, 'bounds': bounds,
+                    'report': {'original_vertices': geojson_vertices(original),
+                               'simplified_vertices': geojson_vertices(simplified),
+                               'original_bytes': len(json.dumps([f['geometry'] for f in original['features']])),
+                               'simplified_bytes': len(json.dumps([f['geometry'] for f in simplified['features']])),
+                               'bounds_bytes': len(json.dumps(bounds))}}
+        # Write to a unique file and rename so concurrent runs never read a partial cache file
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(prepared, f)
+        os.replace(tmp, cached)
+
+    _boundary_cache[key] = {'site': geemap.geojson_to_ee(prepared['geojson']),
+                            'bounds': ee.FeatureCollection(ee.Geometry.Rectangle(prepared['bounds'])),
+                            'bbox': prepared['bounds'],
+                            'report': prepared['report']}
+    return _boundary_cache[key]
 
 def maskS2clouds(image):
     """
@@ -626,6 +991,282 @@ def cloudMaskL457(image):
     mask2 = image.mask().reduce(ee.Reducer.min())
     return (image.updateMask(cloud.Not()).updateMask(mask2).copyProperties(orig, orig.propertyNames()))
 
+def filter_AOI_clear_fraction(imgCollection, aoi, min_clear, mask_function, scale=300, img_scale=30):
+    """Drops images whose fraction of clear (unmasked) pixels inside the AOI is below a threshold.
+    The clear fraction of every image is computed from its 'pixel_qa' band at a coarse scale and
+    fetched with a single request, before any water extraction stage runs.
+    Args:
+        imgCollection (object): ee.ImageCollection with a 'pixel_qa' band
+        aoi (object): ee.FeatureCollection of the study area
+        min_clear (float): Minimum fraction (0-1) of clear AOI pixels to keep an image
+        mask_function (function): Cloud masking function for the collection, e.g. maskLandsatclouds
+        scale (float, optional): Scale in meters of the clear fraction reduction. Defaults to 300.
+        img_scale (float, optional): Scale in meters of the later processing stages, used for the report. Defaults to 30.
+    Returns:
+        tuple: (filtered ee.ImageCollection, report dictionary)
+    """
+    region = aoi.geometry()
+
+    def clear_fraction(img):
+        clear = mask_function(img).select('pixel_qa').mask().rename('clear')
+        fraction = clear.reduceRegion(**{
+                        'reducer': ee.Reducer.mean(),
+                        'geometry': region,
+                        'scale': scale,
+                        'maxPixels': 1e13,
+                        'bestEffort': True
+                        }).get('clear')
+        # Id and fraction kept in one property: aggregate_array skips null fractions (no pixels in the AOI),
+        # which would misalign two separate arrays
+        return ee.Feature(None, {'pair': ee.List([img.get('system:index'), fraction])})
+
+    stats = ee.FeatureCollection(imgCollection.map(clear_fraction))
+    info = get_info(ee.Dictionary({'pairs': stats.aggregate_array('pair'),
+                                   'area': region.area(1)}))
+
+    keep_ids = [i for i, c in info['pairs'] if c is not None and c >= min_clear]
+    filtered = imgCollection.filter(ee.Filter.inList('system:index', keep_ids))
+
+    total = len(info['pairs'])
+    dropped = total - len(keep_ids)
+    report = {'total_scenes': total,
+              'kept_scenes': len(keep_ids),
+              'kept_ids': keep_ids,
+              'dropped_scenes': dropped,
+              'work_saved_percent': 100.0 * dropped / total if total else 0.0,
+              'pixels_saved_per_stage': int(dropped * info['area'] / (img_scale * img_scale))}
+    return filtered, report
+
+# Same-day mosaic plans, keyed by the hash of the serialized collection
+_mosaic_plan_cache = {}
+
+def same_day_plan(imgCollection):
+    """Plans same-day mosaics from a single metadata request.
+    Args:
+        imgCollection (object): ee.ImageCollection to mosaic
+    Returns:
+        dict: Scene system:index values of each UTC date ('YYYY-MM-dd'), in date order
+    """
+    key = hashlib.md5(imgCollection.serialize().encode()).hexdigest()
+    if key not in _mosaic_plan_cache:
+        scenes = get_info(imgCollection.reduceColumns(ee.Reducer.toList(2), ['system:index', 'system:time_start'])
+                          .get('list'))
+        plan = {}
+        for index, time_start in sorted(scenes, key=lambda scene: scene[1]):
+            date = datetime.utcfromtimestamp(time_start / 1000.0).strftime('%Y-%m-%d')
+            plan.setdefault(date, []).append(index)
+        _mosaic_plan_cache[key] = plan
+    return _mosaic_plan_cache[key]
+
+def mosaic_same_day(imgCollection, plan=None):
+    """Mosaics images of the same day following a same-day plan.
+    Only dates with more than one scene are mosaicked (footprints merged and the band projections of
+    the first scene kept, as in geetools mosaicSameDay); single-scene dates pass through untouched.
+    Args:
+        imgCollection (object): ee.ImageCollection to mosaic
+        plan (dict, optional): Plan from same_day_plan; fetched if None.
+    Returns:
+        object: ee.ImageCollection with one image per day
+    """
+    if plan is None:
+        plan = same_day_plan(imgCollection)
+
+    single_ids = [ids[0] for ids in plan.values() if len(ids) == 1]
+    images = imgCollection.filter(ee.Filter.inList('system:index', single_ids))
+
+    mosaics = []
+    for date, ids in plan.items():
+        if len(ids) == 1:
+            continue
+        scenes = imgCollection.filter(ee.Filter.inList('system:index', ids))
+        first_img = ee.Image(scenes.first())
+        bands = first_img.bandNames()
+        mosaic = scenes.mosaic().select(bands).set('system:time_start', ee.Date(date).millis(),
+                                                   'system:footprint', tools.imagecollection.mergeGeometries(scenes))
+
+        def reproject(bname, mos, first_img=first_img):
+            bname = ee.String(bname)
+            mos = ee.Image(mos)
+            return tools.image.replace(mos, bname, mos.select(bname).setDefaultProjection(first_img.select(bname).projection()))
+
+        mosaics.append(ee.Image(bands.iterate(reproject, mosaic)))
+
+    if mosaics:
+        images = images.merge(ee.ImageCollection(mosaics))
+    return images.sort('system:time_start')
+
+# Input bands of each water index
+water_index_bands = {
+    'NDWI': ['green', 'nir'],
+    'MNDWI': ['green', 'swir1'],
+    'AWEInsh': ['green', 'nir', 'swir1', 'swir2'],
+    'AWEIsh': ['blue', 'green', 'nir', 'swir1', 'swir2'],
+    'DSWE': ['blue', 'green', 'red', 'nir', 'swir1', 'swir2', 'pixel_qa']
+    }
+
+# Input bands of the depth methods that use spectral bands
+depth_method_bands = {
+    'Random Forest': ['green', 'swir1'],
+    'Mod_Stumpf': ['green', 'swir1'],
+    'Mod_Lyzenga': ['green', 'swir1']
+    }
+
+def band_requirements(imageType, water_index, depth_method=None):
+    """Lists the bands each pipeline stage needs for a platform, water index and depth method
+    Args:
+        imageType (str): Satellite platform, e.g. 'Landsat-Collection 2'
+        water_index (str): Water index, e.g. 'NDWI' (or the band for Sentinel-1)
+        depth_method (str, optional): Depth estimation method; bands of every method of the platform are kept if None.
+    Returns:
+        dict: Band lists for the 'index', 'display' and 'depth' stages, the 'input' bands to select before
+              water extraction and the 'carry' bands to keep after it
+    """
+    if imageType == 'Sentinel-1':
+        index = [water_index]
+        display = ['VV', 'VH']
+        depth = []
+    elif imageType == 'USDA NAIP':
+        index = ['G', 'N']
+        display = ['R', 'G', 'B']
+        depth = []
+    else:
+        index = list(water_index_bands[water_index])
+        display = ['red', 'green', 'blue']
+        if depth_method is None:
+            depth = sorted(set(b for bands in depth_method_bands.values() for b in bands))
+        else:
+            depth = depth_method_bands.get(depth_method, [])
+
+    def union(*lists):
+        bands = []
+        for lst in lists:
+            bands += [b for b in lst if b not in bands]
+        return bands
+
+    return {'index': index,
+            'display': display,
+            'depth': depth,
+            'input': union(index, display, depth),
+            'carry': union(display, depth, ['water', 'waterMask'])}
+
+def estimate_image_bytes(img, region, scale):
+    """Estimates the uncompressed size of an image over a region from its band types
+    Args:
+        img (object): ee.Image
+        region (object): ee.Geometry of the download region
+        scale (float): Download scale in meters
+    Returns:
+        int: Estimated number of bytes
+    """
+    info = get_info(ee.Dictionary({'types': img.bandTypes(), 'area': region.area(1)}))
+    pixels = info['area'] / (scale * scale)
+    total = 0
+    for band_type in info['types'].values():
+        if band_type.get('precision') == 'double':
+            size = 8
+        elif band_type.get('precision') == 'float':
+            size = 4
+        else:
+            span = max(abs(band_type.get('min', 0)), abs(band_type.get('max', 0)))
+            size = 1 if span < 2**8 else 2 if span < 2**16 else 4 if span < 2**32 else 8
+        total += size
+    return int(total * pixels)
+
+def frequency_groups(grouping, StartDate=None, EndDate=None):
+    """Lists the calendar groups of a grouped water frequency
+    Args:
+        grouping (str): 'Monthly', 'Seasonal' or 'Yearly'
+        StartDate (datetime, optional): Start of the study period; required for 'Yearly'.
+        EndDate (datetime, optional): End of the study period; required for 'Yearly'.
+    Returns:
+        tuple: (group keys, band names)
+    """
+    if grouping == 'Monthly':
+        keys = list(range(1, 13))
+        names = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+    elif grouping == 'Seasonal':
+        keys = [0, 1, 2, 3]
+        names = ['DJF', 'MAM', 'JJA', 'SON']
+    elif grouping == 'Yearly':
+        keys = list(range(StartDate.year, EndDate.year + 1))
+        names = [str(k) for k in keys]
+    else:
+        raise ValueError(f'Unknown grouping: {grouping}')
+    return keys, names
+
+def grouped_water_frequency(water_images, grouping, StartDate=None, EndDate=None):
+    """Computes water occurrence frequency for every month, season or year with a single reduction.
+    Each image is tagged with its calendar group and spread into one band per group, so the water and
+    valid-observation counts of all groups come from one sum over the collection.
+    Args:
+        water_images (object): ee.ImageCollection with a 'water' band (1 water, 0 dry, masked if not observed)
+        grouping (str): 'Monthly', 'Seasonal' (DJF, MAM, JJA, SON) or 'Yearly'
+        StartDate (datetime, optional): Start of the study period; required for 'Yearly'.
+        EndDate (datetime, optional): End of the study period; required for 'Yearly'.
+    Returns:
+        object: ee.Image with one frequency band (percent) per group
+    """
+    keys, names = frequency_groups(grouping, StartDate, EndDate)
+    group_keys = ee.Image.constant(keys)
+
+    def tag(img):
+        date = img.date()
+        if grouping == 'Monthly':
+            group = date.get('month')
+        elif grouping == 'Seasonal':
+            group = ee.Number(date.get('month')).mod(12).divide(3).floor()
+        else:
+            group = date.get('year')
+        in_group = group_keys.eq(ee.Image.constant(group))
+        water = img.select('water')
+        observed = water.mask().gt(0)
+        return in_group.multiply(water.unmask(0).And(observed)).rename(['w_' + n for n in names])\
+                .addBands(in_group.multiply(observed).rename(['n_' + n for n in names])).toUint16()
+
+    counts = water_images.map(tag).sum()
+    water_count = counts.select(['w_' + n for n in names])
+    obs_count = counts.select(['n_' + n for n in names])
+    frequency = water_count.divide(obs_count).multiply(100).rename(names)
+    return frequency.updateMask(obs_count.gt(0))
+
+def hydroperiod(water_images):
+    """Computes per-pixel hydroperiod metrics in one pass over a per-pixel time array.
+    Every observation of a pixel lasts until its next valid observation (one day for the last one),
+    so runs are measured in days and dates that are not observed at a pixel are skipped.
+    Args:
+        water_images (object): ee.ImageCollection with a 'water' band (1 water, 0 dry, masked if not observed)
+    Returns:
+        object: ee.Image with 'inundated_days', 'longest_wet_run' (days), 'first_wet' and 'last_wet'
+                (days since 1970-01-01) bands
+    """
+    def add_time(img):
+        water = img.select('water')
+        days = ee.Image.constant(img.date().millis().divide(86400000)).updateMask(water.mask())
+        return water.toDouble().addBands(days.toDouble().rename('t'))
+
+    array = water_images.sort('system:time_start').map(add_time).toArray()
+    array = array.updateMask(array.arrayLength(0).gt(0))
+    wet = array.arraySlice(1, 0, 1)
+    dry = wet.multiply(-1).add(1)
+    t = array.arraySlice(1, 1, 2)
+
+    # Each observation lasts until the next one; the last observation lasts one day
+    next_t = t.arraySlice(0, 1).arrayCat(t.arraySlice(0, -1).add(1), 0)
+    wet_days = wet.multiply(next_t.subtract(t))
+
+    # Run lengths: cumulative wet days minus the cumulative total reached at the last dry observation
+    cum = wet_days.arrayAccum(0, ee.Reducer.sum())
+    reset = cum.multiply(dry).arrayAccum(0, ee.Reducer.max())
+    runs = cum.subtract(reset)
+
+    inundated = wet_days.arrayReduce(ee.Reducer.sum(), [0]).arrayGet([0, 0]).rename('inundated_days')
+    longest = runs.arrayReduce(ee.Reducer.max(), [0]).arrayGet([0, 0]).rename('longest_wet_run')
+    first = t.add(dry.multiply(1e9)).arrayReduce(ee.Reducer.min(), [0]).arrayGet([0, 0]).rename('first_wet')
+    last = t.multiply(wet).arrayReduce(ee.Reducer.max(), [0]).arrayGet([0, 0]).rename('last_wet')
+
+    ever_wet = inundated.gt(0)
+    return inundated.addBands([longest, first.updateMask(ever_wet), last.updateMask(ever_wet)])
+
 def compute_histogram(img,aoi,img_scale):
     
     reducers = ee.Reducer.histogram(255,2).combine(reducer2=ee.Reducer.mean(), sharedInputs=True)\
@@ -678,7 +1319,7 @@ def image_scale(img):
     Returns:
         float: The nominal scale in meters.
     """   
-    return img.projection().nominalScale().getInfo()
+    return get_info(img.projection().nominalScale())
 
 def image_max_value(img, region=None, scale=None):
     """Retrieves the maximum value of an image.
@@ -702,7 +1343,7 @@ def image_max_value(img, region=None, scale=None):
         'maxPixels': 1e12,
         'bestEffort':True
         }).values().get(0))
-    return max_value.getInfo()
+    return get_info(max_value)
 
 def image_min_value(img, region=None, scale=None):
     """Retrieves the minimum value of an image.
@@ -726,7 +1367,7 @@ def image_min_value(img, region=None, scale=None):
         'maxPixels': 1e12,
         'bestEffort':True
     }).values().get(0))
-    return min_value.getInfo()
+    return get_info(min_value)
 
 def estimateDepths_FromDEM(dem, site, img_scale):
     """Estimates water depth based on water extent and DEM elevations
@@ -767,6 +1408,73 @@ def estimateDepths_FromDEM(dem, site, img_scale):
         return img.addBands(DepthFilter)
     return wrap
 
+def estimateDepths_FromDEM_Raster(dem, site, img_scale, maxSize=1024, coarse_factor=16):
+    """Estimates water depth based on water extent and DEM elevations without leaving raster space.
+    Each water body is labelled with connectedComponents (4-connected, as in estimateDepths_FromDEM)
+    and the maximum DEM elevation of every label is spread back over its pixels with
+    reduceConnectedComponents, replacing the reduceToVectors/reduceRegions/reduceToImage round trip.
+    Water bodies wider than maxSize pixels cannot be labelled by Earth Engine; they are labelled again
+    at coarse_factor times the scale and get the maximum elevation of their own coarse label, from one
+    grouped reduceRegion, so separate large water bodies keep separate levels. Only water bodies wider
+    than maxSize * coarse_factor pixels share the maximum elevation of all remaining unlabelled water.
+    Args:
+        dem (object): Elevation data
+        site (object): The region over which to reduce data.
+        img_scale (float): A nominal scale in meters of the projection to work in.
+        maxSize (int, optional): Maximum size of a labelled water body in pixels (at most 1024). Defaults to 1024.
+        coarse_factor (int, optional): Scale factor of the labelling of larger water bodies (at most 256). Defaults to 16.
+    Returns:
+        object: ee.Image
+    """
+    proj = dem.projection().atScale(img_scale)
+    coarse_proj = proj.scale(coarse_factor, coarse_factor)
+
+    def wrap(img):
+        """Estimates water depth based on water extent and DEM elevations
+        Args:
+            img (object): Water mask
+        Returns:
+            object: ee.Image
+        """
+        flood = img.select('waterMask')
+        dem_mask = dem.mask(flood)
+
+        labels = flood.selfMask().connectedComponents(ee.Kernel.plus(1), maxSize).select('labels')
+        maxImage = dem_mask.rename('elevation').addBands(labels)\
+                    .reduceConnectedComponents(ee.Reducer.max(), 'labels', maxSize)
+
+        # Water bodies larger than maxSize are left unlabelled: label them at a coarser scale
+        unlabelled = dem_mask.updateMask(labels.mask().Not())
+        large_water = flood.selfMask().updateMask(labels.mask().Not()).unmask(0).reproject(proj)\
+                    .reduceResolution(ee.Reducer.max(), False, coarse_factor * coarse_factor).reproject(coarse_proj)
+        zones = large_water.selfMask().connectedComponents(ee.Kernel.plus(1), maxSize).select('labels')\
+                    .reproject(coarse_proj)
+        zone_stats = ee.List(unlabelled.rename('elevation').addBands(zones).reduceRegion(**{
+                            'reducer': ee.Reducer.max().group(1, 'zone'),
+                            'geometry': site,
+                            'scale': img_scale,
+                            'maxPixels': 1e13,
+                            'bestEffort': True
+                            }).get('groups'))
+        zone_max = zones.remap(zone_stats.map(lambda g: ee.Dictionary(g).get('zone')),
+                               zone_stats.map(lambda g: ee.Dictionary(g).get('max')))
+
+        # Water bodies too large even for the coarse labelling share one level
+        fallback_max = unlabelled.updateMask(zone_max.mask().Not()).reduceRegion(**{
+                            'reducer': ee.Reducer.max(),
+                            'geometry': site,
+                            'scale': img_scale,
+                            'maxPixels': 1e13,
+                            'bestEffort': True
+                            }).values().get(0)
+        fallback_max = ee.Algorithms.If(fallback_max, fallback_max, 0)
+        maxImage = maxImage.unmask(zone_max).unmask(ee.Image.constant(fallback_max)).updateMask(flood)
+
+        Depths = maxImage.subtract(dem_mask).rename('Depth')
+        DepthFilter = Depths.where(Depths.lt(0),0)
+        return img.addBands(DepthFilter)
+    return wrap
+
 # def estimateDepths_Experimental(dem, site, img_scale):
 #     """Estimates water depth based on water extent and DEM elevations
 #     Args:
@@ -811,7 +1519,7 @@ def estimateDepths_FromDEM(dem, site, img_scale):
 
 def add_depth_variables(img):
     orig = img
-    scaled_image = img.multiply(1000)
+    scaled_image = img.select(['green','swir1']).multiply(1000)
     mod_green = scaled_image.select('green').log().rename('mod_green')
     mod_swir1 = scaled_image.select('swir1').log().rename('mod_swir1')
     stumpf = mod_green.divide(mod_swir1).rename('Stumpf')
@@ -858,25 +1566,556 @@ def FwDET_Depth_Estimate(dem):
         return img.addBands(depth_map).copyProperties(orig, orig.propertyNames())
     return wrap
 
-def local_download(img, filename, region, scale):
+def pipeline_config_hash(params):
+    """Hashes the parameters of a pipeline run, so stored results can be matched to the configuration that produced them
+    Args:
+        params (dict): JSON serializable parameters; a 'boundary' file is hashed by content
+    Returns:
+        str: Hex digest
+    """
+    params = dict(params)
+    if params.get('boundary') and os.path.exists(params['boundary']):
+        params['boundary'] = boundary_file_hash(params['boundary'])
+    return hashlib.md5(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+
+# Divisor and symbol of each area unit
+area_units = {'Square m': (1, 'Sq m'), 'Square Km': (1e6, 'Sq km'), 'Hectares': (1e4, 'Ha'), 'Acre': (4047, 'acre')}
+
+# Multiplier and symbol of each volume unit
+volume_units = {'Cubic m': (1, 'cu m'), 'Cubic ft': (35.3147, 'cu ft'), 'Litres': (1e3, 'litres'), 'ac-ft': (1.0/1233, 'ac-ft')}
+
+# Random forest depth model shipped with the toolbox
+rf_model_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ML_models', 'Landsat_RF_model.sav')
+
+def load_platform_images(imageType, site, site_bounds, StartDate, EndDate, cloud_thresh, clear_thresh=0,
+                         filterType='Refined-Lee', terrain_asset_root=None, scene_ids=None, clear_ids=None):
+    """Retrieves the cloud masked (optical) or slope corrected and speckle filtered (SAR) images of a platform
+    Args:
+        imageType (str): Satellite platform
+        site (object): ee.FeatureCollection of the study area
+        site_bounds (object): ee.FeatureCollection of the study area bounding box, used for filterBounds
+        StartDate (object): ee.Date start of the study period
+        EndDate (object): ee.Date end of the study period
+        cloud_thresh (float): Threshold for filtering cloudy images
+        clear_thresh (float, optional): Minimum fraction (0-1) of clear AOI pixels to keep an image. Defaults to 0.
+        filterType (str, optional): Sentinel-1 speckle filter. Defaults to 'Refined-Lee'.
+        terrain_asset_root (str, optional): Asset folder of exported terrain layers. Defaults to None.
+        scene_ids (dict, optional): Scene ids selected from the local scene catalog. Defaults to None.
+        clear_ids (list, optional): Image ids kept by an earlier run of the AOI prefilter (its report's 'kept_ids');
+            the prefilter request is skipped. Defaults to None.
+    Returns:
+        tuple: (ee.ImageCollection, Landsat collection before cloud masking or None, AOI prefilter report or None)
+    """
+    filtered_landsat = None
+    report = None
+
+    def prefilter(collection, mask_function, img_scale):
+        # Drop scenes that are clouded over the study area before any heavy stage
+        if clear_ids is not None:
+            return collection.filter(ee.Filter.inList('system:index', clear_ids)), None
+        return filter_AOI_clear_fraction(collection, site, clear_thresh, mask_function, img_scale=img_scale)
+
+    if imageType == 'Landsat-Collection 2':
+        filtered_landsat = load_Landsat_Coll_2(site_bounds, StartDate, EndDate, cloud_thresh, scene_ids)
+        if clear_thresh > 0:
+            filtered_landsat, report = prefilter(filtered_landsat, maskLandsatclouds, 30)
+        filtered_Collection = filtered_landsat.map(maskLandsatclouds)
+    elif imageType == 'Sentinel-2':
+        Collection_before = load_Sentinel2(site_bounds, StartDate, EndDate, cloud_thresh, scene_ids)
+        if clear_thresh > 0:
+            Collection_before, report = prefilter(Collection_before, maskS2clouds, 10)
+        filtered_Collection = Collection_before.map(maskS2clouds)
+    elif imageType == 'Sentinel-1':
+        Collection_before = load_Sentinel1(site_bounds, StartDate, EndDate, scene_ids)
+        terrain = get_terrain_layers('USGS/SRTMGL1_003', 'elevation', site, terrain_asset_root)
+        slope_correction = slope_correction_terrain(terrain)
+        boxcar = ee.Kernel.circle(**{'radius':3, 'units':'pixels', 'normalize':True})
+
+        def filtr(img):
+            return img.convolve(boxcar)
+
+        speckle_filters = {'Gamma MAP': hf.gamma_map, 'Refined-Lee': hf.refined_lee, 'Perona-Malik': hf.perona_malik,
+                           'P-median': hf.p_median, 'Boxcar Convolution': filtr}
+        if filterType == 'Lee Sigma':
+            # slope correction before lee_sigma fails
+            filtered_Collection = Collection_before.map(hf.lee_sigma)
+        else:
+            filtered_Collection = Collection_before.map(slope_correction).map(speckle_filters[filterType])
+    elif imageType == 'USDA NAIP':
+        filtered_Collection = load_NAIP(site_bounds, StartDate, EndDate, scene_ids)
+    return filtered_Collection, filtered_landsat, report
+
+def water_index_function(imageType, water_index):
+    """Builds the function adding a 'waterIndex' band (NDWI, MNDWI, AWEInsh or AWEIsh) to optical images
+    Args:
+        imageType (str): Satellite platform
+        water_index (str): Water index
+    Returns:
+        function: Function to map over the images
+    """
+    def wrap(img):
+        index_image = ee.Image(1)
+        if water_index == 'NDWI':
+            if imageType == 'Landsat-Collection 2' or imageType == 'Sentinel-2':
+                bands = ['green', 'nir']
+            elif imageType == 'USDA NAIP':
+                bands = ['G', 'N']
+            index_image = img.normalizedDifference(bands).rename('waterIndex')\
+                .copyProperties(img, ['system:time_start'])
+
+        elif water_index == 'MNDWI':
+            if imageType == 'Landsat-Collection 2':
+                bands = ['green', 'swir1']
+                index_image = img.normalizedDifference(bands).rename('waterIndex')\
+                    .copyProperties(img, ['system:time_start'])
+
+            elif imageType == 'Sentinel-2':
+                # Resample only the index bands; swir1 from 20m to 10m
+                bands = ['green', 'swir1']
+                resampled = img.select(bands).resample('bilinear').reproject(**
+                            {'crs': img.select('swir1').projection().crs(),
+                            'scale':10
+                            })
+                index_image = resampled.normalizedDifference(bands).rename('waterIndex')\
+                    .copyProperties(img, ['system:time_start'])
+
+        elif water_index == 'AWEInsh':
+            index_image = img.expression(
+                    '(4 * (GREEN - SWIR1)) - ((0.25 * NIR)+(2.75 * SWIR2))', {
+                        'NIR': img.select('nir'),
+                        'GREEN': img.select('green'),
+                        'SWIR1': img.select('swir1'),
+                        'SWIR2': img.select('swir2')
+                    }).rename('waterIndex').copyProperties(img, ['system:time_start'])
+
+        elif water_index == 'AWEIsh':
+            index_image = img.expression(
+                    '(BLUE + (2.5 * GREEN) - (1.5 * (NIR + SWIR1)) - (0.25 * SWIR2))', {
+                        'BLUE':img.select('blue'),
+                        'NIR': img.select('nir'),
+                        'GREEN': img.select('green'),
+                        'SWIR1': img.select('swir1'),
+                        'SWIR2': img.select('swir2')
+                    }).rename('waterIndex').copyProperties(img, ['system:time_start'])
+
+        return img.addBands(index_image)
+    return wrap
+
+def water_threshold_function(method, threshold, site, img_scale):
+    """Builds the function adding a 'water' band by thresholding the 'waterIndex' band
+    Args:
+        method (str): 'Simple' (fixed threshold) or 'Otsu' (per image threshold over the study area)
+        threshold (float): Threshold of the 'Simple' method
+        site (object): ee.FeatureCollection of the study area
+        img_scale (float): A nominal scale in meters of the projection to work in.
+    Returns:
+        function: Function to map over the images
+    """
+    def wrap(img):
+        if method == 'Simple': # Simple value no dynamic thresholding
+            water_image = img.select('waterIndex').gt(threshold).rename('water')\
+            .copyProperties(img, ['system:time_start'])
+        elif method == 'Otsu':
+            reducers = ee.Reducer.histogram(255,2).combine(reducer2=ee.Reducer.mean(), sharedInputs=True)\
+                .combine(reducer2=ee.Reducer.variance(), sharedInputs= True)
+
+            histogram = img.select('waterIndex').reduceRegion(
+                            reducer=reducers,
+                            geometry=site.geometry(),
+                            scale=img_scale,
+                            bestEffort=True)
+            nd_threshold = otsu(histogram.get('waterIndex_histogram')) # get threshold from the nir band
+
+            water_image = img.select('waterIndex').gt(nd_threshold).rename('water')
+            water_image = water_image.copyProperties(img, ['system:time_start'])
+
+        return img.addBands(water_image)
+    return wrap
+
+def s1_water_function(band, site, img_scale):
+    """Builds the function adding a 'water' band to Sentinel-1 images with the Otsu algorithm
+    Args:
+        band (str): Polarisation band, 'VV' or 'VH'
+        site (object): ee.FeatureCollection of the study area
+        img_scale (float): A nominal scale in meters of the projection to work in.
+    Returns:
+        function: Function to map over the images
+    """
+    def wrap(img):
+        reducers = ee.Reducer.histogram(255,2).combine(reducer2=ee.Reducer.mean(), sharedInputs=True)\
+            .combine(reducer2=ee.Reducer.variance(), sharedInputs= True)
+        histogram = img.select(band).reduceRegion(
+        reducer=reducers,
+        geometry=site.geometry(),
+        scale=img_scale,
+        bestEffort=True)
+
+        # Calculate threshold via function otsu (see before)
+        threshold = otsu(histogram.get(band+'_histogram'))
+
+        # get watermask
+        waterMask = img.select(band).lt(threshold).rename('water')
+        return img.addBands(waterMask)
+    return wrap
+
+def dswe_water_function(threshold):
+    """Builds the function adding a 'water' band with the DSWE classes 1 to threshold
+    Args:
+        threshold (int): Highest DSWE class counted as water
+    Returns:
+        function: Function to map over the DSWE images
+    """
+    def wrap(img):
+        nd_threshold = threshold+1
+        waterImage = img.select('dswe').rename('water')
+        water = waterImage.gt(0).And(waterImage.lt(nd_threshold)).copyProperties(img, ['system:time_start'])
+        return img.addBands(water)
+    return wrap
+
+def add_water_mask(img):
+    """Adds the 'waterMask' band (water pixels only) of the 'water' band"""
+    waterMask = img.select('water').selfMask().rename('waterMask').copyProperties(img, ['system:time_start'])
+    return img.addBands(waterMask)
+
+def extract_water(images, imageType, water_index, threshold_method, threshold, site, img_scale,
+                  landsat_images=None, terrain=None, plan=None, dswe_aoi=None):
+    """Extracts surface water from processed images, as the Water Extraction tab does
+    Args:
+        images (object): Processed ee.ImageCollection (e.g. clipped_images)
+        imageType (str): Satellite platform
+        water_index (str): Water index ('NDWI', 'MNDWI', 'DSWE', 'AWEInsh', 'AWEIsh') or polarisation band for Sentinel-1
+        threshold_method (str): 'Simple' or 'Otsu'
+        threshold (float): Threshold of the 'Simple' method, or highest DSWE class counted as water
+        site (object): ee.FeatureCollection of the study area
+        img_scale (float): A nominal scale in meters of the projection to work in.
+        landsat_images (object, optional): Landsat collection before cloud masking; required for DSWE.
+        terrain (object, optional): Terrain layers for DSWE (see get_terrain_layers).
+        plan (dict, optional): Same-day mosaic plan for DSWE (see same_day_plan).
+        dswe_aoi (object, optional): Area DSWE images are clipped to; not clipped if None.
+    Returns:
+        dict: 'water_images', 'WaterMasks', 'index_images' and 'dswe_images' (None when not computed)
+    """
+    # Bands needed by water extraction, display and depth estimation
+    stage_bands = band_requirements(imageType, water_index)
+    input_images = images.select(stage_bands['input'])
+    result = {'index_images': None, 'dswe_images': None}
+
+    if imageType == 'Sentinel-1':
+        result['water_images'] = input_images.map(s1_water_function(water_index, site, img_scale))
+    elif imageType == 'Landsat-Collection 2' and water_index == 'DSWE':
+        dem = ee.Image('USGS/SRTMGL1_003')
+        result['dswe_images'] = DSWE_2(landsat_images, dem, dswe_aoi, terrain=terrain, plan=plan)
+        result['water_images'] = result['dswe_images'].map(dswe_water_function(threshold))
+    else:
+        result['index_images'] = input_images.map(water_index_function(imageType, water_index))
+        result['water_images'] = result['index_images'].map(water_threshold_function(threshold_method, threshold,
+                                                                                     site, img_scale))
+    result['WaterMasks'] = result['water_images'].map(add_water_mask).select(stage_bands['carry'])
+    return result
+
+def water_area_function(site, img_scale, divisor=1):
+    """Builds the function setting the total water area ('water_area') of a water mask image
+    Args:
+        site (object): ee.FeatureCollection of the study area
+        img_scale (float): A nominal scale in meters of the projection to work in.
+        divisor (float, optional): Square meters per area unit (see area_units). Defaults to 1.
+    Returns:
+        function: Function to map over the water masks
+    """
+    def wrap(img):
+        pixel_area = img.select('waterMask').multiply(ee.Image.pixelArea()).divide(divisor)
+        img_area = pixel_area.reduceRegion(**{
+                            'geometry': site.geometry(),
+                            'reducer': ee.Reducer.sum(),
+                            'scale': img_scale,
+                            'maxPixels': 1e13
+                            })
+        return img.set({'water_area': img_area})
+    return wrap
+
+def water_volume_function(site, img_scale, multiplier=1):
+    """Builds the function setting the total water volume ('volume') of a depth image
+    Args:
+        site (object): ee.FeatureCollection of the study area
+        img_scale (float): A nominal scale in meters of the projection to work in.
+        multiplier (float, optional): Volume units per cubic meter (see volume_units). Defaults to 1.
+    Returns:
+        function: Function to map over the depth maps
+    """
+    def wrap(img):
+        depth = img.select('Depth')
+        volume = depth.multiply(ee.Image.pixelArea()).multiply(multiplier)
+        total_volume = volume.reduceRegion(**{
+                        'reducer':ee.Reducer.sum(),
+                        'geometry':site.geometry(),
+                        'scale':img_scale,
+                        'maxPixels':1e13})
+        return img.set({'volume':total_volume})
+    return wrap
+
+def load_rf_classifier(filename=None):
+    """Loads the random forest depth model as an Earth Engine classifier
+    Args:
+        filename (str, optional): Pickled scikit-learn model. Defaults to rf_model_file.
+    Returns:
+        object: ee.Classifier
+    """
+    feature_names = ['mod_green','mod_swir1']
+    with open(filename or rf_model_file, 'rb') as f:
+        loaded_model = pickle.load(f)
+    trees =  ml.rf_to_strings(loaded_model,feature_names)
+    return ml.strings_to_classifier(trees)
+
+def depth_estimates(water_masks, method, dem, site, img_scale, rf_classifier=None):
+    """Estimates water depth maps with one of the depth methods of the toolbox
+    Args:
+        water_masks (object): ee.ImageCollection of water masks (e.g. WaterMasks)
+        method (str): 'Random Forest', 'Mod_Stumpf', 'Mod_Lyzenga', 'FwDET' or 'DEM Max'
+        dem (object): Elevation data
+        site (object): ee.FeatureCollection of the study area
+        img_scale (float): A nominal scale in meters of the projection to work in.
+        rf_classifier (object, optional): Random forest classifier; loaded with load_rf_classifier if None.
+    Returns:
+        tuple: (ee.ImageCollection of depth maps, random forest classifier or None)
+    """
+    def count_water_pixels(img):
+        count = img.select('waterMask').reduceRegion(ee.Reducer.sum(), site).values().get(0)
+        return img.set({'pixel_count': count})
+
+    # Filter out only images containing water pixels to avoid error in depth estimation
+    water_images = water_masks.map(count_water_pixels).filter(ee.Filter.gt('pixel_count', 0))
+
+    if method == 'Random Forest':
+        if rf_classifier is None:
+            rf_classifier = load_rf_classifier()
+        depth_maps = water_masks.map(add_depth_variables).map(RF_Depth_Estimate(rf_classifier))
+    elif method == 'Mod_Stumpf':
+        depth_maps = water_masks.map(add_depth_variables).map(Mod_Stumpf_Depth_Estimate)
+    elif method == 'Mod_Lyzenga':
+        depth_maps = water_masks.map(add_depth_variables).map(Mod_Lyzenga_Depth_Estimate)
+    elif method == 'FwDET':
+        depth_maps = water_images.map(FwDET_Depth_Estimate(dem))
+    else:
+        depth_maps = water_images.map(estimateDepths_FromDEM_Raster(dem, site.geometry(), img_scale))
+    return depth_maps, rf_classifier
+
+def serialize_ee_objects(objects):
+    """Serializes Earth Engine objects with the ee serializer; only the expression graphs are stored, nothing is computed
+    Args:
+        objects (dict): Earth Engine objects keyed by name; None values are skipped
+    Returns:
+        dict: (class name, serialized expression) keyed by name
+    """
+    return {name: (type(obj).__name__, obj.serialize()) for name, obj in objects.items() if obj is not None}
+
+def deserialize_ee_objects(serialized):
+    """Rebuilds Earth Engine objects serialized with serialize_ee_objects
+    Args:
+        serialized (dict): (class name, serialized expression) keyed by name
+    Returns:
+        dict: Earth Engine objects keyed by name, cast back to their classes (e.g. ee.ImageCollection)
+    """
+    objects = {}
+    for name, (class_name, expression) in serialized.items():
+        obj = ee.deserializer.fromJSON(expression)
+        cls = getattr(ee, class_name, None)
+        objects[name] = cls(obj) if isinstance(cls, type) and not isinstance(obj, cls) else obj
+    return objects
+
+def gauge_points(pointfile, id_column=None):
+    """Loads gauge locations as a point FeatureCollection with a 'gauge' property
+    Args:
+        pointfile (str): CSV with longitude and latitude columns (lon/long/longitude/x, lat/latitude/y),
+            or a shapefile, KML, KMZ or GeoJSON of points
+        id_column (str, optional): Column or property naming the gauges. Defaults to 'gauge', 'id' or 'name'
+            when present, otherwise the row number.
+    Returns:
+        object: ee.FeatureCollection of points
+    """
+    if os.path.splitext(pointfile)[1].lower() == '.csv':
+        with open(pointfile, newline='') as f:
+            rows = list(csv.DictReader(f))
+        columns = {c.strip().lower(): c for c in rows[0].keys()} if rows else {}
+        lon = [columns[c] for c in ['lon', 'long', 'longitude', 'x'] if c in columns][0]
+        lat = [columns[c] for c in ['lat', 'latitude', 'y'] if c in columns][0]
+        records = [{'coordinates': [float(row[lon]), float(row[lat])], 'properties': row} for row in rows]
+    else:
+        records = [{'coordinates': f['geometry']['coordinates'], 'properties': f['properties'] or {}}
+                   for f in boundary_geojson(pointfile)['features'] if f['geometry']['type'] == 'Point']
+
+    features = []
+    for i, record in enumerate(records):
+        properties = {k.strip().lower(): v for k, v in record['properties'].items()}
+        name = [properties[c] for c in [(id_column or '').lower(), 'gauge', 'id', 'name'] if c in properties]
+        features.append(ee.Feature(ee.Geometry.Point(record['coordinates'][:2]),
+                                   {'gauge': str(name[0]) if name else str(i + 1)}))
+    return ee.FeatureCollection(features)
+
+def date_chunks(StartDate, EndDate, chunk_days=365):
+    """Splits a study period into consecutive date ranges
+    Args:
+        StartDate (datetime): Start of the study period
+        EndDate (datetime): End of the study period (inclusive)
+        chunk_days (int, optional): Length of each range in days. Defaults to 365.
+    Returns:
+        list: ('YYYY-MM-dd', 'YYYY-MM-dd') ranges, end exclusive, for filterDate
+    """
+    chunks = []
+    start = StartDate
+    while start <= EndDate:
+        end = min(start + timedelta(days=chunk_days), EndDate + timedelta(days=1))
+        chunks.append((start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')))
+        start = end
+    return chunks
+
+def depth_hydrographs(depth_maps, points, scale, StartDate, EndDate, band='Depth', chunk_days=365, workers=4):
+    """Extracts the depth of many gauges at all dates with batched reduceRegions requests.
+    Each date range is fetched with one request holding every (date, gauge) value.
+    Args:
+        depth_maps (object): ee.ImageCollection with a depth band
+        points (object): ee.FeatureCollection of points with a 'gauge' property (see gauge_points)
+        scale (float): A nominal scale in meters of the projection to work in.
+        StartDate (datetime): Start of the study period
+        EndDate (datetime): End of the study period (inclusive)
+        band (str, optional): Band to extract. Defaults to 'Depth'.
+        chunk_days (int, optional): Days per request, lower it for many gauges or dense series. Defaults to 365.
+        workers (int, optional): Number of concurrent requests. Defaults to 4.
+    Returns:
+        object: pandas.DataFrame indexed by date with one column per gauge; masked values are NaN
+    """
+    def sample(img):
+        values = img.select(band).unmask(-9999).reduceRegions(**{
+            'collection': points,
+            'reducer': ee.Reducer.first().setOutputs([band]),
+            'scale': scale
+            })
+        date = img.date().format('YYYY-MM-dd')
+        return values.map(lambda f: f.set('date', date))
+
+    def fetch(chunk):
+        samples = depth_maps.filterDate(chunk[0], chunk[1]).map(sample).flatten()
+        return get_info(samples.reduceColumns(ee.Reducer.toList(3), ['date', 'gauge', band]).get('list'))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        rows = [row for chunk_rows in executor.map(fetch, date_chunks(StartDate, EndDate, chunk_days))
+                for row in chunk_rows]
+
+    df = pd.DataFrame(rows, columns=['date', 'gauge', band])
+    df['date'] = pd.to_datetime(df['date'])
+    df[band] = df[band].where(df[band] != -9999)
+    return df.pivot_table(index='date', columns='gauge', values=band, aggfunc='mean', dropna=False)
+
+# Export profiles: bands to keep (None for all), scale factor, data type and nodata value of each product
+export_profiles = {
+    'Satellite': {
+        'Landsat-Collection 2': {'bands': ['blue', 'green', 'red', 'nir', 'swir1', 'swir2'], 'scale': 10000,
+                                 'dtype': 'int16', 'nodata': -32768},
+        'Sentinel-2': {'bands': ['blue', 'green', 'red', 'nir', 'swir1', 'swir2'], 'scale': 1,
+                       'dtype': 'int16', 'nodata': -32768},
+        'Sentinel-1': {'bands': None, 'scale': 100, 'dtype': 'int16', 'nodata': -32768},
+        'USDA NAIP': {'bands': None, 'scale': 1, 'dtype': 'uint16', 'nodata': 65535}},  # digital numbers use all of 0-255
+    'Water': {'bands': ['water'], 'scale': 1, 'dtype': 'uint8', 'nodata': 255},        # 1 water, 0 dry, 255 not observed
+    'Frequency': {'bands': None, 'scale': 1, 'dtype': 'uint16', 'nodata': 65535},     # percent of dates with water
+    'Depth': {'bands': ['Depth'], 'scale': 100, 'dtype': 'int16', 'nodata': -32768},    # depth in cm
+    'DSWE': {'bands': ['dswe'], 'scale': 1, 'dtype': 'uint8', 'nodata': 255},
+    'Hydroperiod': {'bands': None, 'scale': 1, 'dtype': 'uint16', 'nodata': 65535}
+    }
+
+def export_profile(product, imageType=None):
+    """Retrieves the export profile of a product
+    Args:
+        product (str): 'Satellite', 'Water', 'Frequency', 'Depth', 'DSWE' or 'Hydroperiod'
+        imageType (str, optional): Satellite platform; required for 'Satellite'.
+    Returns:
+        dict: 'bands', 'scale', 'dtype' and 'nodata' of the product
+    """
+    profile = export_profiles[product]
+    if product == 'Satellite':
+        profile = profile[imageType]
+    return profile
+
+def apply_export_profile(img, profile):
+    """Selects, scales and casts an image to the minimal data type of its export profile
+    Args:
+        img (object): ee.Image to export
+        profile (dict): Export profile (see export_profile)
+    Returns:
+        object: ee.Image with masked pixels set to the profile's nodata value
+    """
+    orig = img
+    if profile['bands'] is not None:
+        img = img.select(profile['bands'])
+    img = img.multiply(profile['scale']).round()
+    cast = getattr(ee.Image, ee_cast_methods[profile['dtype']])
+    return cast(img).unmask(profile['nodata']).copyProperties(orig, orig.propertyNames())
+
+def export_profile_report(img, profile, region, scale):
+    """Reports the download size of an image with and without its export profile
+    Args:
+        img (object): ee.Image as produced by the toolbox
+        profile (dict): Export profile (see export_profile)
+        region (object): ee.Geometry of the download region
+        scale (float): Download scale in meters
+    Returns:
+        dict: Estimated bytes before and after the profile and the saving in percent
+    """
+    original = estimate_image_bytes(img, region, scale)
+    profiled = estimate_image_bytes(apply_export_profile(img, profile), region, scale)
+    return {'original_bytes': original, 'profiled_bytes': profiled,
+            'saving_percent': 100.0 * (original - profiled) / original if original else 0.0}
+
+def compress_geotiff(src_file, dst_file, nodata):
+    """Rewrites a GeoTIFF tiled and deflate-compressed with a declared nodata value"""
+    with rasterio.open(src_file) as src:
+        profile = src.profile.copy()
+        integer = np.issubdtype(np.dtype(profile['dtype']), np.integer)
+        profile.update(driver='GTiff', compress='deflate', predictor=2 if integer else 3, tiled=True,
+                       blockxsize=256, blockysize=256, nodata=nodata)
+        with rasterio.open(dst_file, 'w', **profile) as dst:
+            for _, window in src.block_windows(1):
+                dst.write(src.read(window=window), window=window)
+
+def local_download(img, filename, region, scale, profile=None):
+    """Downloads an image as a GeoTIFF to local drive.
+    With an export profile the image is cast to the profile's data type, downloaded zipped and
+    written deflate-compressed with the profile's nodata value.
+    Args:
+        img (object): ee.Image to download
+        filename (str): Output GeoTIFF
+        region (object): ee.FeatureCollection of the download region
+        scale (float): Download scale in meters
+        profile (dict, optional): Export profile (see export_profile). Defaults to None.
+    """
     print("Generating URL ...")
     proj = img.select(0).projection()
-    crs = proj.getInfo()['crs']
+    crs = get_info(proj)['crs']
+    if profile is not None:
+        img = apply_export_profile(img, profile)
     img = img.reproject(crs=crs,scale=scale)
-    url = ee.data.makeDownloadUrl(ee.data.getDownloadId({
+    url = ee.data.makeDownloadUrl(governor.call('getDownloadId', ee.data.getDownloadId, {
             'image': img,
             'region': region.geometry(),
             'filePerBand': False,
-            'format':"GEO_TIFF",
+            'format':"GEO_TIFF" if profile is None else "ZIPPED_GEO_TIFF",
             'maxPixels':1e13,
             'scale':scale,
             }))
     print(f"Downloading data from {url}")
-    local_zip, headers = urlretrieve(url)
-    shutil.move(local_zip,filename)
+    local_zip, headers = governor.call('urlretrieve', urlretrieve, url)
+    if profile is None:
+        shutil.move(local_zip,filename)
+        return
+    with zipfile.ZipFile(local_zip) as archive:
+        tif_name = [n for n in archive.namelist() if n.endswith('.tif')][0]
+        tmp_dir = tempfile.mkdtemp()
+        extracted = archive.extract(tif_name, tmp_dir)
+    compress_geotiff(extracted, filename, profile['nodata'])
+    shutil.rmtree(tmp_dir)
+    os.remove(local_zip)
     return
 
-def export_image_collection_to_local(ee_object, out_dir, name_pattern, date_pattern, extra, scale, region=None):
+def export_image_collection_to_local(ee_object, out_dir, name_pattern, date_pattern, extra, scale, region=None, profile=None,
+                                     strict=False):
     """Exports an ImageCollection as GeoTIFFs to local drive.
     Adapted from geemap's "ee_export_image_collection" method
     Args:
@@ -888,18 +2127,23 @@ def export_image_collection_to_local(ee_object, out_dir, name_pattern, date_patt
         scale (float, optional): A default scale to use for any bands that do not specify one; ignored if crs and crs_transform is specified. Defaults to None.
       crs (str, optional): A default CRS string to use for any bands that do not explicitly specify one. Defaults to None.
       region (object, optional): A polygon specifying a region to download; ignored if crs and crs_transform is specified. Defaults to None.
+        profile (dict, optional): Export profile for compact data types (see export_profile). Defaults to None.
+        strict (bool, optional): Raise the first download error instead of printing it. Defaults to False.
+    Returns:
+        list: Paths of the downloaded GeoTIFFs
     """
 
     if not isinstance(ee_object, ee.ImageCollection):
         print("The ee_object must be an ee.ImageCollection.")
-        return
+        return []
 
     if not os.path.exists(out_dir):
         os.makedirs(out_dir)
 
+    files = []
     try:
 
-        count = int(ee_object.size().getInfo())
+        count = int(get_info(ee_object.size()))
         print(f"Total number of images: {count}\n")
 
         for i in range(0, count):
@@ -907,7 +2151,7 @@ def export_image_collection_to_local(ee_object, out_dir, name_pattern, date_patt
             name_Pattern = name_pattern
             date_pattern = date_pattern
             extra = extra
-            name = makeName(image, name_Pattern, date_pattern, extra).getInfo()
+            name = get_info(makeName(image, name_Pattern, date_pattern, extra))
             name = name + ".tif"
             filename = os.path.join(os.path.abspath(out_dir), name)
             print(f"Exporting {i + 1}/{count}: {name}")
@@ -915,9 +2159,144 @@ def export_image_collection_to_local(ee_object, out_dir, name_pattern, date_patt
                 image,
                 filename=filename,
                 region=region,
-                scale=scale
+                scale=scale,
+                profile=profile
             )
+            files.append(filename)
             print("\n")
 
     except Exception as e:
+        if strict:
+            raise
         print(e)
+    return files
+
+# ee.Image methods casting to each numpy data type
+ee_cast_methods = {'uint8': 'toUint8', 'int8': 'toInt8', 'uint16': 'toUint16', 'int16': 'toInt16',
+                   'uint32': 'toUint32', 'int32': 'toInt32', 'float32': 'toFloat', 'float64': 'toDouble'}
+
+def datacube_grid(region, scale, crs='EPSG:4326'):
+    """Builds the pixel grid of a datacube covering a region
+    Args:
+        region (object): ee.FeatureCollection or ee.Geometry of the download region
+        scale (float): Pixel size in meters (in degrees when crs is EPSG:4326, converted at the equator)
+        crs (str, optional): Coordinate reference system of the grid. Defaults to 'EPSG:4326'.
+    Returns:
+        dict: 'crs', 'transform' ([xScale, xShear, xOrigin, yShear, yScale, yOrigin]), 'width' and 'height'
+    """
+    if isinstance(region, ee.FeatureCollection):
+        region = region.geometry()
+    coords = get_info(region.bounds(1, crs).coordinates())[0]
+    xs = [c[0] for c in coords]
+    ys = [c[1] for c in coords]
+    step = scale / 111320.0 if crs == 'EPSG:4326' else scale
+    width = int(math.ceil((max(xs) - min(xs)) / step))
+    height = int(math.ceil((max(ys) - min(ys)) / step))
+    return {'crs': crs, 'transform': [step, 0, min(xs), 0, -step, max(ys)], 'width': width, 'height': height}
+
+def _fetch_pixels(img, grid, row, col, height, width):
+    """Fetches a window of a datacube grid from Earth Engine as a structured numpy array"""
+    xs, _, x0, _, ys, y0 = grid['transform']
+    return governor.call('computePixels', ee.data.computePixels, {
+        'expression': img,
+        'fileFormat': 'NUMPY_NDARRAY',
+        'grid': {
+            'dimensions': {'width': width, 'height': height},
+            'affineTransform': {'scaleX': xs, 'shearX': 0, 'translateX': x0 + col * xs,
+                                'shearY': 0, 'scaleY': ys, 'translateY': y0 + row * ys},
+            'crsCode': grid['crs']}})
+
+def export_image_collection_to_zarr(ee_object, store, scale, region, bands=None, dtype='float32', nodata=-9999,
+                                    chunks=(16, 256, 256), crs='EPSG:4326', workers=8):
+    """Downloads an ImageCollection into a single chunked, compressed (time, y, x) Zarr datacube.
+    Every (time chunk, y chunk, x chunk) block is fetched with computePixels and written by one worker,
+    so writes are concurrent without two workers touching the same chunk. If the store already exists,
+    only images newer than its last date are downloaded and appended along time. The time axis is
+    extended only after every block of an append is written, so an interrupted append is redone in full.
+    Args:
+        ee_object (object): The ee.ImageCollection to download.
+        store (str): Path of the Zarr store (a folder, e.g. 'Landsat_Water.zarr')
+        scale (float): Pixel size in meters
+        region (object): ee.FeatureCollection of the download region
+        bands (list, optional): Bands to download. Defaults to all bands of the first image.
+        dtype (str, optional): Data type of the datacube. Defaults to 'float32'.
+        nodata (float, optional): Value stored for masked pixels. Defaults to -9999.
+        chunks (tuple, optional): Chunk sizes along (time, y, x). Defaults to (16, 256, 256).
+        crs (str, optional): Coordinate reference system of the grid. Defaults to 'EPSG:4326'.
+        workers (int, optional): Number of concurrent chunk downloads. Defaults to 8.
+    Returns:
+        int: Number of dates appended
+    """
+    if not isinstance(ee_object, ee.ImageCollection):
+        print("The ee_object must be an ee.ImageCollection.")
+        return 0
+
+    collection = ee_object.sort('system:time_start')
+
+    time_path = os.path.join(store, 'time')
+    if os.path.exists(time_path):
+        times = zarr.open_array(time_path, mode='a')
+        grid = times.attrs['grid']
+        bands = times.attrs['bands']
+        start = times.shape[0]
+        last_time = int(times[-1]) if start else None
+    else:
+        grid = datacube_grid(region, scale, crs)
+        start = 0
+        last_time = None
+        if bands is None:
+            bands = get_info(collection.first().bandNames())
+
+    if last_time is not None:
+        collection = collection.filter(ee.Filter.gt('system:time_start', last_time))
+    new_times = get_info(collection.aggregate_array('system:time_start'))
+    if not new_times:
+        print("The datacube is up to date.")
+        return 0
+    total = start + len(new_times)
+
+    shape = (total, grid['height'], grid['width'])
+    if start == 0:
+        times = zarr.open_array(time_path, mode='w', shape=(0,), chunks=(4096,), dtype='int64')
+        times.attrs['grid'] = grid
+        times.attrs['bands'] = bands
+        arrays = {b: zarr.open_array(os.path.join(store, b), mode='w', shape=shape, chunks=chunks,
+                                     dtype=dtype, fill_value=nodata) for b in bands}
+        for b, arr in arrays.items():
+            arr.attrs['nodata'] = nodata
+    else:
+        # Band arrays may be longer than the time axis after an interrupted append; those dates are rewritten
+        arrays = {b: zarr.open_array(os.path.join(store, b), mode='a') for b in bands}
+        for arr in arrays.values():
+            arr.resize(shape)
+        chunks = arrays[bands[0]].chunks
+
+    images = collection.toList(len(new_times))
+    cast = getattr(ee.Image, ee_cast_methods[str(np.dtype(dtype))])
+    prepared = [cast(ee.Image(images.get(i)).select(bands).unmask(nodata)) for i in range(len(new_times))]
+
+    def write_block(t0, row, col):
+        t1 = min(t0 + chunks[0], total)
+        height = min(chunks[1], grid['height'] - row)
+        width = min(chunks[2], grid['width'] - col)
+        blocks = {b: arrays[b][t0:t1, row:row + height, col:col + width] for b in arrays}
+        for t in range(max(t0, start), t1):
+            pixels = _fetch_pixels(prepared[t - start], grid, row, col, height, width)
+            for b in arrays:
+                blocks[b][t - t0] = pixels[b]
+        for b in arrays:
+            arrays[b][t0:t1, row:row + height, col:col + width] = blocks[b]
+
+    first_chunk = (start // chunks[0]) * chunks[0]
+    jobs = [(t0, row, col) for t0 in range(first_chunk, total, chunks[0])
+            for row in range(0, grid['height'], chunks[1])
+            for col in range(0, grid['width'], chunks[2])]
+    print(f"Downloading {len(new_times)} images in {len(jobs)} chunks ...")
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for future in [pool.submit(write_block, *job) for job in jobs]:
+            future.result()
+
+    # Commit the new dates once all their blocks are stored
+    times.resize((total,))
+    times[start:total] = new_times
+    return len(new_times)
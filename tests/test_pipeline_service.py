@@ -0,0 +1,69 @@
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+PipelineService = pytest.importorskip('PipelineService').PipelineService
+
+boundary = {'type': 'FeatureCollection', 'features': [
+    {'type': 'Feature', 'properties': {},
+     'geometry': {'type': 'Polygon', 'coordinates': [[[0, 0], [1, 0], [1, 1], [0, 1], [0, 0]]]}}]}
+
+request = {'boundary_geojson': boundary, 'start': '2020-01-01', 'end': '2021-01-01'}
+
+class StubRunner:
+    """Stands in for BatchRunner.run_job: writes an area series, optionally waiting for a release or failing"""
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.calls = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def __call__(self, job, checkpoint_dir):
+        self.calls.append(job['id'])
+        self.release.wait(10)
+        if self.fail:
+            raise RuntimeError('Earth Engine unavailable')
+        job_dir = os.path.join(checkpoint_dir, job['id'])
+        os.makedirs(job_dir, exist_ok=True)
+        with open(os.path.join(job_dir, 'areas.csv'), 'w') as f:
+            f.write('Date,"Area, Sq m"\n2020-01-01,5.5\n2020-01-17,\n')
+        return {'id': job['id'], 'status': 'completed', 'stages': {}, 'error': None, 'seconds': 0.0}
+
+def test_duplicate_requests_join_one_job(tmp_path):
+    runner = StubRunner()
+    runner.release.clear()
+    service = PipelineService(str(tmp_path), workers=2, runner=runner)
+    records = [service.submit(request) for _ in range(3)]
+    runner.release.set()
+    service.queue.join()
+
+    assert len({r['job_id'] for r in records}) == 1
+    assert [r['deduplicated'] for r in records] == [False, True, True]
+    assert len(runner.calls) == 1
+    assert service.status(records[0]['job_id'])['requests'] == 3
+
+def test_completed_job_is_served_from_cache(tmp_path):
+    runner = StubRunner()
+    service = PipelineService(str(tmp_path), workers=1, runner=runner)
+    job_id = service.submit(request)['job_id']
+    service.queue.join()
+
+    record = service.submit(dict(request))
+    assert record['deduplicated'] and record['state'] == 'completed' and record['job_id'] == job_id
+    assert len(runner.calls) == 1
+    assert service.series(job_id, 'area') == {'Date': ['2020-01-01', '2020-01-17'], 'Area, Sq m': [5.5, None]}
+
+def test_failed_runner_is_reported(tmp_path):
+    runner = StubRunner(fail=True)
+    service = PipelineService(str(tmp_path), workers=1, runner=runner)
+    job_id = service.submit(request)['job_id']
+    service.queue.join()
+
+    record = service.status(job_id)
+    assert record['state'] == 'failed'
+    assert 'Earth Engine unavailable' in record['error']
+    assert record['finished'] is not None